@@ -1,10 +1,46 @@
-from flask import Flask
+from flask import Flask, g, request
 from flask_bootstrap import Bootstrap
 
+from app.instrumentation import instrumentation
+from app.pool import release_connections
+
 app = Flask(__name__)
 bootstrap = Bootstrap(app)
 app.config['DEBUG'] = True
 app.config['SECRET_KEY'] = 'you-will-never-guess'
+# module with User, Book and Tag models used by routes
+app.config['MODELS'] = 'app.arango_models'
+# buffer relationships created by requests and write them in batches
+app.config['WRITE_BEHIND'] = False
+# directory of graph snapshot in-process indexes are warm started from, shared by workers
+app.config['SNAPSHOT'] = None
+
+
+@app.before_request
+def start_query_stats():
+    """ Collect queries issued by request """
+    g.query_stats = instrumentation.begin(request.endpoint)
+
+
+@app.after_request
+def add_query_stats(response):
+    """ Report queries issued before response in Server-Timing header,
+     queries of streamed body are only in g.query_stats """
+    stats = g.get('query_stats')
+    if stats is not None:
+        response.headers['Server-Timing'] = ('db;dur=%.3f;desc="%d queries, %d bytes"'
+                                             % (stats.seconds * 1000, stats.queries, stats.bytes))
+    return response
+
+
+@app.teardown_request
+def release_database_connections(exception=None):
+    """ Give connections used by request back to the pools """
+    stats = g.pop('query_stats', None)
+    if stats is not None:
+        instrumentation.end(stats)
+    release_connections()
+
 
 from app import routes
 
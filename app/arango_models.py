@@ -3,12 +3,38 @@ from arango import DocumentInsertError
 from arango_orm.exceptions import DocumentNotFoundError
 from arango_orm.fields import String, Integer
 from arango_orm import Collection, Relation, Graph, GraphConnection
-from passlib.hash import sha256_crypt
-from .databases import ArangoDataBase
-
-db = ArangoDataBase.connect()
-
-
+from .cache import LRUCache, TTLCache, cached
+from .databases import arango_pool
+from .instrumentation import instrumentation, instrumented
+from .passwords import verifier
+from .pool import LazyConnection
+from .popularity import reader_counts
+from .recommendations import recommender
+from .similarity import book_similarity
+from .tag_index import tag_index
+from .utils import BATCH_SIZE, batches, index_updates, ordered
+from .write_behind import WriteBehind
+
+# connection of current thread, opened on first query
+db = LazyConnection(arango_pool)
+
+# (collection, _key) -> document, shared by all relationship inserts
+vertex_cache = LRUCache()
+# results of aggregate queries, dropped by writes changing them
+query_cache = TTLCache()
+
+# collection -> fields with unique hash index, created by create_schema()
+UNIQUE_FIELDS = {
+    "users": ["username"],
+}
+
+# documents fetched per round trip of cursors by users() and books()
+FETCH_SIZE = 1000
+# records of one page of users_page() and books_page()
+PAGE_SIZE = 100
+
+
+@instrumented
 class User(Collection):
     """Class for User node"""
     __collection__ = 'users'
@@ -26,7 +52,7 @@ class User(Collection):
     def find(self):
         """ Return user in database by username """
         try:
-            user = db.query(User).filter_by(self.username)
+            user = db.query(User).filter("username==@username", username=self.username)
             return user.first()
         except DocumentNotFoundError:
             return None
@@ -35,45 +61,146 @@ class User(Collection):
         user = db.query(User).by_key(self._key)
         return user
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (users in order of ids, ids without user) fetched by one query """
+        return _find_many(User, ids)
+
     def insert(self):
-        """ Insert user node to graph """
-        try:
-            db.add(self)
-        except DocumentInsertError:
-            pass
+        """ Insert user node to graph, existing user with the same key is kept """
+        _add(self)
+        vertex_cache.put((User.__collection__, str(self._key)), self)
+
+    @staticmethod
+    def insert_many(users, batch_size=BATCH_SIZE):
+        """ Insert user nodes to graph with one bulk import per batch """
+        documents = ({'_key': str(user['user_id']),
+                      'username': user['username'],
+                      'password': user['password']} for user in users)
+        _import_documents(User.__collection__, documents, batch_size)
 
     def verify_password(self, password):
-        """ Return if password is valid """
+        """ Return if password matches hash stored in the user found by username,
+         hash is checked in the pool of password verifier """
         user = self.find()
         if not user:
             return False
-        return sha256_crypt.verify(password, user.password)
+        return verifier.verify(password, user.password)
+
+    def login(self, password):
+        """ Return session token of user id if password is valid, else None """
+        user = self.find()
+        if not user:
+            return None
+        return verifier.login(int(user._key), password, user.password)
 
     def reads(self, book_id):
         """ Create relationship (User)-[:READS]->(Book) """
-        if self.find_by_id():
-            book = db.query(Book).by_key(book_id)
-            db.add(graph.relation(self, Relation("reads"), book))
+        if write_behind.enabled:
+            write_behind.add("reads", self._key, book_id)
+            return
+        user = _vertex(User, self._key)
+        book = _vertex(Book, book_id)
+        if user and book and _add(_relation(user, "reads", book)):
+            _count_reader(self._key, book_id)
 
     def follows(self, friend_id):
         """ Create relationship (User)-[:FOLLOWS]->(User) """
-        if self.find_by_id():
-            friend = db.query(User).by_key(friend_id)
-            db.add(graph.relation(self, Relation("follows"), friend))
+        if write_behind.enabled:
+            write_behind.add("follows", self._key, friend_id)
+            return
+        user = _vertex(User, self._key)
+        friend = _vertex(User, friend_id)
+        if user and friend and _add(_relation(user, "follows", friend)):
+            recommender.add_follow(self._key, friend_id)
 
     def likes(self, book_id):
         """ Create relationship (User)-[:LIKES]->(Book) """
-        if self.find_by_id():
-            book = db.query(Book).by_key(book_id)
-            db.add(graph.relation(self, Relation("likes"), book))
+        if write_behind.enabled:
+            write_behind.add("likes", self._key, book_id)
+            return
+        user = _vertex(User, self._key)
+        book = _vertex(Book, book_id)
+        if user and book and _add(_relation(user, "likes", book)):
+            recommender.add_like(self._key, book_id)
+
+    @staticmethod
+    def reads_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:READS]->(Book) from (user_id, book_id) pairs """
+        _import_edges(Reads.__collection__, User, Book, pairs, batch_size, _count_reader)
+
+    @staticmethod
+    def follows_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:FOLLOWS]->(User) from (user_id, friend_id) pairs """
+        _import_edges(Follows.__collection__, User, User, pairs, batch_size,
+                      recommender.add_follow)
+        recommender.compact()
+
+    @staticmethod
+    def likes_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:LIKES]->(Book) from (user_id, book_id) pairs """
+        _import_edges(Likes.__collection__, User, Book, pairs, batch_size, recommender.add_like)
+        recommender.compact()
+
+    def recommended_books(self, k=10):
+        """ Return ids of books liked by followed users, precomputed in memory """
+        write_behind.flush(self._key)
+        return recommender.recommend(self._key, k)
+
+    def recommended_books_query(self, k=10):
+        """ Return ids of books liked by followed users, computed by database """
+        write_behind.flush(self._key)
+        query = """
+                LET liked = (FOR book IN 1..1 OUTBOUND @user likes RETURN book._id)
+                FOR friend IN 1..1 OUTBOUND @user follows
+                    FOR book IN 1..1 OUTBOUND friend likes
+                        FILTER book._id NOT IN liked
+                        COLLECT book_id = book._key WITH COUNT INTO score
+                        SORT score DESC, book_id
+                        LIMIT @k
+                        RETURN book_id
+                """
+        cursor = db.aql.execute(query, bind_vars={'user': '%s/%s' % (User.__collection__, self._key),
+                                                  'k': k})
+        return [int(book_id) for book_id in cursor]
 
     @staticmethod
-    def users():
-        """Return list of all users"""
-        users = db.query(User).all()
-        return [u.username for u in users]
+    def users(fetch_size=None):
+        """ Yield usernames of all users from server side cursor """
+        return db.aql.execute("FOR user IN users RETURN user.username",
+                              batch_size=fetch_size or FETCH_SIZE)
+
+    @staticmethod
+    def users_page(after=None, limit=PAGE_SIZE):
+        """ Return user_id and username of at most limit users with key greater than after,
+         keys are ordered as strings """
+        query = """
+                FOR user IN users
+                    FILTER user._key > @after
+                    SORT user._key
+                    LIMIT @limit
+                    RETURN {user_id: TO_NUMBER(user._key), username: user.username}
+                """
+        return list(db.aql.execute(query, bind_vars={'after': '' if after is None else str(after),
+                                                     'limit': limit}))
+
+    @staticmethod
+    def export_page(after=None, limit=PAGE_SIZE):
+        """ Return all properties, password hash included, of at most limit users
+         with key greater than after, keys are ordered as strings """
+        query = """
+                FOR user IN users
+                    FILTER user._key > @after
+                    SORT user._key
+                    LIMIT @limit
+                    RETURN {user_id: TO_NUMBER(user._key), username: user.username,
+                            password: user.password}
+                """
+        return list(db.aql.execute(query, bind_vars={'after': '' if after is None else str(after),
+                                                     'limit': limit}))
 
 
+@instrumented
 class Book(Collection):
     """Class for Book node"""
 
@@ -94,46 +221,100 @@ class Book(Collection):
         self.language = language
 
     def insert(self):
-        """Inserting book node to graph"""
-        db.add(self)
+        """ Insert book node to graph, existing book with the same key is kept """
+        _add(self)
+        vertex_cache.put((Book.__collection__, str(self._key)), self)
+
+    @staticmethod
+    def insert_many(books, batch_size=BATCH_SIZE):
+        """ Insert book nodes to graph with one bulk import per batch """
+        documents = ({'_key': str(book['book_id']),
+                      'authors': book['authors'],
+                      'year': book['year'],
+                      'title': book['title'],
+                      'language': book['language']} for book in books)
+        _import_documents(Book.__collection__, documents, batch_size)
 
     def find_by_id(self):
         book = db.query(Book).by_key(self._key)
         return book
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (books in order of ids, ids without book) fetched by one query """
+        return _find_many(Book, ids)
+
     def linked_tags(self):
-        """Return list of tags for specific book"""
-        book = db.query(Book).by_key(self._key)
-        graph.expand(book, depth=1, direction='any')
-        tags = [tag._object_from.tag_name for tag in book._relations["tagged_to"]]
-        return tags
+        """Return list of tags for specific book, from tag index if it is complete"""
+        if tag_index.complete:
+            return tag_index.tag_names(self._key)
+        query = "FOR tag IN 1..1 OUTBOUND @book tagged_to RETURN tag.tag_name"
+        return list(db.aql.execute(query, bind_vars={'book': '%s/%s' % (Book.__collection__,
+                                                                       self._key)}))
+
+    def similar_books(self, k=10):
+        """ Return ids of k books with the most similar tags """
+        return book_similarity.similar(self._key, k)
 
     def link_to_tag(self, tag_id):
         """Create relationship (Book)-[:TAGGED_TO]->(Tag) """
-        if self.find_by_id():
-            tag = db.query(Tag).by_key(tag_id)
-            db.add(graph.relation(self, Relation("tagged_to"), tag))
+        book = _vertex(Book, self._key)
+        tag = _vertex(Tag, tag_id)
+        if book and tag and _add(_relation(book, "tagged_to", tag)):
+            _tag_book(self._key, tag_id)
+
+    @staticmethod
+    def link_to_tag_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (Book)-[:TAGGED_TO]->(Tag) from (book_id, tag_id) pairs """
+        _import_edges(TaggedTo.__collection__, Book, Tag, pairs, batch_size, _tag_book)
+        tag_index.compact()
 
     @staticmethod
-    def books():
-        """Return list of all books"""
-        books = db.query(Book).all()
-        return books
+    def books(fetch_size=None):
+        """ Yield properties of all books from server side cursor """
+        query = """
+                FOR book IN books
+                    RETURN {book_id: TO_NUMBER(book._key), title: book.title,
+                            authors: book.authors, year: book.year, language: book.language}
+                """
+        return db.aql.execute(query, batch_size=fetch_size or FETCH_SIZE)
 
+    @staticmethod
+    def books_page(after=None, limit=PAGE_SIZE):
+        """ Return properties of at most limit books with key greater than after,
+         keys are ordered as strings """
+        query = """
+                FOR book IN books
+                    FILTER book._key > @after
+                    SORT book._key
+                    LIMIT @limit
+                    RETURN {book_id: TO_NUMBER(book._key), title: book.title,
+                            authors: book.authors, year: book.year, language: book.language}
+                """
+        return list(db.aql.execute(query, bind_vars={'after': '' if after is None else str(after),
+                                                     'limit': limit}))
 
     @staticmethod
+    @cached(query_cache, "most_popular_books")
     def most_popular_books():
-        """ Returns books which are read by most amount of users """
+        """ Returns books which are read by most amount of users,
+         reads edges point from user to book and are grouped by the book """
         query = """
-                FOR user IN users
-                    FOR book IN INBOUND user reads
-                        COLLECT book_doc=book WITH COUNT INTO amount
-                        SORT book_doc, amount ASC
-                        RETURN {"book":book_doc, "count":amount}
+                FOR read IN reads
+                    COLLECT book_id = read._to WITH COUNT INTO amount
+                    SORT amount DESC, book_id
+                    LIMIT 16
+                    RETURN {"book": DOCUMENT(book_id), "count": amount}
                 """
-        return graph.aql(query)
+        return list(db.aql.execute(query))
+
+    @staticmethod
+    def most_popular_book_ids(n=16):
+        """ Return ids of the most read books from reader counts kept in memory """
+        return reader_counts.top(n)
 
 
+@instrumented
 class Tag(Collection):
     """Class for Tag node"""
 
@@ -148,13 +329,65 @@ class Tag(Collection):
         self.tag_name = tag_name
 
     def insert(self):
-        """ Insert tag to graph"""
-        db.add(self)
+        """ Insert tag to graph, existing tag with the same key is kept """
+        _add(self)
+        vertex_cache.put((Tag.__collection__, str(self._key)), self)
+        tag_index.name(self._key, self.tag_name)
+
+    @staticmethod
+    def insert_many(tags, batch_size=BATCH_SIZE):
+        """ Insert tag nodes to graph with one bulk import per batch """
+        if index_updates.enabled:
+            tags = tag_index.name_rows(tags)
+        documents = ({'_key': str(tag['tag_id']), 'tag_name': tag['tag_name']} for tag in tags)
+        _import_documents(Tag.__collection__, documents, batch_size)
 
     def find_by_id(self):
         tag = db.query(Tag).by_key(self._key)
         return tag
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (tags in order of ids, ids without tag) fetched by one query """
+        return _find_many(Tag, ids)
+
+    @staticmethod
+    def tags_page(after=None, limit=PAGE_SIZE):
+        """ Return tag_id and tag_name of at most limit tags with key greater than after,
+         keys are ordered as strings """
+        query = """
+                FOR tag IN tags
+                    FILTER tag._key > @after
+                    SORT tag._key
+                    LIMIT @limit
+                    RETURN {tag_id: TO_NUMBER(tag._key), tag_name: tag.tag_name}
+                """
+        return list(db.aql.execute(query, bind_vars={'after': '' if after is None else str(after),
+                                                     'limit': limit}))
+
+    def books(self):
+        """ Return ids of books tagged with tag, from tag index if it is complete """
+        return Tag.books_with_tags([self._key])
+
+    @staticmethod
+    def books_with_tags(tag_ids):
+        """ Return sorted ids of books tagged with all of tags, from tag index if it is complete """
+        if tag_index.complete:
+            return tag_index.books(*tag_ids).tolist()
+        tags = sorted({'%s/%s' % (Tag.__collection__, int(tag_id)) for tag_id in tag_ids})
+        if not tags:
+            return []
+        query = """
+                FOR edge IN tagged_to
+                    FILTER edge._to IN @tags
+                    COLLECT book = edge._from AGGREGATE amount = COUNT_DISTINCT(edge._to)
+                    FILTER amount == LENGTH(@tags)
+                    LET book_id = TO_NUMBER(PARSE_IDENTIFIER(book).key)
+                    SORT book_id
+                    RETURN book_id
+                """
+        return list(db.aql.execute(query, bind_vars={'tags': tags}))
+
 
 class TaggedTo(Relation):
     __collection__ = "tagged_to"
@@ -194,11 +427,155 @@ class BooksGraph(Graph):
 
 
 graph = BooksGraph(connection=db)
-#db.create_graph(graph)
+
+# relationships created by requests, buffered and written in batches once started
+write_behind = WriteBehind({"reads": User.reads_many,
+                           "follows": User.follows_many,
+                           "likes": User.likes_many})
+
+# relationship -> edge collection, streamed by relationships()
+RELATIONSHIPS = {
+    "reads": Reads,
+    "follows": Follows,
+    "likes": Likes,
+    "tagged_to": TaggedTo,
+}
+# AQL returning (from key, to key) pairs of edges as numbers
+_EDGE_IDS = "{from_id: TO_NUMBER(PARSE_IDENTIFIER(edge._from).key), " \
+            "to_id: TO_NUMBER(PARSE_IDENTIFIER(edge._to).key)}"
+
+
+def relationships(relationship, fetch_size=None):
+    """ Yield (from_id, to_id) pairs of all edges from server side cursor """
+    query = "FOR edge IN @@edges RETURN " + _EDGE_IDS
+    cursor = db.aql.execute(query, bind_vars={'@edges': RELATIONSHIPS[relationship].__collection__},
+                            batch_size=fetch_size or FETCH_SIZE)
+    return ((edge['from_id'], edge['to_id']) for edge in cursor)
+
+
+def _vertex(model, key):
+    """ Return document of model by key, looking into vertex_cache first """
+    def load():
+        try:
+            return db.query(model).by_key(key)
+        except DocumentNotFoundError:
+            return None
+
+    key = str(key)
+    return vertex_cache.resolve((model.__collection__, key), load)
+
+
+def _find_many(model, keys):
+    """ Return (documents of model in order of keys, keys without document)
+     fetched by one request """
+    keys = [str(key) for key in keys]
+    documents = db.collection(model.__collection__).get_many(keys)
+    return ordered(keys, {document["_key"]: model._load(document, db=db) for document in documents})
+
+
+def _count_reader(_, book_id):
+    """ Count reader of book, cached most popular books are dropped if the top changed """
+    if reader_counts.add(int(book_id)):
+        query_cache.discard("most_popular_books")
+
+
+def _tag_book(book_id, tag_id):
+    """ Register new tag of book in tag index and similar books """
+    tag_index.add(book_id, tag_id)
+    book_similarity.add(book_id, tag_id)
+
+
+def _edge_key(from_key, to_key):
+    """ Key of edge between two documents, the same edge is imported only once """
+    return '%s-%s' % (from_key, to_key)
+
+
+def _add(document):
+    """ Insert document, document with the same key is kept; return if it was inserted """
+    try:
+        db.add(document)
+    except DocumentInsertError:
+        return False
+    return True
+
+
+def _relation(from_document, name, to_document):
+    """ Return edge of collection name between documents with key from their keys """
+    relation = graph.relation(from_document, Relation(name), to_document)
+    relation._key = _edge_key(from_document._key, to_document._key)
+    return relation
+
+
+def _import_documents(collection, documents, batch_size, on_duplicate='update'):
+    """ Bulk import documents to collection, documents with existing keys are updated """
+    for batch in batches(documents, batch_size):
+        db.collection(collection).import_bulk(batch, halt_on_error=False,
+                                              on_duplicate=on_duplicate)
+
+
+def _existing_keys(collection, keys):
+    """ Return set of keys of documents of collection which exist, fetched by one request """
+    return set(document['_key'] for document in db.collection(collection).get_many(list(keys)))
+
+
+def _import_edges(collection, from_model, to_model, pairs, batch_size, created=None):
+    """ Bulk import edges built from (from_key, to_key) pairs. Edges which already exist
+     and edges with missing vertices are skipped, created(from_key, to_key) is called
+     for every imported edge """
+    for batch in batches(pairs, batch_size):
+        keys = {}
+        for from_key, to_key in batch:
+            keys.setdefault(_edge_key(from_key, to_key), (from_key, to_key))
+        sources = _existing_keys(from_model.__collection__,
+                                 set(str(from_key) for from_key, _ in keys.values()))
+        targets = _existing_keys(to_model.__collection__,
+                                 set(str(to_key) for _, to_key in keys.values()))
+        existing = _existing_keys(collection, keys)
+        new = [(key, from_key, to_key) for key, (from_key, to_key) in keys.items()
+               if key not in existing and str(from_key) in sources and str(to_key) in targets]
+        edges = [{'_key': key,
+                  '_from': '%s/%s' % (from_model.__collection__, from_key),
+                  '_to': '%s/%s' % (to_model.__collection__, to_key)} for key, from_key, to_key in new]
+        if edges:
+            db.collection(collection).import_bulk(edges, halt_on_error=False, on_duplicate='ignore')
+        if created is not None and index_updates.enabled:
+            for _, from_key, to_key in new:
+                created(from_key, to_key)
+
+
+def create_schema(indexes=True):
+    """ Create graph with its collections and unique indexes, or drop the indexes
+     if indexes is False. Ids are keys of documents and edges always have edge index """
+    if not db.has_graph(BooksGraph.__graph__):
+        db.create_graph(graph)
+    for name, fields in UNIQUE_FIELDS.items():
+        collection = db.collection(name)
+        existing = [index for index in collection.indexes()
+                    if index["type"] == "hash" and index["fields"] == fields]
+        if indexes and not existing:
+            collection.add_hash_index(fields=fields, unique=True)
+        elif not indexes:
+            for index in existing:
+                collection.delete_index(index["id"])
 
 
 def clear_graph():
     """Clear data from the graph"""
+    write_behind.clear()
     db.delete_graph('book_graph')
+    vertex_cache.clear()
+    recommender.clear()
+    query_cache.clear()
+    reader_counts.clear()
+    tag_index.clear()
+    book_similarity.clear()
     return True
 
+
+def _instrument(connection):
+    """ Record every HTTP request of new connection, including next batches of cursors """
+    instrumentation.instrument(connection._conn, ("send_request",), "arangodb",
+                               size=lambda response: len(response.raw_body or ""))
+
+
+arango_pool.on_connect.append(_instrument)
@@ -0,0 +1,217 @@
+"""Benchmark runner for experiments.
+
+Every benchmark is run several times after warmup runs, times are summarized
+as min/median/p95/stddev and stored with metadata of the run. Runs can be
+saved as baseline and later runs compared against it. Benchmarks of
+in-process indexes and snapshot export, which are not query workloads,
+are run here too.
+"""
+import csv
+import json
+import os
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+from . import datasets
+from .similarity import book_similarity
+from .snapshot import from_datasets, from_models
+
+WARMUP = 1
+REPEAT = 5
+# median slower than baseline median by this fraction is a regression
+THRESHOLD = 0.1
+
+
+def summarize(times):
+    """ Return statistics of list of running times in seconds """
+    times = np.asarray(times, dtype=float)
+    return {'runs': len(times),
+            'min': float(times.min()),
+            'median': float(np.median(times)),
+            'p95': float(np.percentile(times, 95)),
+            'mean': float(times.mean()),
+            'stddev': float(times.std(ddof=1)) if len(times) > 1 else 0.0}
+
+
+def commit():
+    """ Return hash of checked out commit or None outside of git repository """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+class Measured:
+    """ Running time measured by benchmarked function itself, returned
+     instead of its result to replace the wall time of the call """
+
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Benchmark:
+    """ Runs benchmarks of one backend and collects their statistics """
+
+    def __init__(self, backend, warmup=WARMUP, repeat=REPEAT, **metadata):
+        self.backend = backend
+        self.warmup = warmup
+        self.repeat = repeat
+        self.metadata = dict(metadata,
+                             backend=backend,
+                             warmup=warmup,
+                             repeat=repeat,
+                             commit=commit(),
+                             python=platform.python_version(),
+                             host=platform.node(),
+                             started=datetime.now().isoformat())
+        self.results = {}
+
+    def run(self, name, func, setup=None):
+        """ Run func warmup + repeat times and return its statistics.
+
+        setup is called before every run and is not timed. func may return
+        Measured with its own running time, e.g. to leave out starting of workers.
+        """
+        times = []
+        for run in range(self.warmup + self.repeat):
+            if setup is not None:
+                setup()
+            time_start = perf_counter()
+            measured = func()
+            running_time = perf_counter() - time_start
+            if isinstance(measured, Measured):
+                running_time = measured.seconds
+            if run >= self.warmup:
+                times.append(running_time)
+        stats = summarize(times)
+        stats['times'] = times
+        self.results[name] = stats
+        return stats
+
+    def save_csv(self, path='results.csv', fieldnames=None):
+        """ Append medians to results table, one row per benchmark in column of backend """
+        save_results(path, self.backend,
+                     [(name, stats['median']) for name, stats in self.results.items()],
+                     fieldnames)
+
+    def save_json(self, path):
+        """ Append run with metadata and all statistics as one line of JSON """
+        with open(path, mode='a') as json_file:
+            json_file.write(json.dumps({'metadata': self.metadata, 'results': self.results}) + '\n')
+
+    def compare(self, baseline, threshold=THRESHOLD):
+        """ Return list of (name, baseline median, median) of regressions.
+
+        Benchmark regressed if its median is slower than baseline median by
+        more than threshold and even its fastest run is slower than baseline p95.
+        """
+        regressions = []
+        for name, stats in self.results.items():
+            before = baseline['results'].get(name)
+            if before is None:
+                continue
+            if stats['median'] > before['median'] * (1 + threshold) and stats['min'] > before['p95']:
+                regressions.append((name, before['median'], stats['median']))
+        return regressions
+
+
+def save_results(path, backend, results, fieldnames=None):
+    """ Append (name, value) pairs to results table in column of backend """
+    fieldnames = fieldnames or ['name', backend]
+    write_header = not os.path.exists(path)
+    with open(path, mode='a') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+        for name, value in results:
+            writer.writerow({'name': name, backend: value})
+
+
+def load_run(path, backend=None):
+    """ Return last run saved with Benchmark.save_json, optionally of backend only """
+    last = None
+    with open(path) as json_file:
+        for line in json_file:
+            run = json.loads(line)
+            if backend is None or run['metadata']['backend'] == backend:
+                last = run
+    if last is None:
+        raise ValueError('no benchmark run of %s in %s' % (backend or 'any backend', path))
+    return last
+
+
+def report(name, stats):
+    """ Return one line summary of statistics """
+    return ('%s: median %.4f s, min %.4f s, p95 %.4f s, stddev %.4f s, %d runs'
+            % (name, stats['median'], stats['min'], stats['p95'], stats['stddev'], stats['runs']))
+
+
+def report_cache(test_name, cache, cache_name='vertex'):
+    """ Print hits and misses of cache collected during test, nothing without cache """
+    if cache is None:
+        return
+    stats = cache.stats()
+    print('%s: %s cache hits %d, misses %d, hit ratio %.2f, size %d'
+          % (test_name, cache_name, stats['hits'], stats['misses'], stats['hit_ratio'],
+             stats['size']))
+
+
+def report_queries(stats):
+    """ Print queries issued during test, nothing for backends without database """
+    if stats.queries:
+        print('\n'.join(stats.report()))
+
+
+def report_profile(profile, directory):
+    """ Print and save profile of phase, return results per run of it """
+    print('\n'.join(profile.report()))
+    print('%s: profile saved to %s' % (profile.name, ', '.join(profile.save(directory))))
+    runs = profile.runs or 1
+    return [('%s[cpu_s]' % profile.name, profile.cpu / runs),
+            ('%s[wait_s]' % profile.name, profile.wait / runs),
+            ('%s[peak_mb]' % profile.name, profile.peak / 2 ** 20)]
+
+
+def run_similar_books(backend, warmup=WARMUP, repeat=REPEAT):
+    """ Measure time and peak memory of computing similar books of all books,
+     return results """
+    books, tags = datasets.columns('tagged_to')
+    counts = np.ones(len(books))
+    peaks = []
+
+    def build():
+        tracemalloc.start()
+        time_start = perf_counter()
+        book_similarity.build(books, tags, counts)
+        running_time = perf_counter() - time_start
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        return Measured(running_time)
+
+    name = 'build_similar_books[rows=%d]' % len(books)
+    stats = Benchmark(backend, warmup=warmup, repeat=repeat).run(name, build)
+    print(report(name, stats))
+    print('%s: peak memory %.1f MB, similar books %.1f MB'
+          % (name, max(peaks) / 2 ** 20, book_similarity.nbytes() / 2 ** 20))
+    return [(name, stats['median']),
+            ('%s[peak_mb]' % name, max(peaks) / 2 ** 20),
+            ('%s[size_mb]' % name, book_similarity.nbytes() / 2 ** 20)]
+
+
+def export_snapshot(source, path, models=None):
+    """ Write snapshot of datasets or of graph stored by models to path """
+    time_start = perf_counter()
+    snapshot = from_datasets() if source == 'datasets' else from_models(models)
+    snapshot.save(path)
+    print('snapshot of %s: %d relationships, %.1f MB written to %s in %.4f s'
+          % (snapshot.source, len(snapshot), snapshot.nbytes / 2 ** 20, path,
+             perf_counter() - time_start))
@@ -0,0 +1,103 @@
+"""Caches shared by the models of all databases"""
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from time import monotonic
+
+CACHE_SIZE = 100000
+QUERY_CACHE_SIZE = 128
+# seconds after which cached query result is dropped even without writes
+QUERY_TTL = 60
+
+
+class LRUCache:
+    """ Bounded mapping which evicts least recently used keys
+     and counts hits and misses """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Return cached value and mark it as recently used """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """ Cache value, evicting the least recently used one if cache is full """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def resolve(self, key, loader):
+        """ Return cached value or load it with loader(), None is not cached """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Drop all values and reset counters """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Return dict with hits, misses, hit ratio and size of cache """
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+                'size': len(self._data)}
+
+
+class TTLCache(LRUCache):
+    """ LRU cache whose values expire ttl seconds after they were put """
+
+    def __init__(self, maxsize=QUERY_CACHE_SIZE, ttl=QUERY_TTL):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        """ Return cached value unless it expired, expired value is dropped """
+        with self._lock:
+            if key in self._data and self._data[key][0] >= monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][1]
+            self._data.pop(key, None)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        super(TTLCache, self).put(key, (monotonic() + self.ttl, value))
+
+
+def cached(cache, key):
+    """ Decorator caching result of function without arguments under key """
+    def decorator(func):
+        @wraps(func)
+        def wrapper():
+            return cache.resolve(key, func)
+        return wrapper
+    return decorator
@@ -0,0 +1,79 @@
+"""Checkpoints of resumable loading.
+
+Loader inserts rows of a dataset batch by batch and after every committed
+batch stores how many rows of the dataset are in the database. Restarted
+load skips these rows and continues with the next batch; the batch which was
+interrupted is inserted again, which is safe because inserts of the models
+upsert nodes and skip existing relationships. Checkpoint of a dataset is
+forgotten when its load finishes and when the graph is cleared, so a later
+load never skips rows which are not in the database.
+"""
+import json
+import os
+import warnings
+from itertools import islice
+from threading import Lock
+
+from .utils import BATCH_SIZE, batches
+
+CHECKPOINT_FILE = 'load_checkpoint.json'
+
+
+class Checkpoint:
+    """ Amount of committed rows of every dataset, kept in JSON file """
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self._lock = Lock()
+        self._done = {}
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self._done = json.load(checkpoint_file)
+
+    def done(self, key):
+        """ Return amount of rows committed under key """
+        with self._lock:
+            return self._done.get(key, 0)
+
+    def commit(self, key, rows):
+        """ Store amount of committed rows, file is replaced atomically """
+        with self._lock:
+            self._done[key] = rows
+            self._save()
+
+    def reset(self, key):
+        """ Forget rows of key, next load starts from the beginning """
+        with self._lock:
+            if self._done.pop(key, None) is not None:
+                self._save()
+
+    def reset_all(self, prefix=''):
+        """ Forget rows of all keys starting with prefix, e.g. of one backend """
+        with self._lock:
+            keys = [key for key in self._done if key.startswith(prefix)]
+            for key in keys:
+                del self._done[key]
+            if keys:
+                self._save()
+
+    def _save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(self._done, checkpoint_file, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+def load_resumable(checkpoint, key, rows, insert_many, batch_size=BATCH_SIZE, total=None):
+    """ Insert rows after the checkpoint of key with insert_many(batch, batch_size),
+     committing checkpoint after every batch and forgetting it at the end; return
+     amount of inserted rows. Checkpoint covering all total rows is not resumed """
+    done = start = checkpoint.done(key)
+    if total is not None and start >= total:
+        warnings.warn('checkpoint of %s covers all %d rows, loading them again' % (key, total))
+        done = start = 0
+    for batch in batches(islice(rows, start, None), batch_size):
+        insert_many(batch, batch_size)
+        done += len(batch)
+        checkpoint.commit(key, done)
+    checkpoint.reset(key)
+    return done - start
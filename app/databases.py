@@ -3,6 +3,8 @@ import pyorient
 import arango
 import arango_orm
 
+from app.pool import ConnectionPool
+
 
 class Neo4JDataBase:
 
@@ -45,3 +47,10 @@ class ArangoDataBase:
         sys_db = client.db('_system', username='root', password='root')
         sys_db.create_database('books')
 
+
+neo4j_pool = ConnectionPool(Neo4JDataBase.connect,
+                            check=lambda graph: graph.run("RETURN 1"))
+orient_pool = ConnectionPool(OrientDataBase.connect,
+                             check=lambda connection: connection[1].client.db_size())
+arango_pool = ConnectionPool(ArangoDataBase.connect,
+                             check=lambda db: db.properties())
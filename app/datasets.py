@@ -0,0 +1,156 @@
+"""Streaming reader of datasets.
+
+CSV files are read in chunks with explicit types and only the columns used by
+the loaders. Parsed columns are cached as .npz files next to the datasets, so
+repeated experiments do not parse CSV at all. Datasets are read from
+DATASETS_DIR, use_directory() switches to e.g. generated datasets.
+Edges are validated against ids of their nodes by validate_edges().
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+DATASETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datasets')
+CHUNK_SIZE = 10000
+
+# dataset -> (csv file, column -> dtype), columns are yielded in this order
+DATASETS = {
+    'users': ('users.csv', {'id': np.int32, 'username': object, 'password': object}),
+    'books': ('diploma_books_final.csv', {'book_id': np.int32,
+                                          'authors': object,
+                                          'original_publication_year': np.float32,
+                                          'title': object,
+                                          'language_code': object}),
+    'tags': ('tags.csv', {'tag_id': np.int32, 'tag_name': object}),
+    'reads': ('to_read1000.csv', {'user_id': np.int32, 'book_id': np.int32}),
+    'tagged_to': ('tags_to_book.csv', {'book_id': np.int32, 'tag_id': np.int32}),
+    'follows': ('friends.csv', {'user': np.int32, 'friend': np.int32}),
+    'likes': ('likes.csv', {'user_id': np.int32, 'book_id': np.int32}),
+}
+
+# edge dataset -> (dataset of source nodes, dataset of target nodes), ids are first columns
+EDGES = {
+    'reads': ('users', 'books'),
+    'tagged_to': ('books', 'tags'),
+    'follows': ('users', 'users'),
+    'likes': ('users', 'books'),
+}
+# dangling edges listed in summary of validation
+EXAMPLES = 5
+
+
+def use_directory(path):
+    """ Read datasets with the same file names from another directory """
+    global DATASETS_DIR
+    DATASETS_DIR = os.path.abspath(path)
+
+
+def _cache_dir():
+    return os.path.join(DATASETS_DIR, '.cache')
+
+
+def _csv_path(name):
+    return os.path.join(DATASETS_DIR, DATASETS[name][0])
+
+
+def _cache_path(name):
+    return os.path.join(_cache_dir(), name + '.npz')
+
+
+def _cache_is_fresh(name):
+    cache = _cache_path(name)
+    return os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(_csv_path(name))
+
+
+def _load_cache(name):
+    dtypes = DATASETS[name][1]
+    with np.load(_cache_path(name), allow_pickle=True) as cache:
+        return tuple(cache[column] for column in dtypes)
+
+
+def _save_cache(name, chunks):
+    """ Save parsed chunks of dataset as one array per column """
+    dtypes = DATASETS[name][1]
+    if not os.path.isdir(_cache_dir()):
+        os.makedirs(_cache_dir())
+    arrays = {}
+    for position, column in enumerate(dtypes):
+        parts = [chunk[position] for chunk in chunks]
+        arrays[column] = np.concatenate(parts) if parts else np.empty(0, dtypes[column])
+    # written aside and renamed, so an interrupted run leaves no truncated cache behind
+    descriptor, temporary = tempfile.mkstemp(suffix='.npz', dir=_cache_dir())
+    try:
+        with os.fdopen(descriptor, 'wb') as cache:
+            np.savez(cache, **arrays)
+        os.replace(temporary, _cache_path(name))
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def column_batches(name, chunk_size=CHUNK_SIZE):
+    """ Yield tuples of column arrays of dataset with chunk_size rows each """
+    if _cache_is_fresh(name):
+        columns = _load_cache(name)
+        for start in range(0, len(columns[0]), chunk_size):
+            yield tuple(column[start:start + chunk_size] for column in columns)
+        return
+
+    dtypes = DATASETS[name][1]
+    chunks = []
+    for frame in pd.read_csv(_csv_path(name), usecols=list(dtypes), dtype=dtypes,
+                             chunksize=chunk_size):
+        chunk = tuple(frame[column].values for column in dtypes)
+        chunks.append(chunk)
+        yield chunk
+    _save_cache(name, chunks)
+
+
+def rows(name, chunk_size=CHUNK_SIZE):
+    """ Yield rows of dataset as tuples of python values """
+    for chunk in column_batches(name, chunk_size):
+        for row in zip(*[column.tolist() for column in chunk]):
+            yield row
+
+
+def columns(name):
+    """ Return tuple of arrays with all values of every column of dataset """
+    chunks = list(column_batches(name))
+    if not chunks:
+        return tuple(np.empty(0, dtype) for dtype in DATASETS[name][1].values())
+    return tuple(np.concatenate(parts) for parts in zip(*chunks))
+
+
+def validate_edges(name):
+    """ Return (sources, targets, summary) of edges of dataset whose both nodes exist,
+     every edge once in order of its first row. Summary counts rows, edges with
+     missing source or target node, repeated edges and clean edges """
+    sources, targets = columns(name)
+    source_nodes, target_nodes = EDGES[name]
+    missing_source = ~np.isin(sources, columns(source_nodes)[0])
+    missing_target = ~np.isin(targets, columns(target_nodes)[0])
+    dangling = missing_source | missing_target
+    valid = np.flatnonzero(~dangling)
+
+    width = int(targets.max()) + 1 if len(targets) else 1
+    keys = sources[valid].astype(np.int64) * width + targets[valid]
+    _, first = np.unique(keys, return_index=True)
+    clean = valid[np.sort(first)]
+    summary = {'rows': len(sources),
+               'missing_source': int(missing_source.sum()),
+               'missing_target': int(missing_target.sum()),
+               'dangling': int(dangling.sum()),
+               'duplicates': len(valid) - len(clean),
+               'clean': len(clean),
+               'dangling_examples': [(int(sources[row]), int(targets[row]))
+                                     for row in np.flatnonzero(dangling)[:EXAMPLES]]}
+    return sources[clean], targets[clean], summary
+
+
+def edge_rows(name):
+    """ Yield (source id, target id) of validated edges of dataset as python ints """
+    sources, targets, _ = validate_edges(name)
+    for row in zip(sources.tolist(), targets.tolist()):
+        yield row
@@ -0,0 +1,222 @@
+"""Instrumentation of database calls of the models.
+
+Driver methods of every new connection are wrapped by instrument(), each call
+is recorded with its latency and bytes of response under the model method
+which issued it. Model methods of User, Book and Tag become operations by
+instrumented(): the outermost one issuing more than limit queries warns about
+N+1 queries. Calls are collected for the whole process (totals), for scopes
+of the current thread, e.g. a Flask request, and for phases of all threads,
+e.g. an experiment; listeners are called with every recorded call.
+"""
+import threading
+import types
+import warnings
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+# upper bounds of buckets of latency histograms, seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+# queries of one operation above which it warns about N+1 queries
+QUERY_LIMIT = 10
+
+
+class NPlusOneWarning(UserWarning):
+    """ One model method issued more queries than the limit """
+
+
+class QueryStats:
+    """ Query counts, latency histograms and bytes of responses per method """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.methods = {}
+        self._lock = threading.Lock()
+
+    @property
+    def queries(self):
+        with self._lock:
+            return sum(method['queries'] for method in self.methods.values())
+
+    @property
+    def seconds(self):
+        with self._lock:
+            return sum(method['seconds'] for method in self.methods.values())
+
+    @property
+    def bytes(self):
+        with self._lock:
+            return sum(method['bytes'] for method in self.methods.values())
+
+    def record(self, method, seconds, nbytes):
+        with self._lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = {'queries': 0, 'seconds': 0.0, 'bytes': 0,
+                                                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['queries'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+            stats['histogram'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, method, q):
+        """ Return upper bound of latency bucket of q-th percentile of method, None above buckets """
+        histogram = self.methods[method]['histogram']
+        rank = q / 100.0 * sum(histogram)
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        """ Return dict method -> copy of its statistics """
+        with self._lock:
+            return {method: dict(stats, histogram=list(stats['histogram']))
+                    for method, stats in self.methods.items()}
+
+    def report(self, top=5):
+        """ Return lines with totals and methods issuing the most queries """
+        lines = ['%s: %d queries, %.4f s in database, %.1f KB'
+                 % (self.name, self.queries, self.seconds, self.bytes / 1024)]
+        methods = sorted(self.summary().items(), key=lambda item: -item[1]['queries'])
+        for method, stats in methods[:top]:
+            p99 = self.percentile(method, 99)
+            lines.append('  %s: %d queries, %.4f s, p99 <= %s, %.1f KB'
+                         % (method, stats['queries'], stats['seconds'],
+                            '%g s' % p99 if p99 is not None else 'inf', stats['bytes'] / 1024))
+        return lines
+
+
+class Instrumentation:
+    """ Records calls of wrapped driver methods """
+
+    def __init__(self, limit=QUERY_LIMIT):
+        self.enabled = True
+        self.limit = limit
+        self.listeners = []
+        self.totals = QueryStats('process')
+        self._phases = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _state(self):
+        local = self._local
+        if not hasattr(local, 'scopes'):
+            local.scopes = []
+            local.operations = []
+            local.queries = 0
+            local.calling = False
+        return local
+
+    def instrument(self, connection, names, label, size=None):
+        """ Replace methods of connection with wrappers recording their calls,
+         size(result) returns bytes of response """
+        for name in names:
+            func = getattr(connection, name)
+            if not getattr(func, 'instrumented', False):
+                setattr(connection, name, self.wrap(func, '%s.%s' % (label, name), size))
+
+    def wrap(self, func, label, size=None):
+        """ Return func recording its calls, calls made by it are not recorded again """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            local = self._state()
+            if not self.enabled or local.calling:
+                return func(*args, **kwargs)
+            local.calling = True
+            result = None
+            time_start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                local.calling = False
+                self.record(local.operations[-1] if local.operations else label,
+                            perf_counter() - time_start,
+                            size(result) if size is not None and result is not None else 0)
+
+        wrapper.instrumented = True
+        return wrapper
+
+    def record(self, method, seconds, nbytes=0):
+        """ Add call to totals, phases, scopes of current thread and operation """
+        local = self._state()
+        local.queries += 1
+        self.totals.record(method, seconds, nbytes)
+        with self._lock:
+            phases = list(self._phases)
+        for stats in phases + local.scopes:
+            stats.record(method, seconds, nbytes)
+        for listener in self.listeners:
+            listener(method, seconds, nbytes)
+
+    def operation(self, name, func):
+        """ Return func whose calls are operations named name """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            local = self._state()
+            outermost = not local.operations
+            if outermost:
+                local.queries = 0
+            local.operations.append(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                local.operations.pop()
+                if outermost and self.enabled and local.queries > self.limit:
+                    warnings.warn('%s issued %d queries, limit is %d'
+                                  % (name, local.queries, self.limit), NPlusOneWarning, 2)
+        return wrapper
+
+    def begin(self, name, stats=None):
+        """ Start collecting calls of current thread into stats, return them """
+        stats = stats if stats is not None else QueryStats(name)
+        self._state().scopes.append(stats)
+        return stats
+
+    def end(self, stats):
+        """ Stop collecting calls of current thread into stats """
+        scopes = self._state().scopes
+        if stats in scopes:
+            scopes.remove(stats)
+        return stats
+
+    @contextmanager
+    def scope(self, name, stats=None):
+        """ Collect calls of current thread in block """
+        stats = self.begin(name, stats)
+        try:
+            yield stats
+        finally:
+            self.end(stats)
+
+    @contextmanager
+    def phase(self, name, stats=None):
+        """ Collect calls of all threads in block """
+        stats = stats if stats is not None else QueryStats(name)
+        with self._lock:
+            self._phases.append(stats)
+        try:
+            yield stats
+        finally:
+            with self._lock:
+                self._phases.remove(stats)
+
+
+def instrumented(cls):
+    """ Class decorator making public methods of model operations named Class.method """
+    for name, value in list(vars(cls).items()):
+        if name.startswith('_'):
+            continue
+        label = '%s.%s' % (cls.__name__, name)
+        if isinstance(value, (staticmethod, classmethod)):
+            setattr(cls, name, type(value)(instrumentation.operation(label, value.__func__)))
+        elif isinstance(value, types.FunctionType):
+            setattr(cls, name, instrumentation.operation(label, value))
+    return cls
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,496 @@
+"""Implementation of models stored in memory.
+
+Reference backend without database server: nodes are records with __slots__
+numbered by dense integer ids, relationships are kept in compressed sparse
+row (CSR) arrays over these ids.
+"""
+import heapq
+from array import array
+
+import numpy as np
+
+from .cache import TTLCache, cached
+from .passwords import verifier
+from .popularity import reader_counts
+from .recommendations import recommender
+from .similarity import book_similarity
+from .tag_index import tag_index
+from .utils import BATCH_SIZE, batches, ordered
+from .write_behind import WriteBehind
+
+
+class Nodes:
+    """ Records of one label, map from primary key to dense integer id
+     and optional unique indexes of other properties """
+
+    __slots__ = ("records", "index", "unique")
+
+    def __init__(self):
+        self.records = []
+        self.index = {}
+        self.unique = {}  # property -> {value: dense id}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, key, record):
+        """ Store record, node with the same key is replaced """
+        if key in self.index:
+            position = self.index[key]
+            for name, values in self.unique.items():
+                values.pop(getattr(self.records[position], name), None)
+            self.records[position] = record
+        else:
+            position = self.index[key] = len(self.records)
+            self.records.append(record)
+        for name, values in self.unique.items():
+            values[getattr(record, name)] = position
+
+    def keys(self):
+        """ Return array of primary keys of records by dense id """
+        keys = np.empty(len(self.records), dtype=np.int64)
+        keys[list(self.index.values())] = list(self.index.keys())
+        return keys
+
+    def get(self, key):
+        """ Return record by primary key or None """
+        position = self.index.get(key)
+        return None if position is None else self.records[position]
+
+    def find(self, name, value):
+        """ Return record by value of property, through its index if it is created """
+        if name in self.unique:
+            position = self.unique[name].get(value)
+            return None if position is None else self.records[position]
+        for record in self.records:
+            if getattr(record, name) == value:
+                return record
+        return None
+
+    def create_index(self, name):
+        """ Index values of property of all records """
+        self.unique[name] = {getattr(record, name): position
+                             for position, record in enumerate(self.records)}
+
+    def drop_indexes(self):
+        self.unique = {}
+
+    def clear(self):
+        self.records = []
+        self.index = {}
+        for values in self.unique.values():
+            values.clear()
+
+
+class Relation:
+    """ Relationships of one type in CSR format.
+
+    New relationships are appended to flat source/target arrays,
+    offsets and targets sorted by source are rebuilt on the first read after a write.
+    Relationships are unique per (source, target) pair.
+    """
+
+    __slots__ = ("_sources", "_targets", "_pairs", "_offsets", "_neighbours", "_dirty")
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self._sources)
+
+    def add(self, source, target):
+        """ Append relationship unless it exists, return if it was added """
+        if (source, target) in self._pairs:
+            return False
+        self._pairs.add((source, target))
+        self._sources.append(source)
+        self._targets.append(target)
+        self._dirty = True
+        return True
+
+    def _compact(self, size):
+        """ Rebuild CSR arrays for size source nodes """
+        sources = np.frombuffer(self._sources, dtype=np.int64) if self._sources else np.empty(0, np.int64)
+        targets = np.frombuffer(self._targets, dtype=np.int64) if self._targets else np.empty(0, np.int64)
+        order = np.argsort(sources, kind="stable")
+        self._neighbours = targets[order]
+        self._offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self._offsets[1:])
+        self._dirty = False
+
+    def csr(self, size):
+        """ Return (offsets, targets) arrays for size source nodes """
+        if self._dirty or len(self._offsets) != size + 1:
+            self._compact(size)
+        return self._offsets, self._neighbours
+
+    def neighbours(self, source, size):
+        """ Return array of targets of source node """
+        offsets, targets = self.csr(size)
+        return targets[offsets[source]:offsets[source + 1]]
+
+    def in_degrees(self, size):
+        """ Return array with amount of relationships pointing to every target node """
+        targets = np.frombuffer(self._targets, dtype=np.int64) if self._targets else np.empty(0, np.int64)
+        return np.bincount(targets, minlength=size)
+
+    def clear(self):
+        self._sources = array("q")
+        self._targets = array("q")
+        self._pairs = set()
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._neighbours = np.empty(0, dtype=np.int64)
+        self._dirty = False
+
+
+user_nodes = Nodes()
+book_nodes = Nodes()
+tag_nodes = Nodes()
+
+# results of aggregate queries, dropped by writes changing them
+query_cache = TTLCache()
+# records of one page of users_page() and books_page()
+PAGE_SIZE = 100
+
+reads_relation = Relation()
+follows_relation = Relation()
+likes_relation = Relation()
+tagged_to_relation = Relation()
+
+
+class Book:
+    """ Class for Book node """
+
+    __slots__ = ("book_id", "authors", "year", "title", "language")
+
+    def __init__(self, book_id=None, authors=None, year=None, title=None, language=None):
+        self.book_id = book_id
+        self.authors = authors
+        self.year = year
+        self.title = title
+        self.language = language
+
+    def insert(self):
+        """Inserting book node to graph"""
+        book_nodes.add(int(self.book_id), self)
+
+    @staticmethod
+    def insert_many(rows, batch_size=BATCH_SIZE):
+        """ Insert book nodes from dicts of properties """
+        for batch in batches(rows, batch_size):
+            for row in batch:
+                Book(**row).insert()
+
+    def find_by_id(self):
+        return book_nodes.get(int(self.book_id))
+
+    @staticmethod
+    def find_many(ids):
+        """ Return (books in order of ids, ids without book) """
+        return _find_many(book_nodes, ids)
+
+    def linked_tags(self):
+        """Return list of tags for specific book"""
+        return tag_index.tag_names(self.book_id)
+
+    def similar_books(self, k=10):
+        """ Return ids of k books with the most similar tags """
+        return book_similarity.similar(self.book_id, k)
+
+    def link_to_tag(self, tag_id):
+        """ Create relationship (Book)-[:TAGGED_TO]->(Tag) """
+        if _link(tagged_to_relation, book_nodes, self.book_id, tag_nodes, tag_id):
+            _tag_book(self.book_id, tag_id)
+
+    @staticmethod
+    def link_to_tag_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (Book)-[:TAGGED_TO]->(Tag) from (book_id, tag_id) pairs """
+        _link_many(tagged_to_relation, book_nodes, tag_nodes, pairs, batch_size, _tag_book)
+        tag_index.compact()
+
+    @staticmethod
+    def books(fetch_size=None):
+        """ Yield properties of all books """
+        return (_book_properties(book) for book in book_nodes.records)
+
+    @staticmethod
+    def books_page(after=None, limit=PAGE_SIZE):
+        """ Return properties of at most limit books with book_id greater than after """
+        return [_book_properties(book) for book in _page(book_nodes, after, limit)]
+
+    @staticmethod
+    @cached(query_cache, "most_popular_books")
+    def most_popular_books():
+        """ Return books which are read by most amount of users """
+        readers = reads_relation.in_degrees(len(book_nodes))
+        top = np.argsort(-readers, kind="stable")[:16]
+        return [book_nodes.records[book] for book in top if readers[book]]
+
+    @staticmethod
+    def most_popular_book_ids(n=16):
+        """ Return ids of the most read books from reader counts kept in memory """
+        return reader_counts.top(n)
+
+
+class User:
+    """ Class for User node """
+
+    __slots__ = ("user_id", "username", "password")
+
+    def __init__(self, user_id=None, username=None, password=None):
+        self.user_id = user_id
+        self.username = username
+        self.password = password
+
+    def find(self):
+        """ Return user by username """
+        return user_nodes.find("username", self.username)
+
+    def find_by_id(self):
+        return user_nodes.get(int(self.user_id))
+
+    @staticmethod
+    def find_many(ids):
+        """ Return (users in order of ids, ids without user) """
+        return _find_many(user_nodes, ids)
+
+    def insert(self):
+        """ Insert user node to graph """
+        user_nodes.add(int(self.user_id), self)
+
+    @staticmethod
+    def insert_many(rows, batch_size=BATCH_SIZE):
+        """ Insert user nodes from dicts of properties """
+        for batch in batches(rows, batch_size):
+            for row in batch:
+                User(**row).insert()
+
+    def verify_password(self, password):
+        """ Return if password matches hash stored in the user found by username,
+         hash is checked in the pool of password verifier """
+        user = self.find()
+        if not user:
+            return False
+        return verifier.verify(password, user.password)
+
+    def login(self, password):
+        """ Return session token of user id if password is valid, else None """
+        user = self.find()
+        if not user:
+            return None
+        return verifier.login(user.user_id, password, user.password)
+
+    def reads(self, book_id):
+        """ Create relationship (User)-[:READS]->(Book) """
+        if write_behind.enabled:
+            write_behind.add("reads", self.user_id, book_id)
+            return
+        if _link(reads_relation, user_nodes, self.user_id, book_nodes, book_id):
+            _count_reader(self.user_id, book_id)
+
+    def follows(self, friend_id):
+        """ Create relationship (User)-[:FOLLOWS]->(User) """
+        if write_behind.enabled:
+            write_behind.add("follows", self.user_id, friend_id)
+            return
+        if _link(follows_relation, user_nodes, self.user_id, user_nodes, friend_id):
+            recommender.add_follow(self.user_id, friend_id)
+
+    def likes(self, book_id):
+        """ Create relationship (User)-[:LIKES]->(Book) """
+        if write_behind.enabled:
+            write_behind.add("likes", self.user_id, book_id)
+            return
+        if _link(likes_relation, user_nodes, self.user_id, book_nodes, book_id):
+            recommender.add_like(self.user_id, book_id)
+
+    @staticmethod
+    def reads_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:READS]->(Book) from (user_id, book_id) pairs """
+        _link_many(reads_relation, user_nodes, book_nodes, pairs, batch_size, _count_reader)
+
+    @staticmethod
+    def follows_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:FOLLOWS]->(User) from (user_id, friend_id) pairs """
+        _link_many(follows_relation, user_nodes, user_nodes, pairs, batch_size,
+                   recommender.add_follow)
+        recommender.compact()
+
+    @staticmethod
+    def likes_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:LIKES]->(Book) from (user_id, book_id) pairs """
+        _link_many(likes_relation, user_nodes, book_nodes, pairs, batch_size,
+                   recommender.add_like)
+        recommender.compact()
+
+    def recommended_books(self, k=10):
+        """ Return ids of books liked by followed users, precomputed in memory """
+        write_behind.flush(self.user_id)
+        return recommender.recommend(self.user_id, k)
+
+    def recommended_books_query(self, k=10):
+        """ Return ids of books liked by followed users, traversing CSR arrays """
+        write_behind.flush(self.user_id)
+        user = user_nodes.index.get(int(self.user_id))
+        if user is None:
+            return []
+        friends = follows_relation.neighbours(user, len(user_nodes))
+        offsets, books = likes_relation.csr(len(user_nodes))
+        liked = np.concatenate([books[offsets[friend]:offsets[friend + 1]] for friend in friends]) \
+            if len(friends) else books[:0]
+        scores = np.bincount(liked, minlength=len(book_nodes))
+        scores[likes_relation.neighbours(user, len(user_nodes))] = 0
+        top = np.lexsort((np.arange(len(scores)), -scores))[:k]
+        return [book_nodes.records[book].book_id for book in top if scores[book]]
+
+    @staticmethod
+    def users(fetch_size=None):
+        """ Yield usernames of all users """
+        return (user.username for user in user_nodes.records)
+
+    @staticmethod
+    def users_page(after=None, limit=PAGE_SIZE):
+        """ Return user_id and username of at most limit users with user_id greater than after """
+        return [{"user_id": user.user_id, "username": user.username}
+                for user in _page(user_nodes, after, limit)]
+
+    @staticmethod
+    def export_page(after=None, limit=PAGE_SIZE):
+        """ Return all properties, password hash included, of at most limit users
+         with user_id greater than after """
+        return [{"user_id": user.user_id, "username": user.username, "password": user.password}
+                for user in _page(user_nodes, after, limit)]
+
+
+class Tag:
+    """ Class for Tag node """
+
+    __slots__ = ("tag_id", "tag_name")
+
+    def __init__(self, tag_id=None, tag_name=None):
+        self.tag_id = tag_id
+        self.tag_name = tag_name
+
+    def insert(self):
+        """ Insert tag to graph"""
+        tag_nodes.add(int(self.tag_id), self)
+        tag_index.name(self.tag_id, self.tag_name)
+
+    @staticmethod
+    def insert_many(rows, batch_size=BATCH_SIZE):
+        """ Insert tag nodes from dicts of properties """
+        for batch in batches(rows, batch_size):
+            for row in batch:
+                Tag(**row).insert()
+
+    def find_by_id(self):
+        return tag_nodes.get(int(self.tag_id))
+
+    @staticmethod
+    def find_many(ids):
+        """ Return (tags in order of ids, ids without tag) """
+        return _find_many(tag_nodes, ids)
+
+    @staticmethod
+    def tags_page(after=None, limit=PAGE_SIZE):
+        """ Return tag_id and tag_name of at most limit tags with tag_id greater than after """
+        return [{"tag_id": tag.tag_id, "tag_name": tag.tag_name}
+                for tag in _page(tag_nodes, after, limit)]
+
+    def books(self):
+        """ Return ids of books tagged with tag from in-process tag index """
+        return tag_index.books(self.tag_id).tolist()
+
+    @staticmethod
+    def books_with_tags(tag_ids):
+        """ Return ids of books tagged with all of tags from in-process tag index """
+        return tag_index.books(*tag_ids).tolist()
+
+
+# relationships created by requests, buffered and written in batches once started
+write_behind = WriteBehind({"reads": User.reads_many,
+                           "follows": User.follows_many,
+                           "likes": User.likes_many})
+
+# relationship -> (source nodes, relation, target nodes), streamed by relationships()
+RELATIONSHIPS = {
+    "reads": (user_nodes, reads_relation, book_nodes),
+    "follows": (user_nodes, follows_relation, user_nodes),
+    "likes": (user_nodes, likes_relation, book_nodes),
+    "tagged_to": (book_nodes, tagged_to_relation, tag_nodes),
+}
+
+
+def relationships(relationship, fetch_size=None):
+    """ Yield (from_id, to_id) pairs of all relationships """
+    from_nodes, relation, to_nodes = RELATIONSHIPS[relationship]
+    offsets, targets = relation.csr(len(from_nodes))
+    sources = np.repeat(from_nodes.keys(), np.diff(offsets))
+    return zip(sources.tolist(), to_nodes.keys()[targets].tolist())
+
+
+def _page(nodes, after, limit):
+    """ Return at most limit records with the smallest keys greater than after """
+    keys = heapq.nsmallest(limit, (key for key in nodes.index if after is None or key > after))
+    return [nodes.get(key) for key in keys]
+
+
+def _book_properties(book):
+    return {"book_id": book.book_id, "title": book.title, "authors": book.authors,
+            "year": book.year, "language": book.language}
+
+
+def _find_many(nodes, ids):
+    """ Return (records in order of ids, ids without record) """
+    ids = [int(key) for key in ids]
+    return ordered(ids, {key: nodes.get(key) for key in ids if key in nodes.index})
+
+
+def _count_reader(_, book_id):
+    """ Count reader of book, cached most popular books are dropped if the top changed """
+    if reader_counts.add(int(book_id)):
+        query_cache.discard("most_popular_books")
+
+
+def _tag_book(book_id, tag_id):
+    """ Register new tag of book in tag index and similar books """
+    tag_index.add(book_id, tag_id)
+    book_similarity.add(book_id, tag_id)
+
+
+def _link(relation, from_nodes, from_id, to_nodes, to_id):
+    """ Create relationship if both nodes exist and it does not, return if it was created """
+    source = from_nodes.index.get(int(from_id))
+    target = to_nodes.index.get(int(to_id))
+    return source is not None and target is not None and relation.add(source, target)
+
+
+def _link_many(relation, from_nodes, to_nodes, pairs, batch_size, created=None):
+    """ Create relationships from (from_id, to_id) pairs, pairs with missing nodes and
+     existing relationships are skipped; created(from_id, to_id) is called for new ones """
+    for batch in batches(pairs, batch_size):
+        for from_id, to_id in batch:
+            if _link(relation, from_nodes, from_id, to_nodes, to_id) and created is not None:
+                created(from_id, to_id)
+
+
+def create_schema(indexes=True):
+    """ Create unique index of usernames or drop it if indexes is False,
+     nodes are always stored by their ids """
+    user_nodes.drop_indexes()
+    if indexes:
+        user_nodes.create_index("username")
+
+
+def clear_graph():
+    """ Clear all nodes and relationships """
+    write_behind.clear()
+    for nodes in (user_nodes, book_nodes, tag_nodes):
+        nodes.clear()
+    for relation in (reads_relation, follows_relation, likes_relation, tagged_to_relation):
+        relation.clear()
+    recommender.clear()
+    query_cache.clear()
+    reader_counts.clear()
+    tag_index.clear()
+    book_similarity.clear()
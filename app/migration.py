@@ -0,0 +1,102 @@
+"""Streaming migration of the graph between backends.
+
+Nodes are read from models of the source backend page by page with keyset
+pagination and relationships with relationships(), and flow through
+generators into insert_many and *_many methods of the target backend, which
+write them batch by batch. Only one page and one batch are held in memory
+whatever the size of the graph: bulk writes of database targets do not
+update in-process indexes meanwhile, processes serving the target build
+them from the database, datasets or a snapshot. Inserts of the models are
+idempotent, so an interrupted migration is simply started again. Progress
+is reported every PROGRESS_INTERVAL seconds, at the end records of the
+target are counted and compared with migrated ones.
+"""
+from operator import itemgetter
+from time import perf_counter
+
+from .utils import BATCH_SIZE, index_updates, keyset_pages
+
+# records fetched from the source per query
+PAGE_SIZE = 1000
+# seconds between reports of progress
+PROGRESS_INTERVAL = 5.0
+# nodes -> (User, Book or Tag, method returning page of properties, id property)
+NODES = {
+    'users': ('User', 'export_page', 'user_id'),
+    'books': ('Book', 'books_page', 'book_id'),
+    'tags': ('Tag', 'tags_page', 'tag_id'),
+}
+# relationship -> (model, method creating relationships from (from_id, to_id) pairs)
+RELATIONSHIPS = {
+    'reads': ('User', 'reads_many'),
+    'follows': ('User', 'follows_many'),
+    'likes': ('User', 'likes_many'),
+    'tagged_to': ('Book', 'link_to_tag_many'),
+}
+
+
+class Progress:
+    """ Records passed through every step of migration and their rate """
+
+    def __init__(self, report=print, interval=PROGRESS_INTERVAL):
+        self.report = report
+        self.interval = interval
+        self.counts = {}
+        self.seconds = {}
+
+    def counted(self, name, records):
+        """ Yield records counting them under name, reporting progress every interval seconds """
+        self.counts[name] = 0
+        time_start = last_report = perf_counter()
+        for record in records:
+            self.counts[name] += 1
+            yield record
+            now = perf_counter()
+            if now - last_report >= self.interval:
+                last_report = now
+                self.report('%s: %d records, %.1f records/s'
+                            % (name, self.counts[name], self.counts[name] / (now - time_start)))
+        self.seconds[name] = perf_counter() - time_start
+
+    def summary(self, name):
+        seconds = self.seconds.get(name, 0.0)
+        return ('%s: %d records in %.2f s, %.1f records/s'
+                % (name, self.counts[name], seconds, self.counts[name] / seconds if seconds else 0.0))
+
+
+def nodes(models, name, page_size=PAGE_SIZE):
+    """ Yield dicts of properties of all nodes, page_size per query """
+    model, method, id_property = NODES[name]
+    return keyset_pages(getattr(getattr(models, model), method), itemgetter(id_property),
+                        page_size=page_size)
+
+
+def migrate(source, target, page_size=PAGE_SIZE, batch_size=BATCH_SIZE, progress=None):
+    """ Copy nodes and then relationships from source models module into target one,
+     return dict name -> amount of records read from the source """
+    progress = progress or Progress()
+    with index_updates.paused():
+        for name in NODES:
+            model = getattr(target, NODES[name][0])
+            model.insert_many(progress.counted(name, nodes(source, name, page_size)), batch_size)
+            progress.report(progress.summary(name))
+        for name, (model, method) in RELATIONSHIPS.items():
+            pairs = source.relationships(name, page_size)
+            getattr(getattr(target, model), method)(progress.counted(name, pairs), batch_size)
+            progress.report(progress.summary(name))
+    return dict(progress.counts)
+
+
+def count(models, page_size=PAGE_SIZE):
+    """ Return dict name -> amount of nodes or relationships stored by models """
+    counts = {name: sum(1 for _ in nodes(models, name, page_size)) for name in NODES}
+    counts.update((name, sum(1 for _ in models.relationships(name, page_size)))
+                  for name in RELATIONSHIPS)
+    return counts
+
+
+def verify(migrated, target, page_size=PAGE_SIZE):
+    """ Return dict name -> (migrated, stored in target) of records whose amounts differ """
+    stored = count(target, page_size)
+    return {name: (migrated[name], stored[name]) for name in migrated
+            if migrated[name] != stored[name]}
@@ -1,13 +1,46 @@
 """Implementation of models for Neo4J"""
-from passlib.hash import sha256_crypt
-from py2neo import Relationship
-from py2neo.ogm import GraphObject, Property, RelatedTo, RelatedFrom
-
-from app.databases import Neo4JDataBase
-
-graph = Neo4JDataBase.connect()
+from functools import partial
+from operator import itemgetter
 
+from py2neo.ogm import GraphObject, Property, RelatedTo, RelatedFrom
 
+from app.cache import LRUCache, TTLCache, cached
+from app.databases import neo4j_pool
+from app.instrumentation import instrumentation, instrumented
+from app.passwords import verifier
+from app.pool import LazyConnection
+from app.popularity import reader_counts
+from app.recommendations import recommender
+from app.similarity import book_similarity
+from app.tag_index import tag_index
+from app.utils import BATCH_SIZE, batches, index_updates, keyset_pages, ordered
+from app.write_behind import WriteBehind
+
+# connection of current thread, opened on first query
+graph = LazyConnection(neo4j_pool)
+
+# (label, id) -> bound node, shared by all relationship inserts
+vertex_cache = LRUCache()
+# results of aggregate queries, dropped by writes changing them
+query_cache = TTLCache()
+
+# label -> properties with uniqueness constraint, created by create_schema()
+UNIQUE_PROPERTIES = {
+    "User": ("user_id", "username"),
+    "Book": ("book_id",),
+    "Tag": ("tag_id",),
+}
+
+# methods of py2neo Graph sending queries, recorded by instrumentation
+NEO4J_CALLS = ("run", "evaluate", "create", "merge", "push", "pull", "delete", "delete_all")
+
+# records fetched per round trip by users() and books()
+FETCH_SIZE = 1000
+# records of one page of users_page() and books_page()
+PAGE_SIZE = 100
+
+
+@instrumented
 class Book(GraphObject):
     """ Class for Book node """
 
@@ -32,43 +65,97 @@ class Book(GraphObject):
         self.language = language
 
     def insert(self):
-        """Inserting book node to graph"""
-        graph.push(self)
+        """ Insert book node to graph, existing book with the same book_id is updated """
+        graph.merge(self)
+        vertex_cache.put(("Book", int(self.book_id)), self)
+
+    @staticmethod
+    def insert_many(books, batch_size=BATCH_SIZE):
+        """ Upsert book nodes to graph with one UNWIND query per batch """
+        query = """
+                UNWIND $rows AS row
+                MERGE (book:Book {book_id: row.book_id})
+                SET book = row
+                """
+        for batch in batches(books, batch_size):
+            graph.run(query, rows=batch)
 
     def find_by_id(self):
         book = Book.match(graph, self.book_id).first()
         return book
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (books in order of ids, ids without book) fetched by one query """
+        return _find_many(Book, ids)
+
     def linked_tags(self):
-        """Return list of tags for specific book"""
-        book = Book.match(graph, self.book_id).first()
-        tags = [tag.tag_name for tag in book.tags]
-        return tags
+        """Return list of tags for specific book, from tag index if it is complete"""
+        if tag_index.complete:
+            return tag_index.tag_names(self.book_id)
+        query = """
+                MATCH (:Book {book_id: $book_id})-[:TAGGED_TO]->(tag:Tag)
+                RETURN tag.tag_name AS tag_name
+                """
+        return [row["tag_name"] for row in graph.run(query, book_id=int(self.book_id)).data()]
+
+    def similar_books(self, k=10):
+        """ Return ids of k books with the most similar tags """
+        return book_similarity.similar(self.book_id, k)
 
     def link_to_tag(self, tag_id):
         """ Create relationship (Book)-[:TAGGED_TO]->(Tag) """
-        tag = Tag.match(graph, int(tag_id)).first()
-        graph.create(Relationship(self.__node__, "TAGGED_TO", tag.__node__))
+        if _relate(_vertex(Book, self.book_id), "TAGGED_TO", _vertex(Tag, tag_id)):
+            _tag_book(self.book_id, tag_id)
+
+    @staticmethod
+    def link_to_tag_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (Book)-[:TAGGED_TO]->(Tag) from (book_id, tag_id) pairs """
+        query = """
+                UNWIND $rows AS row
+                MATCH (book:Book {book_id: row[0]}), (tag:Tag {tag_id: row[1]})
+                WHERE NOT (book)-[:TAGGED_TO]->(tag)
+                CREATE (book)-[:TAGGED_TO]->(tag)
+                RETURN row[0] AS from_id, row[1] AS to_id
+                """
+        _create_relationships(query, pairs, batch_size, _tag_book)
+        tag_index.compact()
 
     @staticmethod
-    def books():
-        """ Return list of all books """
-        books = graph.run("MATCH (b:Book) RETURN b.username").data()
-        return books
+    def books(fetch_size=None):
+        """ Yield properties of all books, fetching fetch_size books per query """
+        return keyset_pages(Book.books_page, itemgetter("book_id"), page_size=fetch_size or FETCH_SIZE)
 
     @staticmethod
+    def books_page(after=None, limit=PAGE_SIZE):
+        """ Return properties of at most limit books with book_id greater than after """
+        query = """
+                MATCH (book:Book) %s
+                RETURN book.book_id AS book_id, book.title AS title, book.authors AS authors,
+                       book.year AS year, book.language AS language
+                ORDER BY book.book_id LIMIT $limit
+                """ % ("" if after is None else "WHERE book.book_id > $after")
+        return graph.run(query, after=after, limit=limit).data()
+
+    @staticmethod
+    @cached(query_cache, "most_popular_books")
     def most_popular_books():
         """ Return books which are read by most amount of users """
         query = """
                 MATCH (book:Book)<-[reads:READS]-(u:User)
                 WITH book, count(reads) AS readers
-                RETURN book 
-                ORDER BY readers  LIMIT 16
+                RETURN book
+                ORDER BY readers DESC LIMIT 16
                 """
-        # TODO use run instead of cypher
-        return graph.cypher.execute(query)
+        return graph.run(query).data()
+
+    @staticmethod
+    def most_popular_book_ids(n=16):
+        """ Return ids of the most read books from reader counts kept in memory """
+        return reader_counts.top(n)
 
 
+@instrumented
 class User(GraphObject):
     """ Class for User node """
 
@@ -91,43 +178,159 @@ class User(GraphObject):
 
     def find(self):
         """ Return user in database by username """
-        user = User.match(graph, self.username).first()
+        user = User.match(graph).where(username=self.username).first()
+        return user
+
+    def find_by_id(self):
+        user = User.match(graph, self.user_id).first()
         return user
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (users in order of ids, ids without user) fetched by one query """
+        return _find_many(User, ids)
+
     def insert(self):
-        """ Insert user node to graph """
+        """ Insert user node to graph, existing user with the same user_id is updated """
         # TODO password encryption in routes
-        #if not self.find():
-        graph.push(self)
+        graph.merge(self)
+        vertex_cache.put(("User", int(self.user_id)), self)
+
+    @staticmethod
+    def insert_many(users, batch_size=BATCH_SIZE):
+        """ Upsert user nodes to graph with one UNWIND query per batch """
+        query = """
+                UNWIND $rows AS row
+                MERGE (user:User {user_id: row.user_id})
+                SET user = row
+                """
+        for batch in batches(users, batch_size):
+            graph.run(query, rows=batch)
 
     def verify_password(self, password):
-        """ Return if password is valid """
+        """ Return if password matches hash stored in the user found by username,
+         hash is checked in the pool of password verifier """
         user = self.find()
         if not user:
             return False
-        return sha256_crypt.verify(password, self.password)
+        return verifier.verify(password, user.password)
+
+    def login(self, password):
+        """ Return session token of user id if password is valid, else None """
+        user = self.find()
+        if not user:
+            return None
+        return verifier.login(user.user_id, password, user.password)
 
     def reads(self, book_id):
         """ Create relationship (User)-[:READS]->(Book) """
-        book = Book.match(graph, int(book_id)).first()
-        graph.create(Relationship(self.__node__, "READS", book.__node__))
+        if write_behind.enabled:
+            write_behind.add("reads", self.user_id, book_id)
+            return
+        if _relate(_vertex(User, self.user_id), "READS", _vertex(Book, book_id)):
+            _count_reader(self.user_id, book_id)
 
     def follows(self, friend_id):
         """ Create relationship (User)-[:FOLLOWS]->(User) """
-        friend = User.match(graph, int(friend_id)).first()
-        graph.create(Relationship(self.__node__, "FOLLOWS", friend.__node__))
+        if write_behind.enabled:
+            write_behind.add("follows", self.user_id, friend_id)
+            return
+        if _relate(_vertex(User, self.user_id), "FOLLOWS", _vertex(User, friend_id)):
+            recommender.add_follow(self.user_id, friend_id)
 
     def likes(self, book_id):
         """ Create relationship (User)-[:LIKES]->(Book) """
-        book = Book.match(graph, int(book_id)).first()
-        graph.create(Relationship(self.__node__, "LIKES", book.__node__))
+        if write_behind.enabled:
+            write_behind.add("likes", self.user_id, book_id)
+            return
+        if _relate(_vertex(User, self.user_id), "LIKES", _vertex(Book, book_id)):
+            recommender.add_like(self.user_id, book_id)
 
     @staticmethod
-    def users():
-        """ Return list of all users """
-        return graph.run("MATCH (u:User) RETURN u.username").data()
+    def reads_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:READS]->(Book) from (user_id, book_id) pairs """
+        query = """
+                UNWIND $rows AS row
+                MATCH (user:User {user_id: row[0]}), (book:Book {book_id: row[1]})
+                WHERE NOT (user)-[:READS]->(book)
+                CREATE (user)-[:READS]->(book)
+                RETURN row[0] AS from_id, row[1] AS to_id
+                """
+        _create_relationships(query, pairs, batch_size, _count_reader)
 
+    @staticmethod
+    def follows_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:FOLLOWS]->(User) from (user_id, friend_id) pairs """
+        query = """
+                UNWIND $rows AS row
+                MATCH (user:User {user_id: row[0]}), (friend:User {user_id: row[1]})
+                WHERE NOT (user)-[:FOLLOWS]->(friend)
+                CREATE (user)-[:FOLLOWS]->(friend)
+                RETURN row[0] AS from_id, row[1] AS to_id
+                """
+        _create_relationships(query, pairs, batch_size, recommender.add_follow)
+        recommender.compact()
+
+    @staticmethod
+    def likes_many(pairs, batch_size=BATCH_SIZE):
+        """ Create relationships (User)-[:LIKES]->(Book) from (user_id, book_id) pairs """
+        query = """
+                UNWIND $rows AS row
+                MATCH (user:User {user_id: row[0]}), (book:Book {book_id: row[1]})
+                WHERE NOT (user)-[:LIKES]->(book)
+                CREATE (user)-[:LIKES]->(book)
+                RETURN row[0] AS from_id, row[1] AS to_id
+                """
+        _create_relationships(query, pairs, batch_size, recommender.add_like)
+        recommender.compact()
 
+    def recommended_books(self, k=10):
+        """ Return ids of books liked by followed users, precomputed in memory """
+        write_behind.flush(self.user_id)
+        return recommender.recommend(self.user_id, k)
+
+    def recommended_books_query(self, k=10):
+        """ Return ids of books liked by followed users, computed by database """
+        write_behind.flush(self.user_id)
+        query = """
+                MATCH (user:User {user_id: $user_id})-[:FOLLOWS]->(:User)-[:LIKES]->(book:Book)
+                WHERE NOT (user)-[:LIKES]->(book)
+                RETURN book.book_id AS book_id, count(*) AS score
+                ORDER BY score DESC, book_id LIMIT $k
+                """
+        return [row["book_id"] for row in graph.run(query, user_id=int(self.user_id), k=k).data()]
+
+    @staticmethod
+    def users(fetch_size=None):
+        """ Yield usernames of all users, fetching fetch_size users per query """
+        users = keyset_pages(User.users_page, itemgetter("user_id"),
+                             page_size=fetch_size or FETCH_SIZE)
+        return (user["username"] for user in users)
+
+    @staticmethod
+    def users_page(after=None, limit=PAGE_SIZE):
+        """ Return user_id and username of at most limit users with user_id greater than after """
+        query = """
+                MATCH (user:User) %s
+                RETURN user.user_id AS user_id, user.username AS username
+                ORDER BY user.user_id LIMIT $limit
+                """ % ("" if after is None else "WHERE user.user_id > $after")
+        return graph.run(query, after=after, limit=limit).data()
+
+    @staticmethod
+    def export_page(after=None, limit=PAGE_SIZE):
+        """ Return all properties, password hash included, of at most limit users
+         with user_id greater than after """
+        query = """
+                MATCH (user:User) %s
+                RETURN user.user_id AS user_id, user.username AS username,
+                       user.password AS password
+                ORDER BY user.user_id LIMIT $limit
+                """ % ("" if after is None else "WHERE user.user_id > $after")
+        return graph.run(query, after=after, limit=limit).data()
+
+
+@instrumented
 class Tag(GraphObject):
     """ Class for Tag node """
 
@@ -136,17 +339,193 @@ class Tag(GraphObject):
     tag_id = Property()
     tag_name = Property()
 
-    books = RelatedFrom("Book", "TAGGED_TO")
+    tagged_books = RelatedFrom("Book", "TAGGED_TO")
 
     def __init__(self, tag_id, tag_name=None):
         self.tag_id = tag_id
         self.tag_name = tag_name
 
     def insert(self):
-        """ Insert tag to graph"""
-        graph.push(self)
+        """ Insert tag to graph, existing tag with the same tag_id is updated """
+        graph.merge(self)
+        vertex_cache.put(("Tag", int(self.tag_id)), self)
+        tag_index.name(self.tag_id, self.tag_name)
+
+    @staticmethod
+    def insert_many(tags, batch_size=BATCH_SIZE):
+        """ Upsert tag nodes to graph with one UNWIND query per batch """
+        query = """
+                UNWIND $rows AS row
+                MERGE (tag:Tag {tag_id: row.tag_id})
+                SET tag = row
+                """
+        if index_updates.enabled:
+            tags = tag_index.name_rows(tags)
+        for batch in batches(tags, batch_size):
+            graph.run(query, rows=batch)
+
+    def find_by_id(self):
+        tag = Tag.match(graph, self.tag_id).first()
+        return tag
+
+    @staticmethod
+    def find_many(ids):
+        """ Return (tags in order of ids, ids without tag) fetched by one query """
+        return _find_many(Tag, ids)
+
+    @staticmethod
+    def tags_page(after=None, limit=PAGE_SIZE):
+        """ Return tag_id and tag_name of at most limit tags with tag_id greater than after """
+        query = """
+                MATCH (tag:Tag) %s
+                RETURN tag.tag_id AS tag_id, tag.tag_name AS tag_name
+                ORDER BY tag.tag_id LIMIT $limit
+                """ % ("" if after is None else "WHERE tag.tag_id > $after")
+        return graph.run(query, after=after, limit=limit).data()
+
+    def books(self):
+        """ Return ids of books tagged with tag, from tag index if it is complete """
+        return Tag.books_with_tags([self.tag_id])
+
+    @staticmethod
+    def books_with_tags(tag_ids):
+        """ Return sorted ids of books tagged with all of tags, from tag index if it is complete """
+        if tag_index.complete:
+            return tag_index.books(*tag_ids).tolist()
+        tag_ids = sorted({int(tag_id) for tag_id in tag_ids})
+        if not tag_ids:
+            return []
+        query = """
+                MATCH (book:Book)-[:TAGGED_TO]->(tag:Tag)
+                WHERE tag.tag_id IN $tag_ids
+                WITH book, count(DISTINCT tag) AS tags
+                WHERE tags = size($tag_ids)
+                RETURN book.book_id AS book_id ORDER BY book_id
+                """
+        return [row["book_id"] for row in graph.run(query, tag_ids=tag_ids).data()]
+
+
+# relationships created by requests, buffered and written in batches once started
+write_behind = WriteBehind({"reads": User.reads_many,
+                           "follows": User.follows_many,
+                           "likes": User.likes_many})
+
+# relationship -> (source model, type, target model), streamed by relationships()
+RELATIONSHIPS = {
+    "reads": (User, "READS", Book),
+    "follows": (User, "FOLLOWS", User),
+    "likes": (User, "LIKES", Book),
+    "tagged_to": (Book, "TAGGED_TO", Tag),
+}
+
+
+def relationships(relationship, fetch_size=None):
+    """ Yield (from_id, to_id) pairs of all relationships, with relationships
+     of fetch_size source nodes per query """
+    sources = keyset_pages(partial(relationships_page, relationship), itemgetter("from_id"),
+                           page_size=fetch_size or FETCH_SIZE)
+    return ((source["from_id"], to_id) for source in sources for to_id in source["to_ids"])
+
+
+def relationships_page(relationship, after=None, limit=PAGE_SIZE):
+    """ Return from_id and sorted to_ids of relationships of at most limit source
+     nodes with id greater than after. Source nodes are read in order of their
+     unique id from its index, every page costs only its own relationships """
+    source, relationship_type, target = RELATIONSHIPS[relationship]
+    query = """
+            MATCH (source:%s) WHERE source.%s %s
+            WITH source ORDER BY source.%s LIMIT $limit
+            OPTIONAL MATCH (source)-[:%s]->(target:%s)
+            WITH source, target ORDER BY target.%s
+            RETURN source.%s AS from_id, collect(target.%s) AS to_ids
+            ORDER BY from_id
+            """ % (source.__primarylabel__, source.__primarykey__,
+                   "IS NOT NULL" if after is None else "> $after", source.__primarykey__,
+                   relationship_type, target.__primarylabel__, target.__primarykey__,
+                   source.__primarykey__, target.__primarykey__)
+    return graph.run(query, after=after, limit=limit).data()
+
+
+def _vertex(model, primary_key):
+    """ Return node of model by primary key, looking into vertex_cache first """
+    primary_key = int(primary_key)
+    return vertex_cache.resolve((model.__name__, primary_key),
+                                lambda: model.match(graph, primary_key).first())
+
+
+def _relate(source, relationship_type, target):
+    """ Create relationship between nodes unless it exists, return if it was created """
+    if source is None or target is None:
+        return False
+    query = """
+            MATCH (source), (target) WHERE id(source) = $source AND id(target) = $target
+            AND NOT (source)-[:%s]->(target)
+            CREATE (source)-[:%s]->(target)
+            RETURN count(*) AS created
+            """ % (relationship_type, relationship_type)
+    return bool(graph.evaluate(query, source=source.__node__.identity,
+                               target=target.__node__.identity))
+
+
+def _find_many(model, ids):
+    """ Return (nodes of model in order of ids, ids without node) fetched by one query """
+    ids = [int(primary_key) for primary_key in ids]
+    query = "MATCH (node:%s) WHERE node.%s IN $ids RETURN node" \
+            % (model.__primarylabel__, model.__primarykey__)
+    nodes = (model.wrap(record["node"]) for record in graph.run(query, ids=ids))
+    return ordered(ids, {getattr(node, model.__primarykey__): node for node in nodes})
+
+
+def _count_reader(_, book_id):
+    """ Count reader of book, cached most popular books are dropped if the top changed """
+    if reader_counts.add(int(book_id)):
+        query_cache.discard("most_popular_books")
+
+
+def _tag_book(book_id, tag_id):
+    """ Register new tag of book in tag index and similar books """
+    tag_index.add(book_id, tag_id)
+    book_similarity.add(book_id, tag_id)
+
+
+def _create_relationships(query, pairs, batch_size, created=None):
+    """ Run UNWIND query for every batch of distinct (from_id, to_id) pairs, every batch
+     is committed as one transaction. Query creates only missing relationships between
+     existing nodes and returns them, created(from_id, to_id) is called for each """
+    for batch in batches(pairs, batch_size):
+        rows = list(dict.fromkeys((int(from_id), int(to_id)) for from_id, to_id in batch))
+        for record in graph.run(query, rows=[list(row) for row in rows]):
+            if created is not None and index_updates.enabled:
+                created(record["from_id"], record["to_id"])
+
+
+def create_schema(indexes=True):
+    """ Create uniqueness constraints, which are backed by indexes, or drop them
+     if indexes is False. Relationships are found from their nodes without indexes """
+    for label, keys in UNIQUE_PROPERTIES.items():
+        existing = graph.schema.get_uniqueness_constraints(label)
+        for key in keys:
+            if indexes and key not in existing:
+                graph.schema.create_uniqueness_constraint(label, key)
+            elif not indexes and key in existing:
+                graph.schema.drop_uniqueness_constraint(label, key)
 
 
 def clear_graph():
     """ Clear all nodes and relationships """
+    write_behind.clear()
     graph.delete_all()
+    vertex_cache.clear()
+    recommender.clear()
+    query_cache.clear()
+    reader_counts.clear()
+    tag_index.clear()
+    book_similarity.clear()
+
+
+def _instrument(connection):
+    """ Record queries of new connection, sizes of py2neo cursors are not known """
+    instrumentation.instrument(connection, NEO4J_CALLS, "neo4j")
+
+
+neo4j_pool.on_connect.append(_instrument)
@@ -1,16 +1,63 @@
+import json
+import re
+from functools import partial
+from operator import itemgetter
+
+from pyorient.exceptions import PyOrientException
 from pyorient.ogm import declarative
 from pyorient.ogm.property import (String, Integer)
-from passlib.hash import sha256_crypt
 
-from .databases import OrientDataBase
+from .cache import LRUCache, TTLCache, cached
+from .databases import orient_pool
+from .instrumentation import instrumentation, instrumented
+from .passwords import verifier
+from .pool import LazyConnection
+from .popularity import reader_counts
+from .recommendations import recommender
+from .similarity import book_similarity
+from .tag_index import tag_index
+from .utils import BATCH_SIZE, batches, index_updates, keyset_pages, ordered
+from .write_behind import WriteBehind
 
 Node = declarative.declarative_node()
 Relationship = declarative.declarative_relationship()
 
 # OrientDataBase.create()
-client, graph = OrientDataBase.connect()
-
-
+# graph of connection of current thread, opened on first query
+graph = LazyConnection(orient_pool, select=itemgetter(1))
+
+# (class, id) -> vertex with @rid, shared by all relationship inserts
+vertex_cache = LRUCache()
+# results of aggregate queries, dropped by writes changing them
+query_cache = TTLCache()
+
+# (class, properties, type) of indexes created by create_schema(),
+# edges are indexed by the vertices they connect
+INDEXES = [
+    ("User", ("user_id",), "UNIQUE"),  # ordered, used by keyset pagination
+    ("User", ("username",), "UNIQUE_HASH_INDEX"),
+    ("Book", ("book_id",), "UNIQUE"),
+    ("Tag", ("tag_id",), "UNIQUE_HASH_INDEX"),
+    ("reads", ("out", "in"), "NOTUNIQUE_HASH_INDEX"),
+    ("follows", ("out", "in"), "NOTUNIQUE_HASH_INDEX"),
+    ("likes", ("out", "in"), "NOTUNIQUE_HASH_INDEX"),
+    ("tagged_to", ("out", "in"), "NOTUNIQUE_HASH_INDEX"),
+]
+
+# methods of pyorient client sending commands, recorded by instrumentation
+ORIENT_CALLS = ("command", "query", "batch", "record_load", "record_create",
+                "record_update", "record_delete")
+
+# records fetched per round trip by users() and books()
+FETCH_SIZE = 1000
+# :name placeholders of values bound by _bind(), "#12:3" record ids are not placeholders
+PLACEHOLDER = re.compile(r"(?<![\w#]):([A-Za-z_]\w*)")
+RID = re.compile(r"#-?\d+:\d+$")
+# records of one page of users_page() and books_page()
+PAGE_SIZE = 100
+
+
+@instrumented
 class User(Node):
     """Class for User node"""
 
@@ -28,57 +75,141 @@ class User(Node):
 
     def find(self):
         """ Return user in database by username """
-        user = graph.client.command("SELECT * FROM User WHERE username='%s'" % self.username)
+        user = graph.users.query(username=self.username).first()
         return user
 
     def insert(self):
-        """ Insert user node to graph without checking
-         if user already exists in graph and without password encryption"""
-        graph.users.create(user_id=self.user_id,
-                           username=self.username,
-                           password=self.password
-                           )
+        """ Insert user node to graph unless user with the same user_id exists,
+         without password encryption"""
+        user = _vertex(User, self.user_id) or graph.users.create(user_id=self.user_id,
+                                                                 username=self.username,
+                                                                 password=self.password
+                                                                 )
+        vertex_cache.put(("User", str(self.user_id)), user)
+
+    @staticmethod
+    def insert_many(users, batch_size=BATCH_SIZE):
+        """ Upsert user nodes to graph with one batch script per batch """
+        _create_vertices(User, users, batch_size)
 
     def verify_password(self, password):
-        """ Return if password is valid """
+        """ Return if password matches hash stored in the user found by username,
+         hash is checked in the pool of password verifier """
         user = self.find()
         if not user:
             return False
-        return sha256_crypt.verify(password, self.password)
+        return verifier.verify(password, user.password)
+
+    def login(self, password):
+        """ Return session token of user id if password is valid, else None """
+        user = self.find()
+        if not user:
+            return None
+        return verifier.login(int(user.user_id), password, user.password)
 
     def find_by_id(self):
         """ Return user in database by username """
         user = graph.users.query(user_id=self.user_id).first()
         return user
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (users in order of ids, ids without user) fetched by one query """
+        return _find_many(User, ids)
+
     def reads(self, book_id):
         """Create relationship (User)-[:READS]->(Book)"""
-        user = self.find_by_id()
-        if user:
-            book = graph.books.query(book_id=book_id).first()
-            graph.reads.create(user, book)
+        if write_behind.enabled:
+            write_behind.add("reads", self.user_id, book_id)
+            return
+        user = _vertex(User, self.user_id)
+        book = _vertex(Book, book_id)
+        if user and book and _link("reads", user, book):
+            _count_reader(self.user_id, book_id)
 
     def follows(self, friend_id):
         """Create relationship (User)-[:FOLLOWS]->(User)"""
-        user = self.find_by_id()
-        if user:
-            friend = graph.users.query(user_id=friend_id).first()
-            graph.follows.create(user, friend)
+        if write_behind.enabled:
+            write_behind.add("follows", self.user_id, friend_id)
+            return
+        user = _vertex(User, self.user_id)
+        friend = _vertex(User, friend_id)
+        if user and friend and _link("follows", user, friend):
+            recommender.add_follow(self.user_id, friend_id)
 
     def likes(self, book_id):
         """ Create relationship (User)-[:LIKES]->(Book) """
-        user = self.find_by_id()
-        if user:
-            book = graph.books.query(book_id=book_id).first()
-            graph.likes.create(user, book)
+        if write_behind.enabled:
+            write_behind.add("likes", self.user_id, book_id)
+            return
+        user = _vertex(User, self.user_id)
+        book = _vertex(Book, book_id)
+        if user and book and _link("likes", user, book):
+            recommender.add_like(self.user_id, book_id)
+
+    @staticmethod
+    def reads_many(pairs, batch_size=BATCH_SIZE):
+        """Create relationships (User)-[:READS]->(Book) from (user_id, book_id) pairs"""
+        _create_edges("reads", User, Book, pairs, batch_size, _count_reader)
+
+    @staticmethod
+    def follows_many(pairs, batch_size=BATCH_SIZE):
+        """Create relationships (User)-[:FOLLOWS]->(User) from (user_id, friend_id) pairs"""
+        _create_edges("follows", User, User, pairs, batch_size, recommender.add_follow)
+        recommender.compact()
 
     @staticmethod
-    def users():
-        """List of all users"""
-        users = graph.users.query().all()
-        return [user.username for user in users]
+    def likes_many(pairs, batch_size=BATCH_SIZE):
+        """Create relationships (User)-[:LIKES]->(Book) from (user_id, book_id) pairs"""
+        _create_edges("likes", User, Book, pairs, batch_size, recommender.add_like)
+        recommender.compact()
+
+    def recommended_books(self, k=10):
+        """ Return ids of books liked by followed users, precomputed in memory """
+        write_behind.flush(self.user_id)
+        return recommender.recommend(self.user_id, k)
+
+    def recommended_books_query(self, k=10):
+        """ Return ids of books liked by followed users, computed by database """
+        write_behind.flush(self.user_id)
+        query = """
+                SELECT book_id, count(*) AS score
+                FROM (
+                      MATCH {class: User, as: user, where: (user_id = :user_id)}
+                            .out('follows'){as: friend}
+                            .out('likes'){as: book}
+                      RETURN book.book_id AS book_id
+                )
+                WHERE book_id NOT IN (SELECT book_id FROM (SELECT expand(out('likes'))
+                                                           FROM User WHERE user_id = :user_id))
+                GROUP BY book_id
+                ORDER BY score DESC, book_id
+                LIMIT :k
+        """
+        return [int(record.oRecordData["book_id"])
+                for record in _command(query, user_id=str(self.user_id), k=int(k))]
 
+    @staticmethod
+    def users(fetch_size=None):
+        """ Yield usernames of all users, fetching fetch_size users per query """
+        users = keyset_pages(User.users_page, itemgetter("user_id"),
+                             page_size=fetch_size or FETCH_SIZE)
+        return (user["username"] for user in users)
+
+    @staticmethod
+    def users_page(after=None, limit=PAGE_SIZE):
+        """ Return user_id and username of at most limit users with user_id greater than after,
+         ids are ordered as strings """
+        return _page("User", "user_id", ["username"], after, limit)
 
+    @staticmethod
+    def export_page(after=None, limit=PAGE_SIZE):
+        """ Return all properties, password hash included, of at most limit users
+         with user_id greater than after, ids are ordered as strings """
+        return _page("User", "user_id", ["username", "password"], after, limit)
+
+
+@instrumented
 class Book(Node):
     """Class for Book node"""
     element_plural = "books"
@@ -97,47 +228,81 @@ class Book(Node):
         book = graph.books.query(book_id=self.book_id).first()
         return book
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (books in order of ids, ids without book) fetched by one query """
+        return _find_many(Book, ids)
+
     def insert(self):
-        """Inserting book node to graph"""
-        graph.books.create(book_id=self.book_id,
-                           authors=self.authors,
-                           year=self.year,
-                           title=self.title,
-                           language=self.language)
+        """Inserting book node to graph unless book with the same book_id exists"""
+        book = _vertex(Book, self.book_id) or graph.books.create(book_id=self.book_id,
+                                                                 authors=self.authors,
+                                                                 year=self.year,
+                                                                 title=self.title,
+                                                                 language=self.language)
+        vertex_cache.put(("Book", str(self.book_id)), book)
+
+    @staticmethod
+    def insert_many(books, batch_size=BATCH_SIZE):
+        """Upsert book nodes to graph with one batch script per batch"""
+        _create_vertices(Book, books, batch_size)
 
     def linked_tags(self):
-        """Return list of tags for specific book"""
-        tags = [tag.outV().tag_name for tag in self.inE()]
-        return tags
+        """Return list of tags for specific book, from tag index if it is complete"""
+        if tag_index.complete:
+            return tag_index.tag_names(self.book_id)
+        query = "SELECT tag_name FROM (SELECT expand(out('tagged_to')) FROM Book " \
+                "WHERE book_id = :book_id)"
+        return [record.oRecordData["tag_name"]
+                for record in _command(query, book_id=str(int(self.book_id)))]
+
+    def similar_books(self, k=10):
+        """ Return ids of k books with the most similar tags """
+        return book_similarity.similar(self.book_id, k)
 
     def link_to_tag(self, tag_id):
         """Create relationship (Book)-[:TAGGED_TO]->(Tag)"""
-        book = self.find_by_id()
-        if book:
-            tag = graph.tags.query(tag_id=tag_id).first()
-            graph.tagged_to.create(book, tag)
+        book = _vertex(Book, self.book_id)
+        tag = _vertex(Tag, tag_id)
+        if book and tag and _link("tagged_to", book, tag):
+            _tag_book(self.book_id, tag_id)
+
+    @staticmethod
+    def link_to_tag_many(pairs, batch_size=BATCH_SIZE):
+        """Create relationships (Book)-[:TAGGED_TO]->(Tag) from (book_id, tag_id) pairs"""
+        _create_edges("tagged_to", Book, Tag, pairs, batch_size, _tag_book)
+        tag_index.compact()
 
+    @staticmethod
+    def books(fetch_size=None):
+        """ Yield properties of all books, fetching fetch_size books per query """
+        return keyset_pages(Book.books_page, itemgetter("book_id"), page_size=fetch_size or FETCH_SIZE)
 
     @staticmethod
-    def books():
-        """Return list of all books"""
-        books = graph.query(Book).all()
-        return [book for book in books]
+    def books_page(after=None, limit=PAGE_SIZE):
+        """ Return properties of at most limit books with book_id greater than after,
+         ids are ordered as strings """
+        return _page("Book", "book_id", ["title", "authors", "year", "language"], after, limit)
 
     @staticmethod
+    @cached(query_cache, "most_popular_books")
     def most_popular_books():
         """ Return books which are read by most amount of users """
         query = """
-                SELECT book_title, Count(tags)
-                from (
-                      MATCH {class: User, as: user}.in('reads') {as: book}
-                      RETURN book.title, user
-                )
-                group by book_title
-        """
-        return graph.query(query)  # alright?
+                SELECT book_id, title, authors, year, language, in('reads').size() AS readers
+                FROM Book
+                ORDER BY readers DESC, book_id
+                LIMIT 16
+                """
+        return [record.oRecordData for record in graph.client.command(query)]
 
+    @staticmethod
+    def most_popular_book_ids(n=16):
+        """ Return ids of the most read books from reader counts kept in memory """
+        return reader_counts.top(n)
 
+
+@instrumented
 class Tag(Node):
     """Class for Tag node"""
 
@@ -151,16 +316,55 @@ class Tag(Node):
         self._props = kwargs
 
     def insert(self):
-        """ Insert tag to graph"""
-        graph.tags.create(
+        """ Insert tag to graph unless tag with the same tag_id exists """
+        tag = _vertex(Tag, self.tag_id) or graph.tags.create(
             tag_id=self.tag_id,
             tag_name=self.tag_name
         )
+        vertex_cache.put(("Tag", str(self.tag_id)), tag)
+        tag_index.name(self.tag_id, self.tag_name)
+
+    @staticmethod
+    def insert_many(tags, batch_size=BATCH_SIZE):
+        """ Upsert tag nodes to graph with one batch script per batch"""
+        if index_updates.enabled:
+            tags = tag_index.name_rows(tags)
+        _create_vertices(Tag, tags, batch_size)
 
     def find_by_id(self):
         tag = graph.tags.query(tag_id=self.tag_id).first()
         return tag
 
+    @staticmethod
+    def find_many(ids):
+        """ Return (tags in order of ids, ids without tag) fetched by one query """
+        return _find_many(Tag, ids)
+
+    @staticmethod
+    def tags_page(after=None, limit=PAGE_SIZE):
+        """ Return tag_id and tag_name of at most limit tags with tag_id greater than after,
+         ids are ordered as strings """
+        return _page("Tag", "tag_id", ["tag_name"], after, limit)
+
+    def books(self):
+        """ Return ids of books tagged with tag, from tag index if it is complete """
+        return Tag.books_with_tags([self.tag_id])
+
+    @staticmethod
+    def books_with_tags(tag_ids):
+        """ Return sorted ids of books tagged with all of tags, from tag index if it is complete """
+        if tag_index.complete:
+            return tag_index.books(*tag_ids).tolist()
+        tag_ids = sorted({str(int(tag_id)) for tag_id in tag_ids})
+        if not tag_ids:
+            return []
+        # relationships are unique, so a book tagged with all tags has one edge per tag
+        query = "SELECT out.book_id AS book_id, count(*) AS amount FROM tagged_to " \
+                "WHERE in.tag_id IN :tag_ids GROUP BY out.book_id"
+        return sorted(int(record.oRecordData["book_id"])
+                      for record in _command(query, tag_ids=tag_ids)
+                      if record.oRecordData["amount"] == len(tag_ids))
+
 
 class TaggedTo(Relationship):
     label = "tagged_to"
@@ -178,10 +382,263 @@ class Likes(Relationship):
     label = "likes"
 
 
+# relationships created by requests, buffered and written in batches once started
+write_behind = WriteBehind({"reads": User.reads_many,
+                           "follows": User.follows_many,
+                           "likes": User.likes_many})
+
+# relationship -> (source model, edge class, target model), streamed by relationships()
+RELATIONSHIPS = {
+    "reads": (User, Read, Book),
+    "follows": (User, Follows, User),
+    "likes": (User, Likes, Book),
+    "tagged_to": (Book, TaggedTo, Tag),
+}
+
+
+def relationships(relationship, fetch_size=None):
+    """ Yield (from_id, to_id) pairs of all edges, with edges of fetch_size
+     source vertices per query """
+    sources = keyset_pages(partial(relationships_page, relationship), itemgetter("from_id"),
+                           page_size=fetch_size or FETCH_SIZE)
+    return ((source["from_id"], to_id) for source in sources for to_id in source["to_ids"])
+
+
+def relationships_page(relationship, after=None, limit=PAGE_SIZE):
+    """ Return from_id and sorted to_ids of edges of at most limit source vertices
+     with id greater than after, ids are ordered as strings. Source vertices are
+     read in order of their unique id from its index, every page costs only its own edges """
+    source, edge, target = RELATIONSHIPS[relationship]
+    id_property = _id_property(source)
+    query = "SELECT %s AS from_id, out('%s').%s AS to_ids FROM %s " \
+            "WHERE %s > :after ORDER BY %s LIMIT :limit" \
+            % (id_property, edge.label, _id_property(target), source.__name__,
+               id_property, id_property)
+    return [{"from_id": int(record.oRecordData["from_id"]),
+             "to_ids": sorted(int(to_id) for to_id in record.oRecordData.get("to_ids") or [])}
+            for record in _command(query, after="" if after is None else str(after),
+                                   limit=int(limit))]
+
+
+def _id_property(model):
+    return model.__name__.lower() + "_id"  # user_id, book_id, tag_id
+
+
+class _Rid(str):
+    """ @rid of record, bound by _bind() as link instead of string """
+
+
+def _literal(value):
+    """ Return OrientDB SQL literal of value, escaped like JSON """
+    if isinstance(value, _Rid):
+        if not RID.match(value):
+            raise ValueError("invalid @rid %r" % str(value))
+        return str(value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return "[%s]" % ", ".join(_literal(item) for item in value)
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join("%s: %s" % (json.dumps(str(key)), _literal(item))
+                                  for key, item in value.items())
+    raise TypeError("value of type %s can not be bound" % type(value).__name__)
+
+
+def _bind(query, **params):
+    """ Return query with :name placeholders replaced by literals of params.
+
+    The binary protocol of pyorient sends commands without parameters, so
+    values are encoded here, in one place, and never formatted into queries.
+    """
+    return PLACEHOLDER.sub(lambda match: _literal(params[match.group(1)]), query)
+
+
+def _command(query, **params):
+    """ Execute query with :name placeholders bound to params, return records """
+    return graph.client.command(_bind(query, **params))
+
+
+def _vertex(model, primary_key):
+    """ Return vertex of model by id, looking into vertex_cache first """
+    primary_key = str(primary_key)
+    elements = getattr(graph, model.element_plural)
+    return vertex_cache.resolve((model.__name__, primary_key),
+                                lambda: elements.query(**{_id_property(model): primary_key}).first())
+
+
+def _find_many(model, ids):
+    """ Return (vertices of model in order of ids, ids without vertex) fetched by one query """
+    ids = [str(primary_key) for primary_key in ids]
+    id_property = _id_property(model)
+    query = "SELECT FROM %s WHERE %s IN :ids" % (model.__name__, id_property)
+    vertices = graph.elements_from_records(_command(query, ids=ids))
+    return ordered(ids, {str(getattr(vertex, id_property)): vertex for vertex in vertices})
+
+
+def _vertices(model, ids):
+    """ Return dict id -> vertex of model, vertices missing in vertex_cache
+     are fetched by one query """
+    ids = set(str(primary_key) for primary_key in ids)
+    vertices = {}
+    for primary_key in ids:
+        vertex = vertex_cache.get((model.__name__, primary_key))
+        if vertex is not None:
+            vertices[primary_key] = vertex
+    missing = [primary_key for primary_key in ids if primary_key not in vertices]
+    found, _ = _find_many(model, missing) if missing else ([], [])
+    for vertex in found:
+        primary_key = str(getattr(vertex, _id_property(model)))
+        vertex_cache.put((model.__name__, primary_key), vertex)
+        vertices[primary_key] = vertex
+    return vertices
+
+
+def _count_reader(_, book_id):
+    """ Count reader of book, cached most popular books are dropped if the top changed """
+    if reader_counts.add(int(book_id)):
+        query_cache.discard("most_popular_books")
+
+
+def _tag_book(book_id, tag_id):
+    """ Register new tag of book in tag index and similar books """
+    tag_index.add(book_id, tag_id)
+    book_similarity.add(book_id, tag_id)
+
+
+def _page(class_name, id_property, properties, after, limit):
+    """ Return dicts with id and properties of at most limit vertices with id greater than after """
+    query = "SELECT %s FROM %s WHERE %s > :after ORDER BY %s LIMIT :limit" \
+            % (", ".join([id_property] + properties), class_name, id_property, id_property)
+    page = []
+    for record in _command(query, after="" if after is None else str(after), limit=int(limit)):
+        row = {name: record.oRecordData.get(name) for name in properties}
+        row[id_property] = int(record.oRecordData[id_property])
+        page.append(row)
+    return page
+
+
+def _run_batch(commands):
+    """ Execute commands as one transactional batch script """
+    script = ";\n".join(["begin"] + commands + ["commit retry 100"])
+    graph.client.batch(script + ";")
+
+
+def _create_vertices(model, rows, batch_size):
+    """ Upsert vertices of model from dicts of properties, vertex with the same id is updated """
+    id_property = _id_property(model)
+    for batch in batches(rows, batch_size):
+        query = "UPDATE %s CONTENT :row UPSERT WHERE %s = :id" % (model.__name__, id_property)
+        _run_batch([_bind(query, row=row, id=str(row[id_property])) for row in batch])
+
+
+def _rid(value):
+    """ Return "#cluster:position" of link returned by query or of @rid string """
+    return value.get_hash() if hasattr(value, "get_hash") else str(value)
+
+
+def _existing_edges(label, pairs):
+    """ Return set of (from @rid, to @rid) pairs which already have edge of label """
+    sources = sorted(set(_Rid(source) for source, _ in pairs))
+    targets = sorted(set(_Rid(target) for _, target in pairs))
+    query = "SELECT out AS source, in AS target FROM %s WHERE out IN :sources AND in IN :targets" \
+            % label
+    return set((_rid(record.oRecordData["source"]), _rid(record.oRecordData["target"]))
+               for record in _command(query, sources=sources, targets=targets))
+
+
+def _link(label, source, target):
+    """ Create edge of label between vertices unless it exists, return if it was created """
+    if _existing_edges(label, [(source._id, target._id)]):
+        return False
+    getattr(graph, label).create(source, target)
+    return True
+
+
+def _create_edges(label, from_model, to_model, pairs, batch_size, created=None):
+    """ Create edges of label from (from_id, to_id) pairs between vertices of models.
+     Vertices of every batch are fetched by one query per model, pairs with missing
+     vertices and edges which already exist are skipped; created(from_id, to_id)
+     is called for every edge created after its batch is committed """
+    for batch in batches(pairs, batch_size):
+        sources = _vertices(from_model, [from_id for from_id, _ in batch])
+        targets = _vertices(to_model, [to_id for _, to_id in batch])
+        rids = {}
+        for from_id, to_id in batch:
+            if str(from_id) in sources and str(to_id) in targets:
+                rids.setdefault((sources[str(from_id)]._id, targets[str(to_id)]._id),
+                                (from_id, to_id))
+        if not rids:
+            continue
+        existing = _existing_edges(label, list(rids))
+        new = [(rid, pair) for rid, pair in rids.items() if rid not in existing]
+        if new:
+            query = "CREATE EDGE %s FROM :source TO :target" % label
+            _run_batch([_bind(query, source=_Rid(source), target=_Rid(target))
+                        for (source, target), _ in new])
+        if created is not None and index_updates.enabled:
+            for _, (from_id, to_id) in new:
+                created(from_id, to_id)
+
+
+def create_schema(indexes=True):
+    """ Create classes of nodes and relationships with their indexes,
+     or drop the indexes if indexes is False """
+    _change_schema(graph.create_all, Node.registry)
+    _change_schema(graph.create_all, Relationship.registry)
+    for class_name, properties, index_type in INDEXES:
+        name = "%s.%s" % (class_name, "_".join(properties))
+        if not indexes:
+            _change_schema(graph.client.command, "DROP INDEX %s" % name)
+            continue
+        for property_name in properties:
+            if property_name in ("out", "in"):  # not declared by classes of relationships
+                _change_schema(graph.client.command,
+                               "CREATE PROPERTY %s.%s LINK" % (class_name, property_name))
+        _change_schema(graph.client.command, "CREATE INDEX %s ON %s (%s) %s"
+                       % (name, class_name, ", ".join(properties), index_type))
+
+
+def _change_schema(func, *args):
+    """ Run schema change, which fails if schema already is as requested """
+    try:
+        func(*args)
+    except PyOrientException:
+        pass
+
+
 def clear_graph():
     """ Clear all nodes and relationships """
+    write_behind.clear()
     graph.drop("books")
+    vertex_cache.clear()
+    recommender.clear()
+    query_cache.clear()
+    reader_counts.clear()
+    tag_index.clear()
+    book_similarity.clear()
+
+
+def _include_registry(connection):
+    """ Register classes of nodes and relationships in new connection """
+    _, connection_graph = connection
+    connection_graph.include(Node.registry)
+    connection_graph.include(Relationship.registry)
+
+
+def _record_bytes(result):
+    """ Approximate size of records returned by command, as JSON """
+    if not isinstance(result, list):
+        return 0
+    return sum(len(json.dumps(getattr(record, "oRecordData", None), default=str))
+               for record in result)
+
+
+def _instrument(connection):
+    """ Record commands of client of new connection """
+    _, connection_graph = connection
+    instrumentation.instrument(connection_graph.client, ORIENT_CALLS, "orientdb",
+                               size=_record_bytes)
 
 
-graph.include(Node.registry)
-graph.include(Relationship.registry)
+orient_pool.on_connect.append(_include_registry)
+orient_pool.on_connect.append(_instrument)
@@ -0,0 +1,97 @@
+"""Parallel loading of relationships with a pool of worker processes.
+
+Pairs are partitioned by one end of relationships, so every vertex of that
+end is written by one worker only. By default it is the end with the highest
+degree, e.g. books of reads, where concurrent writes of popular vertices
+contend most. Vertices of the other end may still be written by several
+workers, shared_vertices() measures how many.
+"""
+import importlib
+import zlib
+from collections import Counter
+from multiprocessing import get_context
+from time import time
+
+# relationship -> (model, id argument of model, method creating one relationship)
+RELATIONSHIPS = {
+    'reads': ('User', 'user_id', 'reads'),
+    'follows': ('User', 'user_id', 'follows'),
+    'likes': ('User', 'user_id', 'likes'),
+    'tagged_to': ('Book', 'book_id', 'link_to_tag'),
+}
+
+# models module of the backend, imported once in every worker
+_models = None
+
+
+def busiest_end(pairs):
+    """ Return 0 if from_id or 1 if to_id end of pairs has the vertex with the highest degree """
+    degrees = [max(Counter(pair[end] for pair in pairs).values(), default=0) for end in (0, 1)]
+    return int(degrees[1] > degrees[0])
+
+
+def partition(pairs, workers, end=None):
+    """ Split (from_id, to_id) pairs between workers by from_id if end is 0 or to_id
+     if it is 1, the busiest end by default, so all writes touching the same vertex
+     of that end go through one worker """
+    pairs = list(pairs)
+    if end is None:
+        end = busiest_end(pairs)
+    parts = [[] for _ in range(workers)]
+    for pair in pairs:
+        worker = zlib.crc32(str(pair[end]).encode()) % workers
+        parts[worker].append(pair)
+    return parts
+
+
+def shared_vertices(parts):
+    """ Return amounts of (from, to) vertices written by more than one worker """
+    shared = []
+    for end in (0, 1):
+        workers = Counter(vertex for part in parts for vertex in {pair[end] for pair in part})
+        shared.append(sum(1 for count in workers.values() if count > 1))
+    return tuple(shared)
+
+
+def _init_worker(backend):
+    """ Import models in worker, so it opens its own database connection """
+    global _models
+    _models = importlib.import_module(backend)
+
+
+def _ready(_):
+    return True
+
+
+def _load_partition(args):
+    """ Create relationships of one partition, return time spent in worker """
+    relationship, pairs, batch_size = args
+    model_name, id_argument, method = RELATIONSHIPS[relationship]
+    model = getattr(_models, model_name)
+    time_start = time()
+    if batch_size:
+        getattr(model, method + '_many')(pairs, batch_size)
+    else:
+        for from_id, to_id in pairs:
+            getattr(model(**{id_argument: str(from_id)}), method)(str(to_id))
+    return time() - time_start
+
+
+def load_parallel(backend, relationship, pairs, workers, batch_size=0, parts=None):
+    """ Create relationships with pool of worker processes.
+
+    backend is name of models module, e.g. 'app.arango_models', parts are
+    pairs already split by partition().
+    Returns wall time of loading and list of times spent by every worker.
+    """
+    parts = parts or partition(pairs, workers)
+    # spawn instead of fork, connection of parent must not be shared with workers
+    context = get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker, initargs=(backend,)) as pool:
+        pool.map(_ready, range(workers), chunksize=1)
+        time_start = time()
+        worker_times = pool.map(_load_partition,
+                                [(relationship, part, batch_size) for part in parts],
+                                chunksize=1)
+        running_time = time() - time_start
+    return running_time, worker_times
@@ -0,0 +1,98 @@
+"""Password verification off the request threads.
+
+sha256_crypt runs hundreds of thousands of rounds per check, which holds a
+request thread and the GIL for a long time. Checks run in a bounded pool of
+processes instead: at most max_pending checks are submitted at once, further
+logins wait up to QUEUE_TIMEOUT seconds for a free slot and then fail with
+VerifierBusy, so a burst of logins does not pile up unbounded work.
+Successful logins get a session token, later requests with the token are
+authenticated from the cache without hashing. Worker processes are spawned,
+a fork of the threaded web app would inherit locks held by other threads,
+and run functions of password_workers, which does not import the app.
+"""
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from password_workers import hash_password, verify_password
+
+from .cache import TTLCache
+
+WORKERS = 4
+# submitted checks per worker process, further logins wait for a free slot
+PENDING_PER_WORKER = 4
+# seconds login waits for a free slot before VerifierBusy
+QUEUE_TIMEOUT = 5
+SESSIONS = 10000
+# seconds session token stays valid
+SESSION_TTL = 30 * 60
+
+
+class VerifierBusy(Exception):
+    """ All slots of the pool were taken for QUEUE_TIMEOUT seconds """
+
+
+class PasswordVerifier:
+    """ Pool of processes checking passwords and cache of session tokens """
+
+    def __init__(self, workers=WORKERS, max_pending=None, timeout=QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending or workers * PENDING_PER_WORKER
+        self.timeout = timeout
+        self.sessions = TTLCache(SESSIONS, SESSION_TTL)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _submit(self, func, *args):
+        """ Submit func to pool when a slot is free, slot is freed when func is done """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise VerifierBusy('%d password checks are pending' % self.max_pending)
+        try:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=get_context('spawn'))
+                future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def verify(self, password, stored_hash):
+        """ Return if password matches stored hash, checked in the pool """
+        if not stored_hash:
+            return False
+        return self._submit(verify_password, password, stored_hash).result()
+
+    def login(self, user_id, password, stored_hash):
+        """ Return new session token of user if password matches stored hash, else None """
+        if not self.verify(password, stored_hash):
+            return None
+        token = secrets.token_urlsafe(32)
+        self.sessions.put(token, user_id)
+        return token
+
+    def session(self, token):
+        """ Return user id of session token or None if it is unknown or expired """
+        return self.sessions.get(token) if token else None
+
+    def logout(self, token):
+        self.sessions.discard(token)
+
+    def hash_many(self, passwords, rounds=None):
+        """ Return sha256_crypt hashes of passwords computed in the pool """
+        futures = [self._submit(hash_password, password, rounds) for password in passwords]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """ Stop worker processes, they are started again by the next check """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+verifier = PasswordVerifier()
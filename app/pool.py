@@ -0,0 +1,117 @@
+"""Pools of database connections opened on first use"""
+import threading
+import time
+import weakref
+
+POOL_SIZE = 8
+# idle connections older than this are checked before reuse, seconds
+CHECK_INTERVAL = 30
+
+# all pools created in process
+POOLS = []
+
+
+class _Session:
+    """ Connection held by one thread, returned to pool when thread ends """
+
+    __slots__ = ("connection", "finalizer", "__weakref__")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.finalizer = None
+
+
+class ConnectionPool:
+    """ Pool of connections opened on first use.
+
+    Every thread acquires its own connection and keeps it until release()
+    or until the thread ends. At most size connections are in use at once,
+    other threads wait for a free one.
+    """
+
+    def __init__(self, connect, check=None, size=POOL_SIZE):
+        POOLS.append(self)
+        self.size = size
+        self.on_connect = []
+        self._connect = connect
+        self._check = check
+        self._idle = []  # (connection, time of release)
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def acquire(self):
+        """ Return connection of current thread, taking it from pool on first use """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = _Session(self._take())
+            session.finalizer = weakref.finalize(session, self._give_back, session.connection)
+            self._local.session = session
+        return session.connection
+
+    def release(self):
+        """ Return connection of current thread to pool """
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            self._local.session = None
+            session.finalizer()
+
+    def _take(self):
+        with self._condition:
+            while self._in_use >= self.size:
+                self._condition.wait()
+            self._in_use += 1
+        try:
+            while True:
+                with self._condition:
+                    if not self._idle:
+                        break
+                    connection, released = self._idle.pop()
+                if self._healthy(connection, released):
+                    return connection
+            return self._open()
+        except Exception:
+            self._give_back(None)
+            raise
+
+    def _open(self):
+        connection = self._connect()
+        for setup in self.on_connect:
+            setup(connection)
+        return connection
+
+    def _healthy(self, connection, released):
+        if self._check is None or time.time() - released < CHECK_INTERVAL:
+            return True
+        try:
+            self._check(connection)
+        except Exception:
+            return False
+        return True
+
+    def _give_back(self, connection):
+        with self._condition:
+            if connection is not None:
+                self._idle.append((connection, time.time()))
+            self._in_use -= 1
+            self._condition.notify()
+
+
+class LazyConnection:
+    """ Proxy to connection of current thread, pool is not touched until first attribute access """
+
+    def __init__(self, pool, select=None):
+        self._pool = pool
+        self._select = select
+
+    def __getattr__(self, name):
+        connection = self._pool.acquire()
+        if self._select is not None:
+            connection = self._select(connection)
+        return getattr(connection, name)
+
+
+def release_connections():
+    """ Return connections of current thread to all pools """
+    for pool in POOLS:
+        pool.release()
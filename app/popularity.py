@@ -0,0 +1,76 @@
+"""Reader counts of books maintained in process.
+
+Counts are increased by User.reads, so the most read books are known without
+aggregating READS relationships in database. The current top books are kept
+in a small min-heap which is updated on every read.
+"""
+import heapq
+from collections import Counter
+from threading import Lock
+
+import numpy as np
+
+from . import datasets
+
+TOP_BOOKS = 16
+
+
+class ReaderCounts:
+    """ Amount of readers of every book and heap of the most read ones """
+
+    def __init__(self, size=TOP_BOOKS):
+        self.size = size
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._counts = Counter()
+            self._heap = []  # (readers, book_id) of the top books, least read first
+            self._in_heap = set()
+
+    def add(self, book_id, readers=1):
+        """ Count new readers of book, return if the top books changed """
+        with self._lock:
+            count = self._counts[book_id] = self._counts[book_id] + readers
+            if book_id in self._in_heap:
+                self._heap = [(count if book == book_id else amount, book)
+                              for amount, book in self._heap]
+                heapq.heapify(self._heap)
+                return True
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, (count, book_id))
+                self._in_heap.add(book_id)
+                return True
+            if count > self._heap[0][0]:
+                _, dropped = heapq.heapreplace(self._heap, (count, book_id))
+                self._in_heap.discard(dropped)
+                self._in_heap.add(book_id)
+                return True
+            return False
+
+    def load(self, book_ids):
+        """ Count readers from array of book ids of READS relationships """
+        self.load_counts(*np.unique(np.asarray(book_ids), return_counts=True))
+
+    def load_counts(self, books, readers):
+        """ Count readers from arrays of book ids and their amounts of readers """
+        for book_id, amount in zip(np.asarray(books).tolist(), np.asarray(readers).tolist()):
+            self.add(book_id, amount)
+
+    def load_from_datasets(self):
+        """ Count readers from to_read1000.csv """
+        self.load(datasets.columns('reads')[1])
+
+    def readers(self, book_id):
+        return self._counts[book_id]
+
+    def top(self, n=TOP_BOOKS):
+        """ Return ids of at most n most read books, the most read first """
+        with self._lock:
+            if n <= self.size:
+                return [book for _, book in heapq.nlargest(n, self._heap)]
+            return [book for book, _ in self._counts.most_common(n)]
+
+
+reader_counts = ReaderCounts()
@@ -0,0 +1,149 @@
+"""Profiling of experiment phases.
+
+Every run of a phase is profiled by cProfile in the calling thread while a
+sampler thread records stacks of all threads, so time spent in worker
+threads of read workloads is sampled too. Wall time is split into CPU time
+of the process and the rest, which is waiting for I/O, mostly for the
+database. Peak memory is traced by tracemalloc. Stacks are written in
+collapsed format ("frame;frame;frame count" lines) read by flamegraph.pl
+and speedscope, cProfile statistics as .prof file read by pstats.
+"""
+import cProfile
+import os
+import pstats
+import re
+import sys
+import sysconfig
+import threading
+import tracemalloc
+from collections import Counter
+from time import perf_counter, process_time
+
+# seconds between samples of stacks
+SAMPLE_INTERVAL = 0.005
+PROFILES_DIR = 'profiles'
+
+
+def _frame_name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return '%s:%s' % (module, code.co_name)
+
+
+def package(filename):
+    """ Return top level package of source file, e.g. pandas or py2neo, or its module """
+    if filename.startswith('~') or filename.startswith('<'):
+        return 'builtins'
+    parts = os.path.normpath(filename).split(os.sep)
+    for marker in ('site-packages', 'dist-packages'):
+        if marker in parts:
+            return os.path.splitext(parts[parts.index(marker) + 1])[0]
+    if 'app' in parts:
+        return 'app'
+    if filename.startswith(sysconfig.get_paths()['stdlib']):
+        return 'stdlib'
+    return os.path.splitext(parts[-1])[0]
+
+
+class StackSampler:
+    """ Thread counting stacks of all other threads every interval seconds """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """ Return lines of stacks in collapsed format """
+        return ['%s %d' % (stack, count) for stack, count in sorted(self.stacks.items())]
+
+
+class PhaseProfile:
+    """ cProfile statistics, stack samples, CPU and wall time and peak memory
+     of all runs of one phase """
+
+    def __init__(self, name, interval=SAMPLE_INTERVAL):
+        self.name = name
+        self.runs = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak = 0
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(interval)
+
+    @property
+    def wait(self):
+        """ Wall time not spent on CPU by the process, i.e. waiting for I/O """
+        return max(self.wall - self.cpu, 0.0)
+
+    def __enter__(self):
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        self.sampler.start()
+        self._wall_start, self._cpu_start = perf_counter(), process_time()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.wall += perf_counter() - self._wall_start
+        self.cpu += process_time() - self._cpu_start
+        self.sampler.stop()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        if self._tracing:
+            tracemalloc.stop()
+        self.runs += 1
+
+    def wrap(self, run):
+        """ Return run profiled on every call """
+        def profiled():
+            with self:
+                return run()
+        return profiled
+
+    def packages(self, top=8):
+        """ Return list of (package, seconds) of own time of functions by package """
+        times = Counter()
+        for (filename, _, _), (_, _, own_time, _, _) in pstats.Stats(self.profile).stats.items():
+            times[package(filename)] += own_time
+        return times.most_common(top)
+
+    def report(self):
+        """ Return lines with times, peak memory and time by package """
+        lines = ['%s: wall %.4f s, cpu %.4f s, waiting %.4f s, peak memory %.1f MB, %d runs'
+                 % (self.name, self.wall, self.cpu, self.wait, self.peak / 2 ** 20, self.runs)]
+        lines += ['  %s: %.4f s' % (name, seconds) for name, seconds in self.packages()]
+        return lines
+
+    def save(self, directory=PROFILES_DIR):
+        """ Write <name>.prof and <name>.collapsed to directory, return their paths """
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, re.sub(r'[^\w.=-]+', '_', self.name))
+        self.profile.dump_stats(base + '.prof')
+        with open(base + '.collapsed', 'w') as collapsed_file:
+            collapsed_file.write('\n'.join(self.sampler.collapsed()) + '\n')
+        return base + '.prof', base + '.collapsed'
@@ -0,0 +1,242 @@
+"""Precomputed "friends also liked" recommendations.
+
+FOLLOWS and LIKES relationships are kept as sparse matrices in CSR format
+over user and book ids. Score of book for user is amount of followed users
+liking it, i.e. row of product FOLLOWS x LIKES, without books the user already
+likes. Top-k books of all users are computed in vectorized batches of users;
+later follows() and likes() mark affected users, whose recommendations are
+recomputed on the next request and kept in a dict in front of the top-k
+arrays. Relationships added one by one are kept in small lists, which
+compact() merges into the CSR arrays after every batch. arrays() and
+load_arrays() save and restore all of it, e.g. in a snapshot.
+"""
+from collections import defaultdict
+from threading import RLock
+
+import numpy as np
+
+from . import datasets
+
+TOP_K = 10
+# users whose products are computed at once by build()
+USERS_BATCH = 1000
+
+
+class SparseRows:
+    """ Sparse 0/1 matrix: CSR arrays built at once plus rows added later """
+
+    def __init__(self, rows=(), columns=()):
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        self.columns = columns[order]
+        self.offsets = np.zeros((rows.max() + 2) if len(rows) else 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.offsets) - 1), out=self.offsets[1:])
+        self.added = defaultdict(list)
+
+    @classmethod
+    def from_csr(cls, offsets, columns):
+        """ Return matrix reading CSR arrays as they are, e.g. mapped from snapshot """
+        matrix = cls.__new__(cls)
+        matrix.offsets, matrix.columns = offsets, columns
+        matrix.added = defaultdict(list)
+        return matrix
+
+    @property
+    def size(self):
+        """ Amount of rows stored in CSR arrays """
+        return len(self.offsets) - 1
+
+    def row(self, row):
+        """ Return array of columns of row """
+        return self.gather(np.array([row], dtype=np.int64))[1]
+
+    def gather(self, rows):
+        """ Return (positions in rows, columns) of all columns of given rows """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[np.minimum(rows, self.size)]
+        lengths = self.offsets[np.minimum(rows + 1, self.size)] - starts
+        positions = np.repeat(np.arange(len(rows)), lengths)
+        columns = self.columns[np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                               + np.arange(lengths.sum())]
+        if self.added:
+            extra = [(position, column) for position, row in enumerate(rows.tolist())
+                     if row in self.added for column in self.added[row]]
+            if extra:
+                extra = np.array(extra, dtype=np.int64)
+                positions = np.concatenate([positions, extra[:, 0]])
+                columns = np.concatenate([columns, extra[:, 1]])
+        return positions, columns
+
+    def add(self, row, column):
+        self.added[row].append(column)
+
+    def pairs(self):
+        """ Return arrays of (row, column) of all cells """
+        rows = np.repeat(np.arange(self.size), np.diff(self.offsets))
+        added = [(row, column) for row, columns in self.added.items() for column in columns]
+        if not added:
+            return rows, self.columns
+        added = np.array(added, dtype=np.int64)
+        return np.concatenate([rows, added[:, 0]]), np.concatenate([self.columns, added[:, 1]])
+
+    def compacted(self):
+        """ Return matrix with rows added later merged into CSR arrays """
+        return SparseRows(*self.pairs()) if self.added else self
+
+
+def _top_rows(recommended):
+    """ Return SparseRows of dict row -> array of columns, keeping order of columns """
+    rows = sorted(recommended)
+    lengths = [len(recommended[row]) for row in rows]
+    if not sum(lengths):
+        return SparseRows()
+    return SparseRows(np.repeat(rows, lengths), np.concatenate([recommended[row] for row in rows]))
+
+
+def top_k(rows, columns, scores, k):
+    """ Return dict row -> columns with the k highest scores of the row.
+
+    rows and columns are sorted like keys returned by np.unique, columns
+    with equal scores stay in this order.
+    """
+    if not len(rows):
+        return {}
+    changes = np.r_[True, rows[1:] != rows[:-1]]
+    # one stable sort by row and then by score, cheaper than lexsort of both
+    span = scores.max() - scores.min() + 1
+    order = np.argsort((np.cumsum(changes) * span) + (scores.max() - scores), kind='stable')
+    columns = columns[order]
+    starts = np.flatnonzero(changes)
+    ends = np.r_[starts[1:], len(rows)]
+    # copies, so the arrays of the whole batch are not kept alive
+    return {int(rows[start]): columns[start:min(end, start + k)].copy()
+            for start, end in zip(starts, ends)}
+
+
+class Recommender:
+    """ Top-k books liked by followed users for every user """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self._lock = RLock()
+        self._follows = SparseRows()
+        self._followers = SparseRows()
+        self._likes = SparseRows()
+        self._top = SparseRows()
+        self._recommended = {}
+        self._stale = set()
+
+    def build(self, follows, likes):
+        """ Compute recommendations of all users from arrays of (user, friend)
+         and (user, book) pairs """
+        follows, likes = np.asarray(follows).reshape(-1, 2), np.asarray(likes).reshape(-1, 2)
+        with self._lock:
+            self._follows = SparseRows(follows[:, 0], follows[:, 1])
+            self._followers = SparseRows(follows[:, 1], follows[:, 0])
+            self._likes = SparseRows(likes[:, 0], likes[:, 1])
+            recommended = {}
+            for start in range(0, self._follows.size, USERS_BATCH):
+                users = np.arange(start, min(start + USERS_BATCH, self._follows.size))
+                recommended.update(self._compute(users))
+            self._top = _top_rows(recommended)
+            self._recommended = {}  # recomputed stale users, in front of self._top
+            self._stale = set()
+
+    def clear(self):
+        """ Forget all relationships and recommendations """
+        self.build(np.empty((0, 2), np.int64), np.empty((0, 2), np.int64))
+
+    def build_from_datasets(self):
+        """ Compute recommendations from friends.csv and likes.csv """
+        self.build(np.column_stack(datasets.columns('follows')),
+                   np.column_stack(datasets.columns('likes')))
+
+    def arrays(self):
+        """ Return dict name -> CSR array of relationships and recommendations,
+         stale recommendations are recomputed first """
+        with self._lock:
+            self.compact()
+            stale = np.array(sorted(self._stale), dtype=np.int64)
+            for start in range(0, len(stale), USERS_BATCH):
+                self._recommended.update(self._compute(stale[start:start + USERS_BATCH]))
+            self._stale = set()
+            top = self._top
+            if self._recommended:
+                top = _top_rows({**{user: self._row(user) for user in range(top.size)},
+                                 **self._recommended})
+            return {'%s.%s' % (name, part): getattr(matrix, part)
+                    for name, matrix in (('follows', self._follows), ('followers', self._followers),
+                                         ('likes', self._likes), ('top', top))
+                    for part in ('offsets', 'columns')}
+
+    def load_arrays(self, arrays):
+        """ Use dict of arrays returned by arrays() as they are, e.g. mapped from snapshot """
+        matrices = [SparseRows.from_csr(arrays[name + '.offsets'], arrays[name + '.columns'])
+                    for name in ('follows', 'followers', 'likes', 'top')]
+        with self._lock:
+            self._follows, self._followers, self._likes, self._top = matrices
+            self._recommended = {}
+            self._stale = set()
+
+    def _compute(self, users, k=None):
+        """ Return top-k books of users from rows of FOLLOWS x LIKES """
+        positions, friends = self._follows.gather(users)
+        friends_of = users[positions]
+        positions, books = self._likes.gather(friends)
+        pair_users = friends_of[positions]
+        positions, own_books = self._likes.gather(users)
+        own_users = users[positions]
+
+        width = int(max(books.max() if len(books) else 0,
+                        own_books.max() if len(own_books) else 0)) + 1
+        keys, scores = np.unique(pair_users * width + books, return_counts=True)
+        new = ~np.isin(keys, own_users * width + own_books)
+        recommended = top_k(keys[new] // width, keys[new] % width, scores[new], k or self.k)
+        return {int(user): recommended.get(int(user), np.empty(0, np.int64)) for user in users}
+
+    def compact(self):
+        """ Merge relationships added one by one into CSR arrays,
+         recommendations are kept and only stale ones are recomputed later """
+        with self._lock:
+            self._follows = self._follows.compacted()
+            self._followers = self._followers.compacted()
+            self._likes = self._likes.compacted()
+
+    def add_follow(self, user_id, friend_id):
+        """ Register (User)-[:FOLLOWS]->(User), recommendations of user become stale """
+        user_id, friend_id = int(user_id), int(friend_id)
+        with self._lock:
+            self._follows.add(user_id, friend_id)
+            self._followers.add(friend_id, user_id)
+            self._stale.add(user_id)
+
+    def add_like(self, user_id, book_id):
+        """ Register (User)-[:LIKES]->(Book),
+         recommendations of user and its followers become stale """
+        user_id, book_id = int(user_id), int(book_id)
+        with self._lock:
+            self._likes.add(user_id, book_id)
+            self._stale.add(user_id)
+            self._stale.update(self._followers.row(user_id).tolist())
+
+    def recommend(self, user_id, k=TOP_K):
+        """ Return list of ids of at most k books recommended to user """
+        user_id = int(user_id)
+        with self._lock:
+            if k > self.k:
+                return self._compute(np.array([user_id]), k)[user_id].tolist()
+            if user_id in self._stale or (user_id not in self._recommended
+                                          and user_id >= self._top.size):
+                self._stale.discard(user_id)
+                self._recommended.update(self._compute(np.array([user_id])))
+            return self._row(user_id)[:k].tolist()
+
+    def _row(self, user_id):
+        """ Return array of books recommended to user computed before """
+        if user_id in self._recommended:
+            return self._recommended[user_id]
+        return self._top.row(user_id)
+
+
+recommender = Recommender()
@@ -1,3 +1,122 @@
+import importlib
+import json
+from itertools import islice
+
+from flask import Response, jsonify, request, stream_with_context
+
+from app import app
+from app.instrumentation import instrumentation
+from app.passwords import VerifierBusy, verifier
+from app.snapshot import shared
+from app.utils import BATCH_SIZE, keyset_pages
+
+
+# relationships which can be created by /api/users/<id>/<relationship>/<id>
+RELATIONSHIPS = ('reads', 'follows', 'likes')
+
+
+def _models():
+    """ Module with models of database chosen by MODELS config,
+     its write-behind buffer is started with WRITE_BEHIND config and
+     in-process indexes are warm started from SNAPSHOT config """
+    models = importlib.import_module(app.config['MODELS'])
+    if app.config['SNAPSHOT']:
+        shared(app.config['SNAPSHOT'])
+    if app.config['WRITE_BEHIND'] and not models.write_behind.enabled:
+        models.write_behind.start()
+    return models
+
+
+def _stream_json(records):
+    """ Yield JSON array of records one record at a time """
+    yield '['
+    for position, record in enumerate(records):
+        yield (',' if position else '') + json.dumps(record)
+    yield ']'
+
+
+def _int_arg(name, minimum=None):
+    """ Return integer query argument or None if it is missing,
+     ValueError if it is not an integer or is less than minimum """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer' % name)
+    if minimum is not None and value < minimum:
+        raise ValueError('%s must be at least %d' % (name, minimum))
+    return value
+
+
+def _stream_pages(fetch_page, key):
+    """ Response with records of pages after ?after= id, at most ?limit= records,
+     400 for arguments which are not integers or negative limit """
+    try:
+        after = _int_arg('after')
+        limit = _int_arg('limit', minimum=0)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    records = keyset_pages(fetch_page, key, after, min(limit or BATCH_SIZE, BATCH_SIZE))
+    if limit is not None:
+        records = islice(records, limit)
+    return Response(stream_with_context(_stream_json(records)), mimetype='application/json')
+
+
+@app.route('/api/users')
+def api_users():
+    return _stream_pages(_models().User.users_page, lambda user: user['user_id'])
+
+
+@app.route('/api/books')
+def api_books():
+    return _stream_pages(_models().Book.books_page, lambda book: book['book_id'])
+
+
+def _session_user():
+    """ Return user id of "Authorization: Bearer <token>" session or None """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    return verifier.session(token.strip())
+
+
+@app.route('/api/users/<int:user_id>/<relationship>/<int:to_id>', methods=['POST'])
+def api_relationship(user_id, relationship, to_id):
+    """ Create relationship of user with book or another user, 401 without
+     session token from /api/login and 403 for relationships of other users """
+    session_user = _session_user()
+    if session_user is None:
+        return jsonify(error='missing or unknown session token'), 401, \
+            {'WWW-Authenticate': 'Bearer'}
+    if session_user != user_id:
+        return jsonify(error='session token of another user'), 403
+    if relationship not in RELATIONSHIPS:
+        return jsonify(error='unknown relationship %s' % relationship), 404
+    getattr(_models().User(user_id=user_id), relationship)(to_id)
+    return '', 204
+
+
+@app.route('/api/login', methods=['POST'])
+def api_login():
+    """ Session token of user, 503 when all password checks of the pool are taken """
+    username, password = request.form.get('username'), request.form.get('password')
+    try:
+        token = _models().User(username=username).login(password)
+    except VerifierBusy:
+        return jsonify(error='too many logins, try again'), 503, {'Retry-After': '1'}
+    if token is None:
+        return jsonify(error='invalid username or password'), 401
+    return jsonify(token=token)
+
+
+@app.route('/api/queries')
+def api_queries():
+    """ Queries issued by the process per model method """
+    return jsonify(instrumentation.totals.summary())
+
+
 # from flask import Flask, request, flash, url_for, redirect, render_template, session
 # #from app.neo4j_models import User, Book, Tag, add_tag_to_book, add_read_books
 # #from app.orientdb_models import User, Book, Tag, add_tag_to_book, add_read_books
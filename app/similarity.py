@@ -0,0 +1,338 @@
+"""Precomputed "more like this" books from tags.
+
+Every book is a sparse TF-IDF vector over tags: weight of tag is
+(1 + log count) * (log(books / books with tag) + 1), where count is how many
+times the tag was given to the book, and vectors have unit
+length, so dot product of two books is their cosine similarity. Products of
+a batch of books with all books go through inverted tag -> books arrays, so
+only books sharing a tag are compared, and their scores are summed per pair
+of books sharing a tag, never over all books. Top-k similar books of all
+books are computed by build() into CSR arrays. link_to_tag recomputes on the
+next request only the vectors of the tagged books, with weights of tags of
+the last build, and marks the book and books sharing the tag, whose similar
+books are recomputed and kept in a dict in front of the arrays; everything
+is rebuilt once REBUILD_FRACTION of edges were added. arrays() and
+load_arrays() save and restore all of it, e.g. in a snapshot, without
+computing anything.
+"""
+from threading import RLock
+
+import numpy as np
+
+from . import datasets
+
+TOP_K = 10
+# products of tag weights computed at once by build(), bound its memory
+PRODUCTS_BATCH = 1000000
+# scores of a batch are summed in dense rows over all books while they take
+# at most this many times its products, else only pairs of books sharing a tag
+DENSE_RATIO = 4
+# share of edges added since the last build above which all vectors and
+# similar books are rebuilt instead of updating vectors of tagged books
+REBUILD_FRACTION = 0.1
+
+
+def _csr(rows, *columns):
+    """ Return offsets of rows and columns sorted by rows """
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros((rows.max() + 2) if len(rows) else 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(offsets) - 1), out=offsets[1:])
+    return (offsets,) + tuple(column[order] for column in columns)
+
+
+def _gather(offsets, rows):
+    """ Return (positions in rows, indices of columns) of all columns of CSR rows """
+    size = len(offsets) - 1
+    starts = offsets[np.minimum(rows, size)]
+    lengths = offsets[np.minimum(rows + 1, size)] - starts
+    positions = np.repeat(np.arange(len(rows)), lengths)
+    indices = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return positions, indices
+
+
+def _idf(frequencies, books):
+    """ Return inverse document frequency of tags given to frequencies of books """
+    return np.log(books / frequencies) + 1
+
+
+def _top_dense(rows, columns, scores, size, width, k, excluded):
+    """ Return (rows, columns) of top-k columns of size rows, scores are summed
+     into dense rows of width columns, at most PRODUCTS_BATCH scores at once;
+     column excluded[row] is left out. rows are sorted """
+    k = min(k, width)
+    step = max(1, PRODUCTS_BATCH // width)
+    top_rows, top_columns = [], []
+    for start in range(0, size, step):
+        end = min(start + step, size)
+        first, last = np.searchsorted(rows, [start, end])
+        block = np.bincount((rows[first:last] - start) * width + columns[first:last],
+                            weights=scores[first:last],
+                            minlength=(end - start) * width).reshape(end - start, width)
+        block[np.arange(end - start), excluded[start:end]] = 0
+        # top-k of every row is selected in linear time and only then sorted
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.lexsort((top, -top_scores))
+        top = np.take_along_axis(top, order, axis=1)
+        kept = np.take_along_axis(top_scores, order, axis=1) > 0
+        top_rows.append(np.repeat(np.arange(start, end), kept.sum(axis=1)))
+        top_columns.append(top[kept])
+    return np.concatenate(top_rows), np.concatenate(top_columns)
+
+
+def _top_sparse(rows, columns, scores, width, k, excluded):
+    """ Return (rows, columns) of top-k columns of rows, scores are summed
+     only for distinct (row, column) pairs; column excluded[row] is left out """
+    kept = columns != excluded[rows]
+    rows, columns, scores = rows[kept], columns[kept], scores[kept]
+    keys, inverse = np.unique(rows * width + columns, return_inverse=True)
+    scores = np.bincount(inverse, weights=scores, minlength=len(keys))
+    rows, columns = keys // width, keys % width
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    kept = (ranks < k) & (scores > 0)
+    return rows[kept], columns[kept]
+
+
+def _rows(similar, size):
+    """ Return CSR offsets and columns of dict row -> array of columns of rows below size """
+    lengths = np.zeros(size, dtype=np.int64)
+    for row, columns in similar.items():
+        lengths[row] = len(columns)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    columns = [similar[row] for row in sorted(similar)]
+    return offsets, (np.concatenate(columns) if columns else np.empty(0, np.int64))
+
+
+class TagSimilarity:
+    """ Top-k books with the most similar tags for every book """
+
+    def __init__(self, k=TOP_K):
+        self.k = k
+        self._lock = RLock()
+        self.clear()
+
+    def build(self, books, tags, counts):
+        """ Compute similar books of all books from arrays of (book, tag, count) """
+        with self._lock:
+            self._edges = (np.asarray(books, dtype=np.int64),
+                           np.asarray(tags, dtype=np.int64),
+                           np.asarray(counts, dtype=np.float64))
+            self._vectorize()
+            self._reset_changes()
+            similar = {}
+            for books in self._batches():
+                similar.update(self._compute(books))
+            self._top_offsets, self._top_books = _rows(similar, len(self._book_offsets) - 1)
+
+    def _reset_changes(self):
+        self._pending = []
+        self._built_edges = len(self._edges[0])
+        self._counts = {}  # tagged book -> {tag: count}, its vector of the last build is stale
+        self._vectors = {}  # tagged book -> {tag: weight}
+        self._tagged = {}  # tag -> set of tagged books with the tag
+        self._rare_idf = None
+        self._similar = {}  # recomputed stale books, in front of the top arrays
+        self._stale = set()
+
+    def clear(self):
+        """ Forget all tags and similar books """
+        self.build(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0))
+
+    def build_from_datasets(self):
+        """ Compute similar books from tags_to_book.csv, repeated tags are counted """
+        books, tags = datasets.columns('tagged_to')
+        self.build(books, tags, np.ones(len(books)))
+
+    def arrays(self):
+        """ Return dict name -> array of edges, vectors and similar books,
+         tags added since the last build are built in first """
+        with self._lock:
+            if self._pending or self._counts:
+                self.build(*self._all_edges())
+            return {'edges.books': self._edges[0], 'edges.tags': self._edges[1],
+                    'edges.counts': self._edges[2],
+                    'book_offsets': self._book_offsets, 'book_tags': self._book_tags,
+                    'book_counts': self._book_counts, 'book_weights': self._book_weights,
+                    'tag_offsets': self._tag_offsets, 'tag_books': self._tag_books,
+                    'tag_weights': self._tag_weights, 'tag_idf': self._tag_idf,
+                    'top_offsets': self._top_offsets, 'top_books': self._top_books}
+
+    def load_arrays(self, arrays):
+        """ Use dict of arrays returned by arrays() as they are, e.g. mapped from snapshot """
+        with self._lock:
+            self._edges = (arrays['edges.books'], arrays['edges.tags'], arrays['edges.counts'])
+            self._book_offsets, self._book_tags, self._book_counts, self._book_weights = (
+                arrays['book_offsets'], arrays['book_tags'], arrays['book_counts'],
+                arrays['book_weights'])
+            self._tag_offsets, self._tag_books, self._tag_weights, self._tag_idf = (
+                arrays['tag_offsets'], arrays['tag_books'], arrays['tag_weights'],
+                arrays['tag_idf'])
+            self._top_offsets, self._top_books = arrays['top_offsets'], arrays['top_books']
+            self._reset_changes()
+
+    def _all_edges(self):
+        """ Return arrays of (book, tag, count) of the last build and of added tags """
+        books, tags, counts = self._edges
+        if not self._pending:
+            return books, tags, counts
+        pending = np.array(self._pending, dtype=np.int64)
+        return (np.concatenate([books, pending[:, 0]]), np.concatenate([tags, pending[:, 1]]),
+                np.concatenate([counts, np.ones(len(pending))]))
+
+    def _vectorize(self):
+        """ Compute unit TF-IDF vectors from edges as CSR arrays by book and by tag """
+        books, tags, counts = self._edges
+        # the same tag may be given to book more than once
+        width = int(tags.max()) + 1 if len(tags) else 1
+        keys, inverse = np.unique(books * width + tags, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys))
+        books, tags = keys // width, keys % width
+        self._tag_idf = _idf(np.maximum(np.bincount(tags), 1), len(np.unique(books)))
+        weights = (1 + np.log(np.maximum(counts, 1))) * self._tag_idf[tags]
+        weights /= np.sqrt(np.bincount(books, weights=weights ** 2))[books]
+        self._book_offsets, self._book_tags, self._book_counts, self._book_weights = _csr(
+            books, tags, counts, weights)
+        self._tag_offsets, self._tag_books, self._tag_weights = _csr(tags, books, weights)
+
+    def _update_vectors(self):
+        """ Recompute vectors of books tagged since the last build, with weights of
+         tags of the build; all vectors are rebuilt once many edges were added """
+        added = len(self._edges[0]) - self._built_edges + len(self._pending)
+        if added > REBUILD_FRACTION * self._built_edges:
+            self.build(*self._all_edges())
+            return
+        self._edges, pending, self._pending = self._all_edges(), self._pending, []
+        for book_id, tag_id in pending:
+            if book_id not in self._counts:
+                start, end = (self._book_offsets[book_id:book_id + 2]
+                              if book_id < len(self._book_offsets) - 1 else (0, 0))
+                self._counts[book_id] = dict(zip(self._book_tags[start:end].tolist(),
+                                                 self._book_counts[start:end].tolist()))
+            counts = self._counts[book_id]
+            counts[tag_id] = counts.get(tag_id, 0) + 1
+
+        if self._rare_idf is None:
+            # tags not given to any book at the last build are as rare as possible
+            self._rare_idf = float(_idf(1, max(1, np.count_nonzero(np.diff(self._book_offsets)))))
+        for book_id in set(book_id for book_id, _ in pending):
+            tags = np.fromiter(self._counts[book_id], dtype=np.int64)
+            counts = np.fromiter(self._counts[book_id].values(), dtype=np.float64)
+            known = tags < len(self._tag_idf)
+            idf = np.full(len(tags), self._rare_idf)
+            idf[known] = self._tag_idf[tags[known]]
+            weights = (1 + np.log(np.maximum(counts, 1))) * idf
+            weights /= np.sqrt((weights ** 2).sum())
+            self._vectors[book_id] = dict(zip(tags.tolist(), weights.tolist()))
+            for tag_id in self._vectors[book_id]:
+                self._tagged.setdefault(tag_id, set()).add(book_id)
+
+    def _batches(self):
+        """ Split tagged books into batches with about PRODUCTS_BATCH products each """
+        tagged = np.flatnonzero(np.diff(self._book_offsets))
+        if not len(tagged):
+            return []
+        books = np.repeat(np.arange(len(self._book_offsets) - 1), np.diff(self._book_offsets))
+        products = np.bincount(books, weights=np.diff(self._tag_offsets)[self._book_tags])
+        totals = np.cumsum(products[tagged])
+        return np.split(tagged, np.searchsorted(totals, np.arange(PRODUCTS_BATCH, totals[-1],
+                                                                  PRODUCTS_BATCH)))
+
+    def _query(self, books):
+        """ Return arrays of (position in books, tag, weight) of vectors of books """
+        if not self._vectors:
+            positions, entries = _gather(self._book_offsets, books)
+            return positions, self._book_tags[entries], self._book_weights[entries]
+        positions, tags, weights = [], [], []
+        for position, book_id in enumerate(books.tolist()):
+            if book_id in self._vectors:
+                vector = self._vectors[book_id]
+                book_tags, book_weights = list(vector), list(vector.values())
+            else:
+                _, entries = _gather(self._book_offsets, np.array([book_id]))
+                book_tags = self._book_tags[entries].tolist()
+                book_weights = self._book_weights[entries].tolist()
+            positions.extend([position] * len(book_tags))
+            tags.extend(book_tags)
+            weights.extend(book_weights)
+        return (np.array(positions, dtype=np.int64), np.array(tags, dtype=np.int64),
+                np.array(weights, dtype=np.float64))
+
+    def _compute(self, books, k=None):
+        """ Return top-k similar books of books from products of their vectors """
+        positions, tags, weights = self._query(books)
+        pairs, neighbours = _gather(self._tag_offsets, tags)
+        rows = positions[pairs]
+        candidates = self._tag_books[neighbours]
+        products = weights[pairs] * self._tag_weights[neighbours]
+        if self._vectors:
+            # vectors of tagged books replace theirs of the last build
+            kept = ~np.isin(candidates, np.fromiter(self._vectors, dtype=np.int64))
+            added = [(position, book_id, weight * self._vectors[book_id][tag_id])
+                     for position, tag_id, weight in zip(positions.tolist(), tags.tolist(),
+                                                         weights.tolist())
+                     for book_id in self._tagged.get(tag_id, ())]
+            added = np.array(added, dtype=np.float64).reshape(-1, 3)
+            rows = np.concatenate([rows[kept], added[:, 0].astype(np.int64)])
+            order = np.argsort(rows, kind='stable')
+            rows = rows[order]
+            candidates = np.concatenate([candidates[kept], added[:, 1].astype(np.int64)])[order]
+            products = np.concatenate([products[kept], added[:, 2]])[order]
+
+        k = k or self.k
+        width = max(len(self._book_offsets) - 1, max(self._vectors, default=-1) + 1,
+                    int(books.max()) + 1 if len(books) else 0)
+        if len(books) * width <= DENSE_RATIO * len(products):
+            rows, similar = _top_dense(rows, candidates, products, len(books), width, k, books)
+        else:
+            rows, similar = _top_sparse(rows, candidates, products, width, k, books)
+        bounds = np.searchsorted(rows, np.arange(len(books) + 1))
+        return {int(book): similar[bounds[position]:bounds[position + 1]]
+                for position, book in enumerate(books)}
+
+    def add(self, book_id, tag_id):
+        """ Register (Book)-[:TAGGED_TO]->(Tag),
+         similar books of the book and of books with the tag become stale """
+        book_id, tag_id = int(book_id), int(tag_id)
+        with self._lock:
+            self._pending.append((book_id, tag_id))
+            self._stale.add(book_id)
+            if tag_id < len(self._tag_offsets) - 1:
+                start, end = self._tag_offsets[tag_id], self._tag_offsets[tag_id + 1]
+                self._stale.update(self._tag_books[start:end].tolist())
+            self._stale.update(self._tagged.get(tag_id, ()))
+
+    def similar(self, book_id, k=TOP_K):
+        """ Return list of ids of at most k books most similar to book """
+        book_id = int(book_id)
+        with self._lock:
+            if self._pending:
+                self._update_vectors()
+            if k > self.k:
+                return self._compute(np.array([book_id]), k)[book_id].tolist()
+            if book_id in self._stale or (book_id not in self._similar
+                                          and book_id >= len(self._top_offsets) - 1):
+                self._stale.discard(book_id)
+                self._similar.update(self._compute(np.array([book_id])))
+            return self._row(book_id)[:k].tolist()
+
+    def _row(self, book_id):
+        """ Return array of similar books of book computed before """
+        if book_id in self._similar:
+            return self._similar[book_id]
+        return self._top_books[self._top_offsets[book_id]:self._top_offsets[book_id + 1]]
+
+    def nbytes(self):
+        """ Return bytes taken by vectors and precomputed similar books """
+        with self._lock:
+            arrays = (self._edges + (self._book_offsets, self._book_tags, self._book_counts,
+                                     self._book_weights, self._tag_offsets, self._tag_books,
+                                     self._tag_weights, self._tag_idf,
+                                     self._top_offsets, self._top_books))
+            return (sum(array.nbytes for array in arrays)
+                    + sum(similar.nbytes for similar in self._similar.values()))
+
+
+book_similarity = TagSimilarity()
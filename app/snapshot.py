@@ -0,0 +1,296 @@
+"""Binary snapshot of the graph for fast warm start.
+
+Snapshot is a directory of .npy arrays: sorted ids of users, books and tags,
+CSR arrays of every relationship over positions of these ids (offsets of
+source nodes, positions of target nodes), names of tags as UTF-8 bytes
+with offsets, and arrays of in-process indexes derived from them: reader
+counts, both directions of the tag index, vectors and top-k of similar
+books, and matrices and top-k of recommendations. manifest.json stores
+version of the format and shapes of the arrays. load() maps arrays
+read-only with mmap_mode='r' and warm_start() hands them to the indexes as
+they are: nothing is parsed, copied or recomputed, and processes mapping the
+same snapshot, e.g. forked Flask workers, share its pages in the page cache.
+Without a usable snapshot warm_start_or_build() builds the indexes from
+datasets instead.
+Snapshot is written into a new directory and the path, a symlink, is
+switched to it atomically, processes which mapped the old snapshot keep
+reading its files.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import warnings
+from operator import itemgetter
+
+import numpy as np
+
+from . import datasets
+from .popularity import reader_counts
+from .recommendations import Recommender, recommender
+from .similarity import TagSimilarity, book_similarity
+from .tag_index import TagIndex, tag_index
+from .utils import keyset_pages
+
+# version of layout of arrays, snapshots of other versions are rejected by load()
+SNAPSHOT_VERSION = 3
+SNAPSHOT_DIR = 'snapshot'
+MANIFEST = 'manifest.json'
+NODES = ('users', 'books', 'tags')
+# relationship -> (source nodes, target nodes)
+RELATIONSHIPS = datasets.EDGES
+# records fetched per query when snapshot is taken from models
+FETCH_SIZE = 10000
+# in-process indexes whose arrays are stored in snapshot, prefixes of their names
+DERIVED = ('tag_index', 'book_similarity', 'recommender')
+
+
+class SnapshotError(Exception):
+    """ Snapshot is missing, damaged or of another version """
+
+
+class GraphSnapshot:
+    """ Read-only arrays of node ids, relationships and tag names """
+
+    def __init__(self, arrays, source=None):
+        self.arrays = arrays  # name -> array, mapped from files by load()
+        self.source = source
+
+    def __len__(self):
+        """ Amount of relationships of all types """
+        return sum(len(self.arrays[relationship + '.targets']) for relationship in RELATIONSHIPS)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def ids(self, nodes):
+        """ Return sorted array of ids of nodes, e.g. users """
+        return self.arrays[nodes + '.ids']
+
+    def positions(self, nodes, ids):
+        """ Return array of positions of ids among ids of nodes, -1 for unknown ids """
+        keys = self.ids(nodes)
+        ids = np.asarray(ids, dtype=keys.dtype)
+        positions = np.searchsorted(keys, ids)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == ids[found]
+        return np.where(found, positions, -1)
+
+    def neighbours(self, relationship, node_id):
+        """ Return array of ids of targets of relationships of node """
+        source, target = RELATIONSHIPS[relationship]
+        position = self.positions(source, [node_id])[0]
+        if position < 0:
+            return self.ids(target)[:0]
+        offsets = self.arrays[relationship + '.offsets']
+        targets = self.arrays[relationship + '.targets'][offsets[position]:offsets[position + 1]]
+        return self.ids(target)[targets]
+
+    def pairs(self, relationship):
+        """ Return arrays of (from ids, to ids) of all relationships """
+        source, target = RELATIONSHIPS[relationship]
+        offsets = self.arrays[relationship + '.offsets']
+        return (np.repeat(self.ids(source), np.diff(offsets)),
+                self.ids(target)[self.arrays[relationship + '.targets']])
+
+    def derived(self, name):
+        """ Return dict of arrays of in-process index name, e.g. tag_index """
+        prefix = name + '.'
+        return {key[len(prefix):]: array for key, array in self.arrays.items()
+                if key.startswith(prefix)}
+
+    def tag_names(self):
+        """ Return (tag ids, list of names) """
+        data = self.arrays['tags.names']
+        offsets = self.arrays['tags.name_offsets']
+        names = [bytes(data[start:end]).decode('utf-8')
+                 for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+        return self.ids('tags'), names
+
+    def save(self, path=SNAPSHOT_DIR):
+        """ Write arrays and manifest to a new directory next to path and switch
+         symlink path to it, path always holds a whole snapshot """
+        path = path.rstrip(os.sep)
+        directory = '%s.%d-%d' % (path, time.time() * 1000, os.getpid())
+        os.makedirs(directory)
+        manifest = {'version': SNAPSHOT_VERSION, 'source': self.source, 'arrays': {}}
+        for name, array in sorted(self.arrays.items()):
+            np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(array))
+            manifest['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+        with open(os.path.join(directory, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+        old = os.path.realpath(path) if os.path.islink(path) else None
+        if os.path.isdir(path) and old is None:
+            # directory written by version 1 can not be replaced by symlink atomically
+            old = '%s.old-%d' % (path, os.getpid())
+            os.rename(path, old)
+        link = '%s.link-%d' % (path, os.getpid())
+        os.symlink(os.path.basename(directory), link)
+        os.replace(link, path)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+        return path
+
+
+def build(nodes, edges, tag_names):
+    """ Return snapshot of dict nodes -> array of ids, dict relationship ->
+     (from ids, to ids) and (tag ids, names); relationships with unknown nodes are dropped """
+    arrays = {}
+    for name in NODES:
+        arrays[name + '.ids'] = np.unique(np.asarray(nodes[name], dtype=np.int64))
+    snapshot = GraphSnapshot(arrays)
+    for relationship, (source, target) in RELATIONSHIPS.items():
+        from_ids, to_ids = edges[relationship]
+        sources = snapshot.positions(source, from_ids)
+        targets = snapshot.positions(target, to_ids)
+        known = (sources >= 0) & (targets >= 0)
+        sources, targets = sources[known], targets[known]
+        order = np.lexsort((targets, sources))
+        offsets = np.zeros(len(arrays[source + '.ids']) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(offsets) - 1), out=offsets[1:])
+        arrays[relationship + '.offsets'] = offsets
+        arrays[relationship + '.targets'] = targets[order].astype(np.int32)
+
+    names = dict(zip(np.asarray(tag_names[0]).tolist(), tag_names[1]))
+    encoded = [('' if names.get(tag_id) is None else str(names[tag_id])).encode('utf-8')
+               for tag_id in arrays['tags.ids'].tolist()]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=offsets[1:])
+    arrays['tags.names'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays['tags.name_offsets'] = offsets
+    _derive(snapshot)
+    return snapshot
+
+
+def _derive(snapshot):
+    """ Compute in-process indexes from relationships of snapshot and add their arrays """
+    arrays = snapshot.arrays
+    arrays['reader_counts.books'], arrays['reader_counts.readers'] = np.unique(
+        snapshot.pairs('reads')[1], return_counts=True)
+    books, tags = snapshot.pairs('tagged_to')
+    index = TagIndex()
+    index.build(books, tags, names=snapshot.tag_names())
+    similarity = TagSimilarity()
+    similarity.build(books, tags, np.ones(len(books)))
+    recommendations = Recommender()
+    recommendations.build(np.column_stack(snapshot.pairs('follows')),
+                          np.column_stack(snapshot.pairs('likes')))
+    for name, derived in zip(DERIVED, (index, similarity, recommendations)):
+        arrays.update(('%s.%s' % (name, key), array) for key, array in derived.arrays().items())
+
+
+def from_datasets():
+    """ Return snapshot of the graph in datasets """
+    nodes = {name: datasets.columns(name)[0] for name in NODES}
+    edges = {relationship: datasets.columns(relationship) for relationship in RELATIONSHIPS}
+    snapshot = build(nodes, edges, datasets.columns('tags'))
+    snapshot.source = 'datasets'
+    return snapshot
+
+
+def _ids(records, key):
+    return np.fromiter((record[key] for record in records), dtype=np.int64)
+
+
+def from_models(models, fetch_size=FETCH_SIZE):
+    """ Return snapshot of the graph stored by models module, nodes and
+     relationships are fetched fetch_size per query """
+    User, Book, Tag = models.User, models.Book, models.Tag
+    nodes = {'users': _ids(keyset_pages(User.users_page, itemgetter('user_id'),
+                                        page_size=fetch_size), 'user_id'),
+             'books': _ids(keyset_pages(Book.books_page, itemgetter('book_id'),
+                                        page_size=fetch_size), 'book_id')}
+    tags = list(keyset_pages(Tag.tags_page, itemgetter('tag_id'), page_size=fetch_size))
+    nodes['tags'] = _ids(tags, 'tag_id')
+    edges = {}
+    for relationship in RELATIONSHIPS:
+        pairs = np.fromiter((key for pair in models.relationships(relationship, fetch_size)
+                             for key in pair), dtype=np.int64).reshape(-1, 2)
+        edges[relationship] = pairs[:, 0], pairs[:, 1]
+    snapshot = build(nodes, edges, (nodes['tags'], [tag['tag_name'] for tag in tags]))
+    snapshot.source = models.__name__
+    return snapshot
+
+
+def load(path=SNAPSHOT_DIR, mmap_mode='r'):
+    """ Return snapshot of directory path with arrays mapped to memory """
+    while True:
+        # all files are read from one directory, even if path is switched meanwhile
+        directory = os.path.realpath(path)
+        try:
+            return _load(directory, mmap_mode)
+        except SnapshotError:
+            if os.path.realpath(path) == directory:
+                raise
+
+
+def _load(directory, mmap_mode):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as error:
+        raise SnapshotError('no snapshot in %s: %s' % (directory, error))
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError('snapshot %s has version %s, expected %d'
+                            % (directory, manifest.get('version'), SNAPSHOT_VERSION))
+    arrays = {}
+    for name, spec in manifest['arrays'].items():
+        try:
+            array = np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+        except OSError as error:
+            raise SnapshotError('array %s of snapshot %s: %s' % (name, directory, error))
+        if array.dtype.str != spec['dtype'] or list(array.shape) != spec['shape']:
+            raise SnapshotError('array %s of snapshot %s does not match manifest'
+                                % (name, directory))
+        arrays[name] = array
+    return GraphSnapshot(arrays, manifest.get('source'))
+
+
+def warm_start(snapshot):
+    """ Point reader counts, tag index, similar books and recommendations to arrays
+     of snapshot instead of building them from datasets or queries of the database """
+    reader_counts.clear()
+    reader_counts.load_counts(snapshot.arrays['reader_counts.books'],
+                              snapshot.arrays['reader_counts.readers'])
+    tag_index.load_arrays(snapshot.derived('tag_index'))
+    book_similarity.load_arrays(snapshot.derived('book_similarity'))
+    recommender.load_arrays(snapshot.derived('recommender'))
+
+
+def build_from_datasets():
+    """ Build reader counts, tag index, similar books and recommendations from datasets """
+    reader_counts.clear()
+    reader_counts.load_from_datasets()
+    tag_index.build_from_datasets()
+    book_similarity.build_from_datasets()
+    recommender.build_from_datasets()
+
+
+def warm_start_or_build(path=SNAPSHOT_DIR):
+    """ Warm start in-process indexes from snapshot of path and return it,
+     build them from datasets and return None if there is no usable snapshot """
+    try:
+        snapshot = load(path)
+    except SnapshotError as error:
+        warnings.warn('%s, in-process indexes are built from datasets' % error)
+        build_from_datasets()
+        return None
+    warm_start(snapshot)
+    return snapshot
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(path=SNAPSHOT_DIR):
+    """ Return snapshot of path mapped once per process, in-process indexes
+     are warm started from it on first call; None if they were built from datasets """
+    path = os.path.abspath(path)
+    with _shared_lock:
+        if path not in _shared:
+            _shared[path] = warm_start_or_build(path)
+        return _shared[path]
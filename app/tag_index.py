@@ -0,0 +1,186 @@
+"""Inverted index of tags kept in process.
+
+TAGGED_TO relationships are stored in both directions as CSR arrays over book
+and tag ids: tags of a book and books of a tag are slices of one array, so
+listing them does not touch the database. Relationships created later by
+Book.link_to_tag are appended to small lists, which compact() merges into
+the arrays. Tag names are kept in an array indexed by tag id, names loaded
+from a snapshot stay UTF-8 bytes with offsets by tag id and are decoded
+only when a book's tags are listed. The index is
+complete only when it was built from all relationships, e.g. datasets or a
+snapshot; otherwise models query the database instead.
+"""
+from collections import defaultdict
+from functools import reduce
+from threading import RLock
+
+import numpy as np
+
+from . import datasets
+
+
+class Adjacency:
+    """ Ids of neighbours of every id: CSR arrays plus neighbours added later """
+
+    def __init__(self, keys=(), values=()):
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.values = values[order]
+        self.offsets = np.zeros((keys.max() + 2) if len(keys) else 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(self.offsets) - 1), out=self.offsets[1:])
+        self.added = defaultdict(list)
+
+    @classmethod
+    def from_csr(cls, offsets, values):
+        """ Return adjacency reading CSR arrays as they are, e.g. mapped from snapshot """
+        adjacency = cls.__new__(cls)
+        adjacency.offsets, adjacency.values = offsets, values
+        adjacency.added = defaultdict(list)
+        return adjacency
+
+    def __len__(self):
+        return len(self.values) + sum(len(values) for values in self.added.values())
+
+    def get(self, key):
+        """ Return array of neighbours of key """
+        if 0 <= key < len(self.offsets) - 1:
+            values = self.values[self.offsets[key]:self.offsets[key + 1]]
+        else:
+            values = self.values[:0]
+        if key in self.added:
+            values = np.concatenate([values, np.array(self.added[key], dtype=np.int64)])
+        return values
+
+    def add(self, key, value):
+        self.added[key].append(value)
+
+    def pairs(self):
+        """ Return arrays of (key, value) of all neighbours """
+        keys = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        added = [(key, value) for key, values in self.added.items() for value in values]
+        if not added:
+            return keys, self.values
+        added = np.array(added, dtype=np.int64)
+        return np.concatenate([keys, added[:, 0]]), np.concatenate([self.values, added[:, 1]])
+
+
+class TagIndex:
+    """ book_id -> tag ids, tag_id -> book ids and tag_id -> tag name """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.clear()
+
+    def __len__(self):
+        """ Amount of indexed (Book)-[:TAGGED_TO]->(Tag) relationships """
+        return len(self._tags)
+
+    def build(self, book_ids, tag_ids, names=None, complete=True):
+        """ Index arrays of book and tag ids of relationships
+         and optionally names of tags as (tag ids, names) arrays;
+         complete tells whether these are all relationships of the graph """
+        with self._lock:
+            self.complete = complete
+            self._tags = Adjacency(book_ids, tag_ids)
+            self._books = Adjacency(tag_ids, book_ids)
+            if names is not None:
+                ids, values = names
+                self._names = np.empty(int(np.max(ids)) + 1 if len(ids) else 0, dtype=object)
+                self._names[np.asarray(ids, dtype=np.int64)] = values
+                self._name_bytes = np.empty(0, np.uint8), np.zeros(1, np.int64)
+
+    def clear(self):
+        """ Forget all relationships and names of tags """
+        self.build(np.empty(0, np.int64), np.empty(0, np.int64), (np.empty(0, np.int64), []),
+                   complete=False)
+
+    def build_from_datasets(self):
+        """ Index tags_to_book.csv and tags.csv """
+        self.build(*datasets.columns('tagged_to'), names=datasets.columns('tags'))
+
+    def arrays(self):
+        """ Return dict name -> CSR array of both directions, relationships added
+         one by one included, and UTF-8 names of tags with offsets by tag id """
+        with self._lock:
+            tags = self._tags if not self._tags.added else Adjacency(*self._tags.pairs())
+            books = self._books if not self._books.added else Adjacency(*self._books.pairs())
+            size = max(len(self._names), len(self._name_bytes[1]) - 1)
+            encoded = [(self._name(tag_id) or '').encode('utf-8') for tag_id in range(size)]
+            name_offsets = np.zeros(size + 1, dtype=np.int64)
+            np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+            return {'tags.offsets': tags.offsets, 'tags.values': tags.values,
+                    'books.offsets': books.offsets, 'books.values': books.values,
+                    'names': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                    'name_offsets': name_offsets}
+
+    def load_arrays(self, arrays):
+        """ Index all relationships and names of dict of arrays returned by arrays(),
+         which are read in place, e.g. mapped from snapshot """
+        with self._lock:
+            self.build(np.empty(0, np.int64), np.empty(0, np.int64), (np.empty(0, np.int64), []))
+            self._tags = Adjacency.from_csr(arrays['tags.offsets'], arrays['tags.values'])
+            self._books = Adjacency.from_csr(arrays['books.offsets'], arrays['books.values'])
+            self._name_bytes = arrays['names'], arrays['name_offsets']
+
+    def _name(self, tag_id):
+        """ Return name of tag registered in process or loaded as bytes, None if unknown """
+        if tag_id < len(self._names) and self._names[tag_id] is not None:
+            return self._names[tag_id]
+        data, offsets = self._name_bytes
+        if tag_id < len(offsets) - 1 and offsets[tag_id + 1] > offsets[tag_id]:
+            return bytes(data[offsets[tag_id]:offsets[tag_id + 1]]).decode('utf-8')
+        return None
+
+    def compact(self):
+        """ Merge relationships added one by one into CSR arrays """
+        with self._lock:
+            if self._tags.added:
+                self.build(*self._tags.pairs(), complete=self.complete)
+
+    def add(self, book_id, tag_id):
+        """ Register (Book)-[:TAGGED_TO]->(Tag) """
+        book_id, tag_id = int(book_id), int(tag_id)
+        with self._lock:
+            self._tags.add(book_id, tag_id)
+            self._books.add(tag_id, book_id)
+
+    def name(self, tag_id, tag_name):
+        """ Register name of tag """
+        tag_id = int(tag_id)
+        with self._lock:
+            if tag_id >= len(self._names):
+                # grown geometrically, tags are usually named one by one in order of ids
+                names = np.empty(max(tag_id + 1, 2 * len(self._names)), dtype=object)
+                names[:len(self._names)] = self._names
+                self._names = names
+            self._names[tag_id] = tag_name
+
+    def name_rows(self, rows):
+        """ Yield dicts of tag properties, registering names of tags """
+        for row in rows:
+            self.name(row['tag_id'], row['tag_name'])
+            yield row
+
+    def tags(self, book_id):
+        """ Return array of ids of tags of book """
+        with self._lock:
+            return self._tags.get(int(book_id))
+
+    def tag_names(self, book_id):
+        """ Return list of names of tags of book """
+        with self._lock:
+            tags = self._tags.get(int(book_id))
+            names = (self._name(tag_id) for tag_id in tags.tolist())
+            return [name for name in names if name is not None]
+
+    def books(self, *tag_ids):
+        """ Return sorted array of ids of books tagged with all tags """
+        with self._lock:
+            books = sorted((np.unique(self._books.get(int(tag_id))) for tag_id in tag_ids), key=len)
+        if not books:
+            return np.empty(0, np.int64)
+        return reduce(lambda left, right: np.intersect1d(left, right, assume_unique=True), books)
+
+
+tag_index = TagIndex()
@@ -0,0 +1,62 @@
+"""Helpers shared by the models of all databases"""
+from contextlib import contextmanager
+from itertools import islice
+
+BATCH_SIZE = 1000
+
+# backend -> module with its User, Book and Tag models, imported by the scripts on demand;
+# backend is also the column in results.csv
+BACKENDS = {
+    'orientdb': 'app.orientdb_models',
+    'neo4j': 'app.neo4j_models',
+    'arangodb': 'app.arango_models',
+    'memory': 'app.memory_models',
+}
+
+
+class IndexUpdates:
+    """ Whether bulk writes of database models update in-process indexes:
+     reader counts, tag index, similar books and recommendations """
+
+    def __init__(self):
+        self.enabled = True
+
+    @contextmanager
+    def paused(self):
+        """ Bulk writes inside the block leave in-process indexes alone,
+         they are then built from the database, datasets or a snapshot """
+        enabled, self.enabled = self.enabled, False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+
+
+index_updates = IndexUpdates()
+
+
+def batches(rows, batch_size=BATCH_SIZE):
+    """ Split iterable of rows into lists of batch_size length """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered(ids, found):
+    """ Return (values of found dict in order of ids, ids missing in found) """
+    return [found[key] for key in ids if key in found], [key for key in ids if key not in found]
+
+
+def keyset_pages(fetch_page, key, after=None, page_size=BATCH_SIZE):
+    """ Yield records of consecutive pages of fetch_page(after, limit),
+     every page starts after key of the last record of the previous one """
+    while True:
+        page = fetch_page(after, page_size)
+        for record in page:
+            yield record
+        if len(page) < page_size:
+            return
+        after = key(page[-1])
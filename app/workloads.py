@@ -0,0 +1,413 @@
+"""Read workloads measuring latency of queries under concurrent load.
+
+Keys of queries are drawn from the datasets with Zipfian distribution:
+the most read books and most followed users are requested most often.
+Mixed workloads are open-loop: operations arrive at a target rate whatever
+the latency of previous ones, and latency is measured from the scheduled
+arrival, so queueing behind slow operations is not hidden. Runners of
+workloads return (name, value) results of throughput and latency percentiles.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import numpy as np
+
+from . import benchmark, datasets
+from .instrumentation import LATENCY_BUCKETS, instrumentation
+from .passwords import PasswordVerifier
+from .pool import release_connections
+from .profiling import PhaseProfile
+from .recommendations import recommender
+
+ZIPF_EXPONENT = 1.1
+REQUESTS = 1000
+CONCURRENCY = 8
+# books fetched at once by find_many, e.g. one page of a list
+PAGE_SIZE = 20
+# operation -> weight in mixed workload, book and tag reads dominate like in the web app
+MIX = {
+    'verify_password': 5,
+    'follows': 5,
+    'likes': 10,
+    'reads': 10,
+    'linked_tags': 20,
+    'similar_books': 10,
+    'tag_books': 10,
+    'find_book_by_id': 20,
+    'most_popular_books': 10,
+}
+# operations per second and seconds of mixed workload
+RATE = 100
+DURATION = 10
+# users whose passwords are hashed for login workload
+LOGIN_USERS = 16
+
+
+def by_popularity(ids, references):
+    """ Return list of ids ordered from the most to the least referenced """
+    counts = Counter(np.asarray(references).tolist())
+    return sorted(np.asarray(ids).tolist(), key=lambda key: -counts[key])
+
+
+def zipf_sample(keys, size, exponent=ZIPF_EXPONENT, random=None):
+    """ Sample keys, i-th key is chosen with probability proportional to 1 / i ** exponent """
+    random = random or np.random.RandomState()
+    weights = np.arange(1, len(keys) + 1, dtype=float) ** -exponent
+    return [keys[i] for i in random.choice(len(keys), size=size, p=weights / weights.sum())]
+
+
+def read_queries(models, requests=REQUESTS, seed=None):
+    """ Return dict of query name -> list of calls with Zipf distributed keys """
+    random = np.random.RandomState(seed)
+    User, Book, Tag = models.User, models.Book, models.Tag
+
+    book_ids = datasets.columns('books')[0]
+    _, read_books = datasets.columns('reads')
+    _, liked_books = datasets.columns('likes')
+    books = by_popularity(book_ids, np.concatenate([read_books, liked_books]))
+
+    user_ids, usernames, passwords = datasets.columns('users')
+    _, friends = datasets.columns('follows')
+    credentials = dict(zip(user_ids.tolist(), zip(usernames, passwords)))
+    users = [credentials[user_id] for user_id in by_popularity(user_ids, friends)]
+
+    _, tagged_tags = datasets.columns('tagged_to')
+    tags = by_popularity(np.unique(tagged_tags), tagged_tags)
+
+    def linked_tags(book_id):
+        return lambda: Book(book_id=book_id).linked_tags()
+
+    def similar_books(book_id):
+        return lambda: Book(book_id=book_id).similar_books()
+
+    def tag_books(tag_id):
+        return lambda: Tag(tag_id=tag_id).books()
+
+    def books_with_tags(tag_ids):
+        return lambda: Tag.books_with_tags(tag_ids)
+
+    def all_users():
+        return list(User.users())
+
+    def books_page(after):
+        return lambda: Book.books_page(after=after)
+
+    def find(username):
+        return lambda: User(username=username).find()
+
+    def find_user_by_id(user_id):
+        return lambda: User(user_id=user_id).find_by_id()
+
+    def find_book_by_id(book_id):
+        return lambda: Book(book_id=book_id).find_by_id()
+
+    def find_many_books(book_ids):
+        return lambda: Book.find_many(book_ids)
+
+    def verify_password(username, password):
+        # users are loaded with hashes of passwords, rejection means only IPC was measured
+        def call():
+            if not User(username=username).verify_password(password):
+                raise ValueError('password of %s rejected' % username)
+        return call
+
+    return {
+        'linked_tags': [linked_tags(book_id)
+                        for book_id in zipf_sample(books, requests, random=random)],
+        'similar_books': [similar_books(book_id)
+                          for book_id in zipf_sample(books, requests, random=random)],
+        'tag_books': [tag_books(tag_id) for tag_id in zipf_sample(tags, requests, random=random)],
+        'books_with_tags': [books_with_tags(tag_ids)
+                            for tag_ids in zip(zipf_sample(tags, requests, random=random),
+                                               zipf_sample(tags, requests, random=random))],
+        'most_popular_books': [Book.most_popular_books] * requests,
+        'most_popular_book_ids': [Book.most_popular_book_ids] * requests,
+        'users': [all_users] * requests,
+        'books_page': [books_page(book_id)
+                       for book_id in zipf_sample(books, requests, random=random)],
+        'find': [find(username) for username, _ in zipf_sample(users, requests, random=random)],
+        'find_user_by_id': [find_user_by_id(user_id) for user_id in
+                            zipf_sample(by_popularity(user_ids, friends), requests, random=random)],
+        'find_book_by_id': [find_book_by_id(book_id)
+                            for book_id in zipf_sample(books, requests, random=random)],
+        'find_many_books': [find_many_books(zipf_sample(books, PAGE_SIZE, random=random))
+                            for _ in range(requests)],
+        'verify_password': [verify_password(username, password)
+                            for username, password in zipf_sample(users, requests, random=random)],
+    }
+
+
+def recommendation_queries(models, requests=REQUESTS, seed=None):
+    """ Return dict of precomputed and database recommendations -> list of calls
+     for the same Zipf distributed users """
+    random = np.random.RandomState(seed)
+    User = models.User
+    user_ids = datasets.columns('users')[0]
+    _, friends = datasets.columns('follows')
+    users = zipf_sample(by_popularity(user_ids, friends), requests, random=random)
+
+    def recommended_books(user_id):
+        return lambda: User(user_id=user_id).recommended_books()
+
+    def recommended_books_query(user_id):
+        return lambda: User(user_id=user_id).recommended_books_query()
+
+    return {
+        'recommended_books': [recommended_books(user_id) for user_id in users],
+        'recommended_books_query': [recommended_books_query(user_id) for user_id in users],
+    }
+
+
+def write_queries(models, requests=REQUESTS, seed=None):
+    """ Return dict of relationship -> list of calls creating it
+     between Zipf distributed users and books or users """
+    random = np.random.RandomState(seed)
+    User = models.User
+    book_ids = datasets.columns('books')[0]
+    user_ids = datasets.columns('users')[0]
+    _, liked_books = datasets.columns('likes')
+    _, friends = datasets.columns('follows')
+    books = by_popularity(book_ids, liked_books)
+    users = by_popularity(user_ids, friends)
+
+    def write(method, user_id, to_id):
+        return lambda: getattr(User(user_id=user_id), method)(to_id)
+
+    return {method: [write(method, user_id, to_id)
+                     for user_id, to_id in zip(zipf_sample(users, requests, random=random),
+                                               zipf_sample(targets, requests, random=random))]
+            for method, targets in (('likes', books), ('reads', books), ('follows', users))}
+
+
+def login_queries(verifier, credentials, requests=REQUESTS, seed=None):
+    """ Return list of calls checking Zipf distributed (password, hash) credentials
+     with verifier, rejected password is an error """
+    random = np.random.RandomState(seed)
+
+    def login(password, stored_hash):
+        def call():
+            if not verifier.verify(password, stored_hash):
+                raise ValueError('password rejected')
+        return call
+
+    return [login(password, stored_hash)
+            for password, stored_hash in zipf_sample(credentials, requests, random=random)]
+
+
+def parse_mix(text):
+    """ Return dict operation -> weight from "operation=weight,..." """
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        mix[operation.strip()] = float(weight or 1)
+    return mix
+
+
+def mixed_queries(models, mix=None, requests=REQUESTS, seed=None):
+    """ Return list of requests (operation, call) pairs, operations are drawn
+     with probabilities proportional to weights of mix """
+    mix = mix or MIX
+    random = np.random.RandomState(seed)
+    queries = read_queries(models, requests, seed)
+    queries.update(write_queries(models, requests, seed))
+    unknown = set(mix) - set(queries)
+    if unknown:
+        raise ValueError('unknown operations %s, choose from %s'
+                         % (', '.join(sorted(unknown)), ', '.join(sorted(queries))))
+    operations = sorted(mix)
+    weights = np.array([mix[operation] for operation in operations], dtype=float)
+    chosen = random.choice(len(operations), size=requests, p=weights / weights.sum())
+    return [(operations[index], queries[operations[index]][position])
+            for position, index in enumerate(chosen)]
+
+
+def _timed(call):
+    """ Return latency of call in seconds and if it raised, connections of the
+     thread go back to the pools after every call like after a web request """
+    time_start = perf_counter()
+    try:
+        call()
+        failed = False
+    except Exception:
+        failed = True
+    finally:
+        release_connections()
+    return perf_counter() - time_start, failed
+
+
+def run_workload(calls, concurrency=CONCURRENCY):
+    """ Run calls with pool of threads, return statistics of latencies and throughput """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        time_start = perf_counter()
+        results = list(executor.map(_timed, calls))
+        wall_time = perf_counter() - time_start
+    latencies = np.array([latency for latency, _ in results])
+    return {'requests': len(results),
+            'errors': sum(failed for _, failed in results),
+            'throughput': len(results) / wall_time if wall_time else 0.0,
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'p999': float(np.percentile(latencies, 99.9))}
+
+
+def _timed_from(call, scheduled):
+    """ Return latency of call from its scheduled start, its service time and if it raised """
+    time_start = perf_counter()
+    latency, failed = _timed(call)
+    return time_start + latency - scheduled, latency, failed
+
+
+def run_open_loop(operations, rate=RATE, concurrency=CONCURRENCY, seed=None):
+    """ Start (operation, call) pairs at Poisson arrivals of rate per second with pool
+     of threads, return statistics of every operation and of all of them """
+    random = np.random.RandomState(seed)
+    arrivals = np.cumsum(random.exponential(1.0 / rate, size=len(operations)))
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        time_start = perf_counter()
+        for (operation, call), arrival in zip(operations, arrivals):
+            scheduled = time_start + arrival
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            futures.append((operation, executor.submit(_timed_from, call, scheduled)))
+        results = [(operation, future.result()) for operation, future in futures]
+        wall_time = perf_counter() - time_start
+
+    stats = {}
+    for operation in sorted(set(operation for operation, _ in results)) + ['all']:
+        selected = [result for name, result in results if operation in (name, 'all')]
+        latencies = np.array([latency for latency, _, _ in selected])
+        stats[operation] = {
+            'requests': len(selected),
+            'errors': sum(failed for _, _, failed in selected),
+            'throughput': len(selected) / wall_time if wall_time else 0.0,
+            'service': float(np.mean([service for _, service, _ in selected])),
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'p999': float(np.percentile(latencies, 99.9)),
+            'histogram': np.histogram(latencies, bins=[0.0] + list(LATENCY_BUCKETS)
+                                      + [np.inf])[0].tolist()}
+    stats['all']['offered'] = float(rate)
+    return stats
+
+
+def report_histogram(histogram):
+    """ Return latency histogram as "<=bound: count" pairs of non-empty buckets """
+    bounds = ['<=%gms' % (bound * 1000) for bound in LATENCY_BUCKETS]
+    bounds.append('>%gms' % (LATENCY_BUCKETS[-1] * 1000))
+    return ', '.join('%s: %d' % (bound, count) for bound, count in zip(bounds, histogram) if count)
+
+
+def report(name, stats):
+    """ Return one line summary of workload statistics """
+    return ('%s: %.1f requests/s, p50 %.2f ms, p99 %.2f ms, p999 %.2f ms, %d errors of %d'
+            % (name, stats['throughput'], stats['p50'] * 1000, stats['p99'] * 1000,
+               stats['p999'] * 1000, stats['errors'], stats['requests']))
+
+
+def results(name, stats):
+    """ Return (name, value) results of throughput and latency percentiles of workload """
+    return [('%s[%s]' % (name, key), stats[key]) for key in ('throughput', 'p50', 'p99', 'p999')]
+
+
+def run_read_workload(models, backend, requests=REQUESTS, concurrency=CONCURRENCY,
+                      recommendations=False, index_modes=(True,), profile_dir=None):
+    """ Measure latency and throughput of read queries on loaded graph, once for every
+     mode of indexes, profiled into profile_dir if given, return results """
+    queries = read_queries(models, requests)
+    workload_results = []
+    if recommendations:
+        stats = benchmark.Benchmark(backend, warmup=0, repeat=1).run(
+            'build_recommendations', recommender.build_from_datasets)
+        print(benchmark.report('build_recommendations', stats))
+        workload_results.append(('build_recommendations', stats['median']))
+        queries = recommendation_queries(models, requests)
+    for indexes in index_modes:
+        models.create_schema(indexes)
+        for query, calls in queries.items():
+            models.query_cache.clear()
+            name = 'read_%s[concurrency=%d]%s' % (query, concurrency,
+                                                  '' if indexes else '[indexes=off]')
+            run = lambda: run_workload(calls, concurrency)
+            if profile_dir:
+                profile = PhaseProfile(name)
+                run = profile.wrap(run)
+            with instrumentation.phase(name) as query_stats:
+                stats = run()
+            print(report(name, stats))
+            if models.query_cache.hits or models.query_cache.misses:
+                benchmark.report_cache(name, models.query_cache, 'query')
+            benchmark.report_queries(query_stats)
+            if profile_dir:
+                workload_results += benchmark.report_profile(profile, profile_dir)
+            workload_results += results(name, stats)
+    return workload_results
+
+
+def run_mixed_workload(models, mix=None, rate=RATE, duration=DURATION, concurrency=CONCURRENCY):
+    """ Measure latency of every operation of mix arriving at rate per second for
+     duration seconds on loaded graph, return results; relationships written stay
+     in the graph """
+    models.create_schema()
+    operations = mixed_queries(models, mix, max(int(rate * duration), 1))
+    name = 'mixed[rate=%g][concurrency=%d]' % (rate, concurrency)
+    with instrumentation.phase(name) as query_stats:
+        stats = run_open_loop(operations, rate, concurrency)
+    workload_results = []
+    for operation, operation_stats in sorted(stats.items()):
+        operation_name = '%s[%s]' % (name, operation)
+        print(report(operation_name, operation_stats))
+        print('  service %.2f ms, latency %s' % (operation_stats['service'] * 1000,
+                                                 report_histogram(operation_stats['histogram'])))
+        workload_results += results(operation_name, operation_stats)
+    print('offered %.1f requests/s, achieved %.1f requests/s'
+          % (stats['all']['offered'], stats['all']['throughput']))
+    benchmark.report_queries(query_stats)
+    return workload_results
+
+
+def run_write_workload(models, reset, requests=REQUESTS, concurrency=CONCURRENCY):
+    """ Measure latency of requests creating relationships written at once and with
+     write-behind buffer, return results; reset is called before both and leaves
+     graph with users and books only """
+    write_behind = models.write_behind
+    workload_results = []
+    for buffered in (False, True):
+        reset()
+        if buffered:
+            write_behind.start()
+        for query, calls in write_queries(models, requests).items():
+            name = 'write_%s[write_behind=%s][concurrency=%d]' \
+                   % (query, 'on' if buffered else 'off', concurrency)
+            stats = run_workload(calls, concurrency)
+            print(report(name, stats))
+            workload_results += results(name, stats)
+        if buffered:
+            time_start = perf_counter()
+            write_behind.close()
+            print('write-behind: %d relationships in %d flushes, %.4f s to write the rest at close'
+                  % (write_behind.written, write_behind.flushes, perf_counter() - time_start))
+    return workload_results
+
+
+def run_login_workload(pool_sizes, requests=REQUESTS, concurrency=CONCURRENCY, rounds=None):
+    """ Measure logins per second of password verifier for every size of its pool,
+     return results; concurrency is raised to the pool size """
+    passwords = datasets.columns('users')[2][:LOGIN_USERS].tolist()
+    hasher = PasswordVerifier(workers=max(pool_sizes))
+    credentials = list(zip(passwords, hasher.hash_many(passwords, rounds)))
+    hasher.shutdown()
+    workload_results = []
+    for size in pool_sizes:
+        verifier = PasswordVerifier(workers=size)
+        # worker processes are started before measuring
+        verifier.hash_many(['warmup'] * size, rounds=1000)
+        threads = max(concurrency, size)
+        stats = run_workload(login_queries(verifier, credentials, requests), threads)
+        verifier.shutdown()
+        name = 'login[pool=%d][concurrency=%d]' % (size, threads)
+        print(report(name, stats))
+        workload_results += results(name, stats)
+    return workload_results
@@ -0,0 +1,143 @@
+"""Write-behind buffer of relationships created by requests.
+
+When started, User.reads, User.follows and User.likes only append the
+relationship to a buffer and return. A background thread writes buffered
+relationships with the *_many methods of the models when flush_size of them
+are waiting or every interval seconds, so latency of requests does not
+include writes to the database. Reads of a user first write relationships
+buffered for the user (read-your-writes), close() writes the rest and runs
+at exit of the process.
+"""
+import atexit
+import threading
+import warnings
+
+from .pool import release_connections
+
+FLUSH_SIZE = 500
+# seconds between writes of a buffer which is not full
+FLUSH_INTERVAL = 0.5
+
+
+class WriteBehind:
+    """ Buffer of (from_id, to_id) pairs of every relationship written in batches """
+
+    def __init__(self, writers, flush_size=FLUSH_SIZE, interval=FLUSH_INTERVAL):
+        self.writers = writers  # relationship -> func(pairs, batch_size)
+        self.flush_size = flush_size
+        self.interval = interval
+        self.enabled = False
+        self.flushes = 0
+        self.written = 0
+        self._pending = {relationship: [] for relationship in writers}
+        self._writing = set()  # from ids of pairs being written
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._registered = False
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(pairs) for pairs in self._pending.values())
+
+    def start(self):
+        """ Buffer relationships from now on and write them in the background """
+        if self.enabled:
+            return
+        self._closed = False
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        if not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def add(self, relationship, from_id, to_id):
+        """ Buffer relationship, the background thread is woken up if buffer is full """
+        with self._condition:
+            pending = self._pending[relationship]
+            pending.append((from_id, to_id))
+            if len(pending) >= self.flush_size:
+                self._condition.notify()
+
+    def pending(self, relationship, from_id):
+        """ Return list of to ids of relationships of from_id which are not written yet """
+        from_id = str(from_id)
+        with self._condition:
+            return [to_id for source, to_id in self._pending[relationship]
+                    if str(source) == from_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or any(len(pairs) >= self.flush_size
+                                                for pairs in self._pending.values()),
+                    timeout=self.interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as error:
+                # pairs stay buffered and are written by the next flush
+                warnings.warn('write-behind flush failed: %r' % error)
+            finally:
+                # connection is not held while the thread waits for the next flush
+                release_connections()
+
+    def flush(self, from_id=None):
+        """ Write buffered relationships, only of from_id if given; return amount written.
+         Pairs which could not be written stay buffered """
+        key = None if from_id is None else str(from_id)
+        if key is not None:
+            with self._condition:
+                if key not in self._writing and not any(
+                        str(source) == key for pairs in self._pending.values()
+                        for source, _ in pairs):
+                    return 0
+        written = 0
+        with self._flush_lock:
+            with self._condition:
+                batches = {}
+                for relationship, pairs in self._pending.items():
+                    if key is None:
+                        batches[relationship], self._pending[relationship] = pairs, []
+                    else:
+                        batches[relationship] = [pair for pair in pairs if str(pair[0]) == key]
+                        self._pending[relationship] = [pair for pair in pairs
+                                                       if str(pair[0]) != key]
+                self._writing = set(str(source) for pairs in batches.values()
+                                    for source, _ in pairs)
+            try:
+                for relationship, pairs in batches.items():
+                    if pairs:
+                        self.writers[relationship](pairs, self.flush_size)
+                        written += len(pairs)
+                        batches[relationship] = []
+            finally:
+                with self._condition:
+                    for relationship, pairs in batches.items():
+                        self._pending[relationship][:0] = pairs
+                    self._writing = set()
+                    if written:
+                        self.flushes += 1
+                        self.written += written
+        return written
+
+    def close(self):
+        """ Stop the background thread and write all buffered relationships """
+        if not self.enabled:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.enabled = False
+        self.flush()
+
+    def clear(self):
+        """ Drop buffered relationships """
+        with self._condition:
+            for pairs in self._pending.values():
+                del pairs[:]
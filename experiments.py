@@ -1,106 +1,499 @@
 """Experiments for comparison of databases """
-from time import time
+import argparse
+import importlib
+import os
+import sys
+from time import perf_counter
 
-import csv
 import pandas as pd
 
-#from app.neo4j_models import User, Book, Tag, clear_graph
+from app import datasets, workloads
+from app.benchmark import (Benchmark, Measured, REPEAT, THRESHOLD, WARMUP, export_snapshot,
+                           load_run, report, report_cache, report_profile, report_queries,
+                           run_similar_books, save_results)
+from app.cache import CACHE_SIZE
+from app.checkpoints import CHECKPOINT_FILE, Checkpoint, load_resumable
+from app.instrumentation import QUERY_LIMIT, QueryStats, instrumentation
+from app.parallel import load_parallel, partition, shared_vertices
+from app.passwords import PasswordVerifier
+from app.pool import POOLS, POOL_SIZE
+from app.profiling import PROFILES_DIR, PhaseProfile
+from app.popularity import reader_counts
+from app.similarity import book_similarity
+from app.snapshot import SNAPSHOT_DIR, warm_start_or_build
+from app.tag_index import tag_index
+from app.utils import BACKENDS, BATCH_SIZE
 
-from app.orientdb_models import User, Book, Tag, clear_graph
-#from app.arango_models import User, Book, Tag, clear_graph
+# models of the backend under test, set by use_backend()
+backend = models = None
+User = Book = Tag = clear_graph = create_schema = vertex_cache = query_cache = None
+# checkpoints of loading, set by main(); rows are skipped only with --resume
+checkpoint = None
+resume = False
+# snapshot read workloads warm start from, set by --snapshot
+snapshot_dir = None
+# rounds of sha256_crypt hashes of passwords stored by loads, the minimum, so hashing
+# does not dominate loading; --login measures verification with realistic rounds
+PASSWORD_ROUNDS = 1000
+# datasets directory -> user_id -> hash of password, filled by password_hashes()
+# when users are first inserted
+_password_hashes = {}
 
-# nodes
-tags = pd.read_csv('datasets/tags.csv')  # 34252
-books = pd.read_csv('datasets/diploma_books_final.csv')  # 10000
-users = pd.read_csv('datasets/users.csv')  # 1000
-# relationships
-books_of_users = pd.read_csv('datasets/to_read1000.csv')  # 11849
-tags_to_books = pd.read_csv('datasets/tags_to_book.csv')  # 50000
-followers = pd.read_csv('datasets/friends.csv')  # 20317
-likes = pd.read_csv('datasets/likes.csv')  # 40466
 
+def use_backend(name):
+    """ Import models of backend, connection is opened by the first query """
+    global backend, models, User, Book, Tag, clear_graph, create_schema, vertex_cache, query_cache
+    models = importlib.import_module(BACKENDS[name])
+    backend = name
+    User, Book, Tag, clear_graph = models.User, models.Book, models.Tag, models.clear_graph
+    create_schema = models.create_schema
+    vertex_cache = getattr(models, 'vertex_cache', None)
+    query_cache = models.query_cache
 
-def save_time(test_name, time):
-    with open('results.csv', mode='a') as csv_file:
-        fieldnames = ['test', 'orientdb', 'neo4j', 'arangodb']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writerow({'test': test_name, 'orientdb': time, 'neo4j': None, 'arangodb': None})
 
+def measure_queries(name, run):
+    """ Return run collecting its queries of all threads into returned stats """
+    stats = QueryStats(name)
 
-def timing(func):
-    def timed(*args, **kw):
-        time_start = time()
-        result = func(*args, **kw)
-        time_end = time()
-        running_time = time_end - time_start
-        save_time(func.__name__, running_time)
-        return result
+    def measured():
+        with instrumentation.phase(name, stats):
+            return run()
 
-    return timed
+    return measured, stats
 
 
-@timing
-def insert_books():
+def _value(value, cast=str):
+    """ Convert dataset value to python type, missing values become None """
+    return None if pd.isnull(value) else cast(value)
+
+
+def book_rows():
+    for book_id, authors, year, title, language in datasets.rows('books'):
+        yield {'book_id': book_id,
+               'authors': authors,
+               'year': _value(year, int),
+               'title': title,
+               'language': _value(language)}
+
+
+def password_hashes(rounds=PASSWORD_ROUNDS):
+    """ Return dict user_id -> hash of password of users dataset,
+     hashed once per datasets directory in the pool of password verifier """
+    if datasets.DATASETS_DIR not in _password_hashes:
+        user_ids, _, passwords = datasets.columns('users')
+        hasher = PasswordVerifier()
+        hashes = hasher.hash_many(passwords.tolist(), rounds)
+        hasher.shutdown()
+        _password_hashes[datasets.DATASETS_DIR] = dict(zip(user_ids.tolist(), hashes))
+    return _password_hashes[datasets.DATASETS_DIR]
+
+
+def user_rows():
+    """ Yield properties of users with hashes of passwords, like stored by the web app """
+    hashes = password_hashes()
+    for user_id, username, _ in datasets.rows('users'):
+        yield {'user_id': user_id, 'username': username, 'password': hashes[user_id]}
+
+
+def tag_rows():
+    for tag_id, tag_name in datasets.rows('tags'):
+        yield {'tag_id': tag_id, 'tag_name': tag_name}
+
+
+def report_validation():
+    """ Print edges of every edge dataset left out by validation """
+    for name in datasets.EDGES:
+        summary = datasets.validate_edges(name)[2]
+        print('%s: %d rows, %d clean edges, %d dangling (source missing %d, target missing %d), '
+              '%d duplicates%s'
+              % (name, summary['rows'], summary['clean'], summary['dangling'],
+                 summary['missing_source'], summary['missing_target'], summary['duplicates'],
+                 ', e.g. %s' % summary['dangling_examples'] if summary['dangling'] else ''))
+
+
+def insert_batches(dataset, insert_many, rows, batch_size):
+    """ Insert rows of dataset with insert_many, with --resume after rows
+     committed by previous runs """
+    if not resume:
+        insert_many(rows, batch_size)
+        return
+    key = '%s:%s' % (backend, os.path.join(datasets.DATASETS_DIR, dataset))
+    total = len(datasets.validate_edges(dataset)[0]) if dataset in datasets.EDGES \
+        else len(datasets.columns(dataset)[0])
+    inserted = load_resumable(checkpoint, key, rows, insert_many, batch_size, total)
+    print('%s: %d rows skipped by checkpoint, %d inserted' % (dataset, total - inserted, inserted))
+
+
+def clear_backend_graph():
+    """ Delete graph of backend under test and checkpoints of its loads """
+    clear_graph()
+    if checkpoint is not None:
+        checkpoint.reset_all(backend + ':')
+
+
+def insert_books(batch_size=None):
     """Insert books from dataset to graph"""
-    for _, row in books.iterrows():
-        book = Book(book_id=row['book_id'],
-                    authors=row['authors'],
-                    year=row['original_publication_year'],
-                    title=row['title'],
-                    language=row['language_code'])
+    if batch_size:
+        insert_batches('books', Book.insert_many, book_rows(), batch_size)
+        return
+    for row in book_rows():
+        book = Book(**row)
         book.insert()
 
 
-
-@timing
-def insert_users():
+def insert_users(batch_size=None):
     """Insert users from dataset to graph"""
-    for index, row in users.iterrows():
-        user = User(user_id=index, username=row['username'], password=row['password'])
+    if batch_size:
+        insert_batches('users', User.insert_many, user_rows(), batch_size)
+        return
+    for row in user_rows():
+        user = User(**row)
         user.insert()
 
 
-
-@timing
-def insert_tags():
-    """Insert users from dataset to graph"""
-    for _, row in tags.iterrows():
-        tag = Tag(tag_id=row['tag_id'], tag_name=row['tag_name'])
+def insert_tags(batch_size=None):
+    """Insert tags from dataset to graph"""
+    if batch_size:
+        insert_batches('tags', Tag.insert_many, tag_rows(), batch_size)
+        return
+    for row in tag_rows():
+        tag = Tag(**row)
         tag.insert()
 
 
-
-@timing
-def insert_reads():
+def insert_reads(batch_size=None):
     """Insert books read by users from dataset to graph"""
-    for _, row in books_of_users.iterrows():
-        user = User(user_id=str(row['user_id']))
-        user.reads(str(row['book_id']))
+    if batch_size:
+        insert_batches('reads', User.reads_many, datasets.edge_rows('reads'), batch_size)
+        return
+    for user_id, book_id in datasets.edge_rows('reads'):
+        user = User(user_id=str(user_id))
+        user.reads(str(book_id))
+
+
+def insert_tagged_to(batch_size=None):
+    if batch_size:
+        insert_batches('tagged_to', Book.link_to_tag_many, datasets.edge_rows('tagged_to'),
+                       batch_size)
+        return
+    for book_id, tag_id in datasets.edge_rows('tagged_to'):
+        book = Book(book_id=str(book_id))
+        book.link_to_tag(str(tag_id))
+
+
+def insert_follows(batch_size=None):
+    if batch_size:
+        insert_batches('follows', User.follows_many, datasets.edge_rows('follows'), batch_size)
+        return
+    for user_id, friend_id in datasets.edge_rows('follows'):
+        user = User(user_id=str(user_id))
+        user.follows(str(friend_id))
+
+
+def insert_likes(batch_size=None):
+    if batch_size:
+        insert_batches('likes', User.likes_many, datasets.edge_rows('likes'), batch_size)
+        return
+    for user_id, book_id in datasets.edge_rows('likes'):
+        user = User(user_id=str(user_id))
+        user.likes(str(book_id))
+
+
+# experiments in order of loading, edges need their nodes to exist
+EXPERIMENTS = [insert_users, insert_books, insert_tags,
+               insert_reads, insert_tagged_to, insert_follows, insert_likes]
+
+# relationship experiments which can run in parallel -> relationship, also name of its dataset
+PARALLEL_EXPERIMENTS = {
+    'insert_reads': 'reads',
+    'insert_tagged_to': 'tagged_to',
+    'insert_follows': 'follows',
+    'insert_likes': 'likes',
+}
+
+
+# experiment -> node experiments loaded before every run of it
+PREREQUISITES = {
+    'insert_users': [],
+    'insert_books': [],
+    'insert_tags': [],
+    'insert_reads': [insert_users, insert_books],
+    'insert_tagged_to': [insert_books, insert_tags],
+    'insert_follows': [insert_users],
+    'insert_likes': [insert_users, insert_books],
+}
+
+
+def insert_parallel(test_name, workers, batch_size=0):
+    """Insert relationships of experiment with pool of workers,
+    return time of loading without starting of workers"""
+    relationship = PARALLEL_EXPERIMENTS[test_name]
+    pairs = list(datasets.edge_rows(relationship))
+    parts = partition(pairs, workers)
+    running_time, worker_times = load_parallel(BACKENDS[backend], relationship, pairs,
+                                               workers, batch_size, parts)
+    print('%s: workers busy %s s, vertices written by several workers: %d from, %d to'
+          % ((test_name, ', '.join('%.2f' % t for t in worker_times)) + shared_vertices(parts)))
+    return Measured(running_time)
+
+
+def experiment_name(name, batch_size=0, workers=0, indexes=True):
+    """ Return name of experiment in results with its parameters """
+    if workers:
+        name += '[workers=%d]' % workers
+    if batch_size:
+        name += '[batch=%d]' % batch_size
+    if not indexes:
+        name += '[indexes=off]'
+    return name
+
+
+def reset_graph(test_name, batch_size=0, indexes=True):
+    """ Return setup which clears graph, creates schema and loads nodes needed by experiment """
+    def setup():
+        clear_backend_graph()
+        create_schema(indexes)
+        for load in PREREQUISITES[test_name]:
+            load(batch_size=batch_size)
+        if vertex_cache is not None:
+            vertex_cache.hits = vertex_cache.misses = 0
+
+    return setup
+
+
+def prepare_reads():
+    """Load graph of memory backend, for databases build in-process indexes of loaded graph"""
+    if backend == 'memory':
+        for load in EXPERIMENTS:
+            load(batch_size=BATCH_SIZE)
+    elif snapshot_dir:
+        time_start = perf_counter()
+        snapshot = warm_start_or_build(snapshot_dir)
+        if snapshot is not None:
+            print('warm start from snapshot of %s: %d relationships, %.1f MB mapped, %.4f s'
+                  % (snapshot.source, len(snapshot), snapshot.nbytes / 2 ** 20,
+                     perf_counter() - time_start))
+    else:
+        # graph was loaded by another process, reader counts and tags are taken from datasets
+        reader_counts.clear()
+        reader_counts.load_from_datasets()
+        tag_index.build_from_datasets()
+        book_similarity.build_from_datasets()
+
+
+def reset_users_and_books():
+    """ Clear graph and load users and books only, for workloads creating relationships """
+    clear_backend_graph()
+    create_schema()
+    insert_users(BATCH_SIZE)
+    insert_books(BATCH_SIZE)
 
 
+def save(results):
+    """ Append (name, value) results of backend under test to results table """
+    save_results('results.csv', backend, results, ['name'] + list(BACKENDS))
 
-@timing
-def insert_tagged_to():
-    for _, row in tags_to_books.iterrows():
-        book = Book(book_id=str(row['book_id']))
-        book.link_to_tag(str(row['tag_id']))
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('experiments', nargs='*', metavar='experiment',
+                        help='experiments to run, all by default')
+    parser.add_argument('--backend', choices=list(BACKENDS), default='orientdb',
+                        help='database to run experiments on, memory is the reference backend')
+    parser.add_argument('--datasets', default=datasets.DATASETS_DIR,
+                        help='directory of datasets, e.g. generated by generate_datasets.py')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='rows per bulk insert, 0 inserts row by row')
+    parser.add_argument('--workers', default='',
+                        help='comma separated worker counts for relationship inserts, '
+                             'e.g. 1,2,4,8; relationships are inserted sequentially by default')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='vertices kept in cache for relationship inserts')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='maximum connections to database used at once, '
+                             'raised to --concurrency + 1 if smaller')
+    parser.add_argument('--read-workload', action='store_true',
+                        help='measure read queries on already loaded graph instead of inserts')
+    parser.add_argument('--requests', type=int, default=workloads.REQUESTS,
+                        help='requests of every query in read workload')
+    parser.add_argument('--concurrency', type=int, default=workloads.CONCURRENCY,
+                        help='threads sending requests in read workload')
+    parser.add_argument('--recommendations', action='store_true',
+                        help='with --read-workload compare precomputed recommendations '
+                             'with the query of database')
+    parser.add_argument('--mixed', action='store_true',
+                        help='run open-loop mix of reads and writes on already loaded graph, '
+                             'latency is measured from scheduled arrival of every operation')
+    parser.add_argument('--mix',
+                        help='comma separated operation=weight pairs of --mixed, '
+                             'e.g. find_book_by_id=50,likes=10; default mix of workloads if not set')
+    parser.add_argument('--rate', type=float, default=workloads.RATE,
+                        help='operations per second arriving in --mixed')
+    parser.add_argument('--duration', type=float, default=workloads.DURATION,
+                        help='seconds of arrivals in --mixed')
+    parser.add_argument('--export-snapshot', choices=['datasets', 'backend'],
+                        help='write binary snapshot of datasets or of graph loaded into backend '
+                             'to --snapshot directory')
+    parser.add_argument('--snapshot', metavar='DIR',
+                        help='snapshot directory, read workloads of database backends '
+                             'warm start from it instead of datasets; %s for --export-snapshot '
+                             'if not set' % SNAPSHOT_DIR)
+    parser.add_argument('--similar-books', action='store_true',
+                        help='measure time and memory of computing similar books of all books')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='compare latency of requests creating relationships written at once '
+                             'and through write-behind buffer, graph is cleared')
+    parser.add_argument('--login', action='store_true',
+                        help='measure logins per second of password verifier, '
+                             'with --requests logins for every pool size')
+    parser.add_argument('--login-pools', default='1,2,4,8',
+                        help='comma separated sizes of pool of password verifier for --login')
+    parser.add_argument('--login-rounds', type=int,
+                        help='rounds of sha256_crypt hashes for --login, passlib default if not set')
+    parser.add_argument('--indexes', choices=['on', 'off', 'both'], default='on',
+                        help='create indexes before loading and reads, '
+                             'both runs experiments without and then with indexes')
+    parser.add_argument('--query-limit', type=int, default=QUERY_LIMIT,
+                        help='queries of one model method above which N+1 queries are reported')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every experiment with cProfile, stack sampling and '
+                             'tracemalloc, measured times include overhead of profiling')
+    parser.add_argument('--profile-dir', default=PROFILES_DIR,
+                        help='directory for .prof and collapsed stacks files of --profile')
+    parser.add_argument('--warmup', type=int, default=WARMUP,
+                        help='runs of every experiment which are not measured')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='measured runs of every experiment')
+    parser.add_argument('--keep-graph', action='store_true',
+                        help='do not clear graph and load nodes before every run, '
+                             'use with --warmup 0 --repeat 1 to load the whole dataset once')
+    parser.add_argument('--resume', action='store_true',
+                        help='load graph once, keeping it between runs, and continue from '
+                             'batches committed by previous runs; needs --batch-size, '
+                             'every experiment runs once without warmup')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE,
+                        help='file with committed rows of every dataset used by --resume')
+    parser.add_argument('--results-json',
+                        help='file to append statistics and metadata of the run to, '
+                             'e.g. to use it as --baseline later')
+    parser.add_argument('--baseline',
+                        help='file with runs saved by --results-json to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fraction by which median may be slower than baseline')
+    args = parser.parse_args()
+    worker_counts = [int(workers) for workers in args.workers.split(',') if workers]
+    names = [func.__name__ for func in EXPERIMENTS]
+    for name in args.experiments:
+        if name not in names:
+            parser.error('unknown experiment %s, choose from %s' % (name, ', '.join(names)))
+    if args.backend == 'memory' and worker_counts:
+        parser.error('memory backend lives in one process and can not be loaded by workers')
+    if args.resume and (not args.batch_size or worker_counts or args.backend == 'memory'):
+        parser.error('--resume needs --batch-size, sequential inserts and a database backend')
+    index_modes = {'on': [True], 'off': [False], 'both': [False, True]}[args.indexes]
 
-@timing
-def insert_follows():
-    for _, row in followers.iterrows():
-        user = User(user_id=str(row['user']))
-        user.follows(str(row['friend']))
+    datasets.use_directory(args.datasets)
+    use_backend(args.backend)
+    for pool in POOLS:
+        # every thread of workloads holds a connection during a call, the main thread keeps one
+        pool.size = max(args.pool_size, args.concurrency + 1)
+    instrumentation.limit = args.query_limit
+    global checkpoint, resume
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.resume:
+        resume = True
+        args.keep_graph = True
+        # runs after the first would skip all committed rows and time nothing
+        args.warmup, args.repeat = 0, 1
+    if vertex_cache is not None:
+        vertex_cache.maxsize = args.cache_size
+    if args.export_snapshot:
+        if args.export_snapshot == 'backend' and backend == 'memory':
+            for load in EXPERIMENTS:
+                load(batch_size=BATCH_SIZE)
+        export_snapshot(args.export_snapshot, args.snapshot or SNAPSHOT_DIR, models)
+        return
+    global snapshot_dir
+    snapshot_dir = args.snapshot
+    if args.write_behind:
+        save(workloads.run_write_workload(models, reset_users_and_books, args.requests,
+                                          args.concurrency))
+        return
+    if args.login:
+        save(workloads.run_login_workload(
+            [int(size) for size in args.login_pools.split(',') if size], args.requests,
+            args.concurrency, args.login_rounds))
+        return
+    if args.mixed:
+        try:
+            mix = workloads.parse_mix(args.mix) if args.mix else None
+        except ValueError as error:
+            parser.error('invalid --mix: %s' % error)
+        prepare_reads()
+        save(workloads.run_mixed_workload(models, mix, args.rate, args.duration,
+                                          args.concurrency))
+        return
+    if args.similar_books:
+        save(run_similar_books(backend, args.warmup, args.repeat))
+        return
+    if args.read_workload:
+        prepare_reads()
+        save(workloads.run_read_workload(models, backend, args.requests, args.concurrency,
+                                         args.recommendations, index_modes,
+                                         args.profile_dir if args.profile else None))
+        return
 
+    report_validation()
+    benchmark = Benchmark(backend, warmup=args.warmup, repeat=args.repeat,
+                          batch_size=args.batch_size,
+                          cache_size=args.cache_size,
+                          pool_size=args.pool_size,
+                          dataset_rows={name: len(datasets.columns(name)[0])
+                                        for name in datasets.DATASETS},
+                          profile=args.profile)
+    profile_results = []
+    for indexes in index_modes:
+        if args.keep_graph:
+            create_schema(indexes)
+        for func in EXPERIMENTS:
+            if args.experiments and func.__name__ not in args.experiments:
+                continue
+            setup = None if args.keep_graph else reset_graph(func.__name__, args.batch_size,
+                                                              indexes)
+            if func is insert_users:
+                # hashed before timing, so inserts of users do not time hashing
+                password_hashes()
+            if worker_counts and func.__name__ in PARALLEL_EXPERIMENTS:
+                runs = [(experiment_name(func.__name__, args.batch_size, workers, indexes),
+                         lambda workers=workers: insert_parallel(func.__name__, workers,
+                                                                 args.batch_size))
+                        for workers in worker_counts]
+            else:
+                runs = [(experiment_name(func.__name__, args.batch_size, indexes=indexes),
+                         lambda: func(batch_size=args.batch_size))]
+            for name, run in runs:
+                # queries of setup are left out, workers of parallel inserts are not recorded
+                run, query_stats = measure_queries(name, run)
+                if args.profile:
+                    profile = PhaseProfile(name)
+                    run = profile.wrap(run)
+                print(report(name, benchmark.run(name, run, setup)))
+                report_cache(name, vertex_cache)
+                report_queries(query_stats)
+                if args.profile:
+                    profile_results += report_profile(profile, args.profile_dir)
 
-@timing
-def insert_likes():
-    for _, row in likes.iterrows():
-        user = User(user_id=str(row['user_id']))
-        user.likes(str(row['book_id']))
+    benchmark.save_csv('results.csv', ['name'] + list(BACKENDS))
+    save(profile_results)
+    if args.results_json:
+        benchmark.save_json(args.results_json)
+    if args.baseline:
+        regressions = benchmark.compare(load_run(args.baseline, backend), args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION %s: median %.4f s, baseline %.4f s' % (name, after, before))
+        if regressions:
+            sys.exit(1)
 
 
-#insert_likes()
-#insert_reads()
-#insert_tagged_to()
-insert_follows()
+if __name__ == '__main__':
+    main()
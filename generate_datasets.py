@@ -0,0 +1,189 @@
+"""Generator of synthetic datasets for scaling experiments.
+
+Writes users, books, tags and their relationships in the schemas of the files
+in datasets/, with sizes multiplied by scale factor. Degrees of relationships
+follow power law: a few users and books take part in most relationships.
+Relationships are unique: pairs drawn again are replaced by new draws until
+every dataset has its size. Rows are written in chunks, memory holds nodes
+and one int64 key per relationship of the dataset being written.
+"""
+import argparse
+import csv
+import os
+
+import numpy as np
+from mimesis import Person, Text
+
+# amount of rows in datasets/ which is scale factor 1
+BASE_SIZES = {
+    'users': 1000,
+    'books': 10000,
+    'tags': 34252,
+    'reads': 11849,
+    'tagged_to': 50000,
+    'follows': 20317,
+    'likes': 40466,
+}
+LANGUAGES = ['eng', 'en-US', 'en-GB', 'spa', 'fre', 'ger', 'ita', 'jpn']
+EXPONENT = 1.1
+CHUNK_SIZE = 100000
+
+
+class PowerLaw:
+    """ Sampler of ids, id of rank i is chosen with probability proportional
+    to 1 / i ** exponent. Ranks are shuffled, so popular ids are spread over the whole range """
+
+    def __init__(self, ids, random, exponent=EXPONENT):
+        weights = np.arange(1, len(ids) + 1, dtype=float) ** -exponent
+        self.cdf = np.cumsum(weights / weights.sum())
+        self.ids = random.permutation(ids)
+        self.random = random
+
+    def sample(self, size):
+        ranks = np.searchsorted(self.cdf, self.random.random_sample(size))
+        return self.ids[np.minimum(ranks, len(self.ids) - 1)]
+
+
+class UniquePairs:
+    """ Keys of (source, target) pairs drawn so far, sorted """
+
+    def __init__(self, width):
+        self.width = width  # greater than any target id
+        self.keys = np.empty(0, np.int64)
+
+    def add(self, sources, targets):
+        """ Return mask of pairs which were not drawn before, remembering them;
+         of pairs repeated in arrays only the first one is new """
+        keys = np.asarray(sources, np.int64) * self.width + np.asarray(targets, np.int64)
+        new = np.zeros(len(keys), dtype=bool)
+        new[np.unique(keys, return_index=True)[1]] = True
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if len(self.keys):
+            new &= self.keys[positions] != keys
+        added = np.sort(keys[new])
+        self.keys = np.insert(self.keys, np.searchsorted(self.keys, added), added)
+        return new
+
+
+def draw_unique(pairs, sources, sample_targets, sample_sources=None, loops=True):
+    """ Return arrays of (source, target) pairs not drawn before for array of sources,
+     targets of rejected pairs are drawn again, and their sources if sample_sources is given """
+    sources, targets = sources.copy(), sample_targets(len(sources))
+    pending = np.arange(len(sources))
+    while len(pending):
+        new = pairs.add(sources[pending], targets[pending])
+        if not loops:
+            # keys of loops are remembered too, they are never written anyway
+            new = (sources[pending] != targets[pending]) & new
+        pending = pending[~new]
+        if sample_sources is not None:
+            sources[pending] = sample_sources(len(pending))
+        targets[pending] = sample_targets(len(pending))
+    return sources, targets
+
+
+def scaled_sizes(scale):
+    """ Return sizes of datasets, relationships are capped by amount of distinct pairs """
+    sizes = {name: int(round(size * scale)) for name, size in BASE_SIZES.items()}
+    possible = {'reads': sizes['users'] * sizes['books'],
+                'tagged_to': sizes['books'] * sizes['tags'],
+                'follows': sizes['users'] * (sizes['users'] - 1),
+                'likes': sizes['users'] * sizes['books']}
+    for name, amount in possible.items():
+        sizes[name] = min(sizes[name], amount)
+    return sizes
+
+
+def _write(path, header, rows):
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        for chunk in rows:
+            writer.writerows(chunk)
+
+
+def _chunks(size, make_chunk):
+    for start in range(0, size, CHUNK_SIZE):
+        yield make_chunk(start, min(start + CHUNK_SIZE, size))
+
+
+def generate(directory, scale, seed=None):
+    """ Write datasets of scale factor to directory """
+    sizes = scaled_sizes(scale)
+    random = np.random.RandomState(seed)
+    person = Person('en', seed=seed)
+    text = Text('en', seed=seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def users(start, end):
+        return [(user_id, '%s_%d' % (person.username(), user_id), person.password())
+                for user_id in range(start, end)]
+
+    def books(start, end):
+        years = random.randint(1800, 2018, end - start)
+        languages = random.choice(LANGUAGES, end - start)
+        return [(index, index, index + 1, person.full_name(), float(year), text.title(),
+                 language, '', '')
+                for index, year, language in zip(range(start, end), years, languages)]
+
+    def tags(start, end):
+        return [(tag_id, '%s-%d' % (text.word(), tag_id)) for tag_id in range(start, end)]
+
+    _write(os.path.join(directory, 'users.csv'), ['id', 'username', 'password'],
+           _chunks(sizes['users'], users))
+    _write(os.path.join(directory, 'diploma_books_final.csv'),
+           ['', 'Unnamed: 0', 'book_id', 'authors', 'original_publication_year', 'title',
+            'language_code', 'image_url', 'small_image_url'],
+           _chunks(sizes['books'], books))
+    _write(os.path.join(directory, 'tags.csv'), ['tag_id', 'tag_name'],
+           _chunks(sizes['tags'], tags))
+
+    user_ids = np.arange(sizes['users'])
+    book_ids = np.arange(1, sizes['books'] + 1)
+    readers = PowerLaw(user_ids, random)
+    popular_books = PowerLaw(book_ids, random)
+    popular_users = PowerLaw(user_ids, random)
+    popular_tags = PowerLaw(np.arange(sizes['tags']), random)
+
+    def relationships(sources, targets, loops=True):
+        pairs = UniquePairs(targets.ids.max() + 1)
+
+        def chunk(start, end):
+            from_ids, to_ids = draw_unique(pairs, sources.sample(end - start), targets.sample,
+                                           sources.sample, loops)
+            return zip(from_ids.tolist(), to_ids.tolist())
+        return chunk
+
+    tag_pairs = UniquePairs(sizes['tags'])
+
+    def tagged(start, end):
+        # every book gets tags, popular tags are used by many books
+        books, tags = draw_unique(tag_pairs, (np.arange(start, end) % sizes['books']) + 1,
+                                  popular_tags.sample)
+        return zip(range(start, end), books.tolist(), tags.tolist())
+
+    _write(os.path.join(directory, 'to_read1000.csv'), ['user_id', 'book_id'],
+           _chunks(sizes['reads'], relationships(readers, popular_books)))
+    _write(os.path.join(directory, 'tags_to_book.csv'), ['', 'book_id', 'tag_id'],
+           _chunks(sizes['tagged_to'], tagged))
+    _write(os.path.join(directory, 'friends.csv'), ['user', 'friend'],
+           _chunks(sizes['follows'], relationships(readers, popular_users, loops=False)))
+    _write(os.path.join(directory, 'likes.csv'), ['user_id', 'book_id'],
+           _chunks(sizes['likes'], relationships(readers, popular_books)))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scale', type=float, help='scale factor, 1 is the size of datasets/')
+    parser.add_argument('--output', help='directory of datasets, datasets/scale_<scale> by default')
+    parser.add_argument('--seed', type=int, help='seed of random generators')
+    args = parser.parse_args()
+    directory = args.output or os.path.join('datasets', 'scale_%g' % args.scale)
+    sizes = generate(directory, args.scale, args.seed)
+    print('%s: %s' % (directory, ', '.join('%s %d' % item for item in sizes.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Migration of the graph from one backend into another.
+
+Nodes and relationships are streamed out of the source database in pages and
+written into the target database in batches, memory does not grow with the
+graph. Progress is printed while copying, amounts of records in the target
+are verified at the end; exit status is 1 if they differ.
+"""
+import argparse
+import importlib
+import sys
+from time import perf_counter
+
+from app import migration
+from app.checkpoints import Checkpoint
+from app.pool import POOLS, POOL_SIZE
+from app.utils import BACKENDS, BATCH_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', choices=[name for name in BACKENDS if name != 'memory'],
+                        help='backend to read the graph from')
+    parser.add_argument('target', choices=list(BACKENDS),
+                        help='backend to write the graph to, memory only verifies the copy')
+    parser.add_argument('--page-size', type=int, default=migration.PAGE_SIZE,
+                        help='records fetched from source per query')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='records written to target per batch')
+    parser.add_argument('--clear-target', action='store_true',
+                        help='delete all nodes and relationships of target before copying')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='do not count records of target after copying')
+    parser.add_argument('--interval', type=float, default=migration.PROGRESS_INTERVAL,
+                        help='seconds between reports of progress')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='maximum connections to database used at once')
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error('source and target are the same backend')
+
+    for pool in POOLS:
+        pool.size = args.pool_size
+    source = importlib.import_module(BACKENDS[args.source])
+    target = importlib.import_module(BACKENDS[args.target])
+    if args.clear_target:
+        target.clear_graph()
+        # loads of experiments must not skip rows which were just deleted
+        Checkpoint().reset_all(args.target + ':')
+    target.create_schema()
+
+    time_start = perf_counter()
+    migrated = migration.migrate(source, target, args.page_size, args.batch_size,
+                                 migration.Progress(interval=args.interval))
+    print('%s -> %s: %d records in %.2f s'
+          % (args.source, args.target, sum(migrated.values()), perf_counter() - time_start))
+    if args.no_verify:
+        return
+    mismatches = migration.verify(migrated, target, args.page_size)
+    for name, (copied, stored) in sorted(mismatches.items()):
+        print('MISMATCH %s: %d migrated, %d in %s' % (name, copied, stored, args.target))
+    if mismatches:
+        sys.exit(1)
+    print('verified: amounts of all nodes and relationships match')
+
+
+if __name__ == '__main__':
+    main()
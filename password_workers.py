@@ -0,0 +1,22 @@
+"""Functions run in worker processes of the password verifier.
+
+Spawned workers import the module of every function they run. These live
+outside the app package, so workers import only passlib and not the Flask
+app, its routes and the models.
+"""
+from passlib.hash import sha256_crypt
+
+
+def verify_password(password, stored_hash):
+    """ Return if password matches hash, values which are not sha256_crypt hashes never do """
+    try:
+        return sha256_crypt.verify(password, stored_hash)
+    except (TypeError, ValueError):
+        return False
+
+
+def hash_password(password, rounds=None):
+    """ Return sha256_crypt hash of password, with passlib default rounds if not given """
+    if rounds is None:
+        return sha256_crypt.hash(password)
+    return sha256_crypt.using(rounds=rounds).hash(password)
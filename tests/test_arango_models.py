@@ -0,0 +1,34 @@
+"""Queries of ArangoDB models on a seeded graph, skipped without ArangoDB server"""
+import pytest
+
+pytest.importorskip("arango")
+pytest.importorskip("arango_orm")
+
+from app import arango_models  # noqa: E402
+
+
+@pytest.fixture
+def graph():
+    try:
+        arango_models.clear_graph()
+        arango_models.create_schema()
+    except Exception as error:
+        pytest.skip("ArangoDB is not available: %s" % error)
+    yield arango_models
+    arango_models.clear_graph()
+
+
+def test_most_popular_books_are_ordered_by_readers(graph):
+    graph.User.insert_many([{"user_id": user_id, "username": "user%d" % user_id,
+                             "password": "hash"} for user_id in range(3)])
+    graph.Book.insert_many([{"book_id": book_id, "authors": "author", "year": 2000,
+                             "title": "book%d" % book_id, "language": "eng"}
+                            for book_id in range(3)])
+    # book 2 is read by 3 users, book 0 by 2 and book 1 by 1
+    graph.User.reads_many([(0, 2), (1, 2), (2, 2), (0, 0), (1, 0), (2, 1)])
+    graph.query_cache.clear()
+
+    books = graph.Book.most_popular_books()
+
+    assert [book["book"]["_key"] for book in books] == ["2", "0", "1"]
+    assert [book["count"] for book in books] == [3, 2, 1]
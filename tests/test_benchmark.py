@@ -0,0 +1,31 @@
+"""Benchmark times calls unless they report their own running time"""
+from time import sleep
+
+from app.benchmark import Benchmark, Measured
+
+
+def test_float_result_does_not_replace_wall_time():
+    benchmark = Benchmark('memory', warmup=0, repeat=2)
+
+    def average_rating():
+        sleep(0.01)
+        return 4.5
+
+    stats = benchmark.run('average_rating', average_rating)
+
+    assert stats['runs'] == 2
+    assert stats['min'] >= 0.01
+
+
+def test_measured_result_replaces_wall_time():
+    benchmark = Benchmark('memory', warmup=1, repeat=3)
+    setups = []
+
+    def load():
+        sleep(0.01)
+        return Measured(0.5)
+
+    stats = benchmark.run('load', load, setup=lambda: setups.append(1))
+
+    assert stats['times'] == [0.5, 0.5, 0.5]
+    assert len(setups) == 4
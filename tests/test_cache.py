@@ -0,0 +1,32 @@
+"""Query cache counts every lookup once, also when values expire"""
+import threading
+
+from app.cache import TTLCache
+
+
+def test_expired_value_is_a_miss_and_is_dropped():
+    cache = TTLCache(ttl=-1)
+    cache.put('popular', [1, 2])
+
+    assert cache.get('popular', 'missing') == 'missing'
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'hit_ratio': 0.0, 'size': 0}
+
+
+def test_concurrent_lookups_are_all_counted():
+    fresh, expired = TTLCache(), TTLCache(ttl=-1)
+
+    def lookups():
+        for _ in range(1000):
+            fresh.put('popular', [1, 2])
+            expired.put('popular', [1, 2])
+            fresh.get('popular')
+            expired.get('popular')
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert (fresh.hits, fresh.misses) == (8000, 0)
+    assert (expired.hits, expired.misses) == (0, 8000)
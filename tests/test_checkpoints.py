@@ -0,0 +1,57 @@
+"""Resumable loading skips only rows committed by an unfinished load"""
+import pytest
+
+from app.checkpoints import Checkpoint, load_resumable
+
+
+def test_interrupted_load_resumes_after_committed_batches(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    inserted = []
+
+    def failing_insert(batch, batch_size):
+        if len(inserted) >= 4:
+            raise RuntimeError('connection lost')
+        inserted.extend(batch)
+
+    with pytest.raises(RuntimeError):
+        load_resumable(checkpoint, 'neo4j:users', range(10), failing_insert, 2, total=10)
+    assert Checkpoint(checkpoint.path).done('neo4j:users') == 4
+
+    resumed = load_resumable(Checkpoint(checkpoint.path), 'neo4j:users', range(10),
+                             lambda batch, batch_size: inserted.extend(batch), 2, total=10)
+
+    assert resumed == 6
+    assert inserted == list(range(10))
+
+
+def test_finished_load_is_not_skipped_by_the_next_one(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    load_resumable(checkpoint, 'neo4j:users', range(10), lambda batch, batch_size: None, 3)
+
+    assert checkpoint.done('neo4j:users') == 0
+    assert load_resumable(checkpoint, 'neo4j:users', range(10),
+                          lambda batch, batch_size: None, 3) == 10
+
+
+def test_checkpoint_covering_all_rows_is_loaded_again(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.commit('neo4j:users', 10)
+
+    with pytest.warns(UserWarning):
+        inserted = load_resumable(checkpoint, 'neo4j:users', range(10),
+                                  lambda batch, batch_size: None, 3, total=10)
+
+    assert inserted == 10
+
+
+def test_clearing_graph_forgets_checkpoints_of_its_backend_only(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.commit('neo4j:users', 4)
+    checkpoint.commit('neo4j:books', 2)
+    checkpoint.commit('orientdb:users', 6)
+
+    checkpoint.reset_all('neo4j:')
+
+    stored = Checkpoint(checkpoint.path)
+    assert [stored.done(key) for key in ('neo4j:users', 'neo4j:books', 'orientdb:users')] \
+        == [0, 0, 6]
@@ -0,0 +1,45 @@
+"""Datasets are validated and cached without leaving broken files behind"""
+import os
+
+import numpy as np
+import pytest
+
+from app import datasets
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    (tmp_path / 'users.csv').write_text('id,username,password\n1,anna,x\n2,boris,y\n')
+    (tmp_path / 'diploma_books_final.csv').write_text(
+        'book_id,authors,original_publication_year,title,language_code\n'
+        '10,author,2000.0,first,eng\n11,author,2001.0,second,eng\n')
+    (tmp_path / 'likes.csv').write_text(
+        'user_id,book_id\n1,10\n2,11\n1,10\n3,10\n2,12\n2,10\n')
+    monkeypatch.setattr(datasets, 'DATASETS_DIR', str(tmp_path))
+    return tmp_path
+
+
+def test_dangling_and_repeated_edges_are_dropped(directory):
+    sources, targets, summary = datasets.validate_edges('likes')
+
+    assert list(zip(sources.tolist(), targets.tolist())) == [(1, 10), (2, 11), (2, 10)]
+    assert summary == {'rows': 6, 'missing_source': 1, 'missing_target': 1, 'dangling': 2,
+                       'duplicates': 1, 'clean': 3, 'dangling_examples': [(3, 10), (2, 12)]}
+
+
+def test_interrupted_cache_write_leaves_no_cache(directory, monkeypatch):
+    def interrupted(file, **arrays):
+        file.write(b'PK')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(np, 'savez', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        datasets.columns('likes')
+    monkeypatch.undo()
+    monkeypatch.setattr(datasets, 'DATASETS_DIR', str(directory))
+
+    assert os.listdir(str(directory / '.cache')) == []
+    users, books = datasets.columns('likes')
+    assert users.tolist() == [1, 2, 1, 3, 2, 2]
+    assert os.listdir(str(directory / '.cache')) == ['likes.npz']
+    assert datasets.columns('likes')[1].tolist() == books.tolist()
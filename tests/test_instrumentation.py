@@ -0,0 +1,96 @@
+"""Instrumentation records queries of a driver under model methods, scopes and phases"""
+import threading
+import warnings
+
+import pytest
+
+from app.instrumentation import Instrumentation, NPlusOneWarning
+
+LIMIT = 3
+
+
+class FakeDriver:
+    """ Connection whose query returns rows of text, e.g. b'row' * 2 for 'row:2' """
+
+    def __init__(self):
+        self.calls = 0
+
+    def query(self, text):
+        self.calls += 1
+        row, _, count = text.partition(':')
+        return [row.encode()] * int(count or 1)
+
+    def command(self, text):
+        # calls query like drivers sending commands through their own requests
+        return self.query(text)
+
+
+def _size(rows):
+    return sum(len(row) for row in rows)
+
+
+@pytest.fixture
+def tracer():
+    return Instrumentation(limit=LIMIT)
+
+
+@pytest.fixture
+def driver(tracer):
+    driver = FakeDriver()
+    tracer.instrument(driver, ('query', 'command'), 'fake', _size)
+    return driver
+
+
+def test_queries_and_bytes_are_recorded_under_operation(tracer, driver):
+    find = tracer.operation('Book.find', lambda: [driver.query('book:2'), driver.command('tag')])
+
+    find()
+    driver.query('user:3')
+
+    summary = tracer.totals.summary()
+    assert driver.calls == 3
+    assert summary['Book.find']['queries'] == 2
+    assert summary['Book.find']['bytes'] == len(b'book') * 2 + len(b'tag')
+    assert summary['fake.query']['queries'] == 1
+    assert summary['fake.query']['bytes'] == len(b'user') * 3
+    assert tracer.totals.queries == 3
+    assert sum(summary['Book.find']['histogram']) == 2
+
+
+def test_nested_scopes_and_phase_collect_their_queries(tracer, driver):
+    with tracer.phase('experiment') as phase:
+        with tracer.scope('request') as request:
+            driver.query('a')
+            with tracer.scope('inner') as inner:
+                driver.query('b:2')
+            driver.query('c')
+        thread = threading.Thread(target=driver.query, args=('d:4',))
+        thread.start()
+        thread.join()
+    driver.query('e')
+
+    assert (inner.queries, inner.bytes) == (1, 2)
+    assert (request.queries, request.bytes) == (3, 4)
+    assert (phase.queries, phase.bytes) == (4, 8)
+    assert tracer.totals.queries == 5
+
+
+def test_n_plus_one_warning_above_limit_only(tracer, driver):
+    def books(count):
+        for book in range(count):
+            driver.query('book')
+
+    at_limit = tracer.operation('Tag.books', lambda: books(LIMIT))
+    above_limit = tracer.operation('Tag.books', lambda: books(LIMIT + 1))
+    # queries of nested operations count for the outermost one
+    nested = tracer.operation('User.feed', lambda: [at_limit(), driver.query('user')])
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        at_limit()
+    with pytest.warns(NPlusOneWarning, match='Tag.books issued 4 queries, limit is 3'):
+        above_limit()
+    with pytest.warns(NPlusOneWarning, match='User.feed issued 4 queries'):
+        nested()
+
+    assert caught == []
@@ -0,0 +1,27 @@
+"""Models of the memory backend find nodes by ids"""
+import pytest
+
+from app import memory_models
+
+BOOKS = [{'book_id': book_id, 'authors': 'author', 'year': 2000, 'title': 'book%d' % book_id,
+          'language': 'eng'} for book_id in (3, 5, 8)]
+
+
+@pytest.fixture
+def books():
+    memory_models.clear_graph()
+    memory_models.Book.insert_many(BOOKS)
+    yield memory_models.Book
+    memory_models.clear_graph()
+
+
+def test_find_many_returns_found_in_order_of_ids_and_missing_ids(books):
+    found, missing = books.find_many([8, '3', 99, 8, 5, 1, 99])
+
+    assert [book.book_id for book in found] == [8, 3, 8, 5]
+    assert [book.title for book in found] == ['book8', 'book3', 'book8', 'book5']
+    assert missing == [99, 1, 99]
+
+
+def test_find_many_of_no_ids(books):
+    assert books.find_many([]) == ([], [])
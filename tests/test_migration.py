@@ -0,0 +1,76 @@
+"""Migration copies a graph into the memory backend and verifies it"""
+import pytest
+
+from app import memory_models, migration
+from app.utils import index_updates
+
+USERS = [{'user_id': user_id, 'username': 'user%d' % user_id, 'password': 'hash%d' % user_id}
+         for user_id in range(1, 6)]
+BOOKS = [{'book_id': book_id, 'authors': 'author', 'year': 2000, 'title': 'book%d' % book_id,
+          'language': 'eng'} for book_id in range(10, 14)]
+TAGS = [{'tag_id': 5, 'tag_name': 'fantasy'}, {'tag_id': 6, 'tag_name': 'classics'}]
+RELATIONSHIPS = {'reads': [(1, 10), (1, 11), (2, 10), (5, 13)],
+                 'follows': [(1, 2), (2, 3), (3, 1)],
+                 'likes': [(2, 11), (4, 12)],
+                 'tagged_to': [(10, 5), (11, 5), (11, 6)]}
+
+
+def _page(records, key):
+    def page(after=None, limit=migration.PAGE_SIZE):
+        return [record for record in records if after is None or record[key] > after][:limit]
+    return staticmethod(page)
+
+
+class Source:
+    """ Models module of a backend storing the graph above """
+
+    class User:
+        export_page = _page(USERS, 'user_id')
+
+    class Book:
+        books_page = _page(BOOKS, 'book_id')
+
+    class Tag:
+        tags_page = _page(TAGS, 'tag_id')
+
+    @staticmethod
+    def relationships(relationship, fetch_size=None):
+        return iter(RELATIONSHIPS[relationship])
+
+
+class BrokenSource(Source):
+    """ Source whose connection is lost while relationships are read """
+
+    @staticmethod
+    def relationships(relationship, fetch_size=None):
+        raise ConnectionError('connection lost')
+
+
+@pytest.fixture
+def target():
+    memory_models.clear_graph()
+    yield memory_models
+    memory_models.clear_graph()
+
+
+def test_migrated_graph_is_stored_by_target(target):
+    migrated = migration.migrate(Source, target, page_size=2, batch_size=3,
+                                 progress=migration.Progress(report=lambda message: None))
+
+    assert migrated == dict({'users': 5, 'books': 4, 'tags': 2},
+                            **{name: len(pairs) for name, pairs in RELATIONSHIPS.items()})
+    assert migration.verify(migrated, target, page_size=2) == {}
+    for name, pairs in RELATIONSHIPS.items():
+        assert sorted(target.relationships(name)) == sorted(pairs)
+    assert target.User(username='user3').find().password == 'hash3'
+    assert target.Tag(tag_id=5).books() == [10, 11]
+    assert index_updates.enabled
+
+
+def test_failed_migration_restores_index_updates(target):
+    with pytest.raises(ConnectionError):
+        migration.migrate(BrokenSource, target,
+                          progress=migration.Progress(report=lambda message: None))
+
+    assert index_updates.enabled
+    assert migration.count(target)['users'] == 5
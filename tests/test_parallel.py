@@ -0,0 +1,37 @@
+"""Partitions of parallel loads keep every vertex of the busiest end in one worker"""
+from collections import Counter
+
+import pytest
+
+from app.parallel import busiest_end, partition, shared_vertices
+
+# book 7 is read by every user, users read at most three books
+READS = ([(user_id, 7) for user_id in range(40)]
+         + [(user_id, book_id) for user_id in range(0, 40, 3) for book_id in (1, 2)])
+
+
+@pytest.mark.parametrize('workers', [1, 3, 4])
+def test_every_pair_goes_to_exactly_one_part(workers):
+    parts = partition(READS, workers)
+
+    assert len(parts) == workers
+    assert Counter(pair for part in parts for pair in part) == Counter(READS)
+
+
+def test_pairs_of_busy_vertex_go_to_the_same_part():
+    assert busiest_end(READS) == 1
+
+    parts = partition(READS, 4)
+
+    for book_id in (1, 2, 7):
+        owners = [number for number, part in enumerate(parts)
+                  if any(pair[1] == book_id for pair in part)]
+        assert len(owners) == 1
+    assert shared_vertices(parts)[1] == 0
+
+
+def test_pairs_are_split_by_requested_end():
+    parts = partition(READS, 4, end=0)
+
+    for user_id in range(40):
+        assert sum(1 for part in parts if any(pair[0] == user_id for pair in part)) == 1
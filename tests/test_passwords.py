@@ -0,0 +1,34 @@
+"""Passwords are hashed and checked in worker processes which do not import the app"""
+import os
+import subprocess
+import sys
+
+from app.passwords import PasswordVerifier
+
+
+def test_hashed_password_is_verified_in_the_pool():
+    verifier = PasswordVerifier(workers=1)
+    try:
+        [stored_hash] = verifier.hash_many(['secret'], rounds=1000)
+
+        assert verifier.verify('secret', stored_hash)
+        assert not verifier.verify('guess', stored_hash)
+        assert not verifier.verify('secret', 'not a hash')
+    finally:
+        verifier.shutdown()
+
+
+def test_worker_functions_are_loaded_without_the_app():
+    # spawned workers unpickle submitted functions, importing only their module
+    code = ("import pickle, sys\n"
+            "from app.passwords import hash_password, verify_password\n"
+            "functions = pickle.dumps((hash_password, verify_password))\n"
+            "for name in [name for name in sys.modules if name.split('.')[0] == 'app']:\n"
+            "    del sys.modules[name]\n"
+            "pickle.loads(functions)\n"
+            "print(sorted(name for name in sys.modules if name.split('.')[0] == 'app'))\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                            capture_output=True, text=True).stdout
+
+    assert output.strip() == '[]'
@@ -0,0 +1,22 @@
+"""Connections of the pools are given back by workload threads"""
+import threading
+
+from app import workloads
+from app.pool import POOLS, ConnectionPool
+
+
+def test_workload_with_more_threads_than_free_connections_finishes():
+    pool = ConnectionPool(object, size=2)
+    try:
+        pool.acquire()  # held by the main thread, e.g. after create_schema()
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(
+            workloads.run_workload([pool.acquire] * 50, concurrency=4)), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+
+        assert not thread.is_alive()
+        assert result['requests'] == 50 and result['errors'] == 0
+    finally:
+        pool.release()
+        POOLS.remove(pool)
@@ -0,0 +1,63 @@
+"""Recommendations agree with brute-force product of FOLLOWS and LIKES"""
+import numpy as np
+
+from app.recommendations import Recommender
+
+FOLLOWS = [(0, 1), (0, 2), (0, 3), (1, 0), (1, 2), (2, 3), (3, 0), (3, 1), (3, 4),
+           (4, 2), (5, 0), (5, 4)]
+LIKES = [(0, 10), (0, 11), (1, 10), (1, 12), (1, 13), (2, 11), (2, 12), (2, 14),
+         (3, 10), (3, 14), (3, 15), (4, 12), (4, 15), (4, 16)]
+
+
+def recommended(follows, likes, user_id, k):
+    """ Return books liked by followed users and not by user,
+     by amount of followed users liking them and then by id """
+    users = max(max(pair) for pair in follows) + 1
+    books = max(book for _, book in likes) + 1
+    followed, liked = np.zeros((users, users)), np.zeros((users, books))
+    followed[tuple(np.array(follows).T)] = 1
+    liked[tuple(np.array(likes).T)] = 1
+    scores = (followed @ liked)[user_id]
+    scores[liked[user_id] > 0] = 0
+    books = np.flatnonzero(scores).tolist()
+    return sorted(books, key=lambda book: (-scores[book], book))[:k]
+
+
+def test_build_recommends_books_liked_by_followed_users():
+    recommender = Recommender(k=3)
+    recommender.build(FOLLOWS, LIKES)
+
+    for user_id in range(6):
+        assert recommender.recommend(user_id, 3) == recommended(FOLLOWS, LIKES, user_id, 3)
+        assert recommender.recommend(user_id, 10) == recommended(FOLLOWS, LIKES, user_id, 10)
+
+
+def test_added_relationships_update_recommendations_of_affected_users():
+    recommender = Recommender(k=3)
+    recommender.build(FOLLOWS, LIKES)
+    for user_id in range(6):
+        recommender.recommend(user_id)
+
+    recommender.add_like(2, 16)
+    recommender.add_like(0, 12)
+    recommender.add_follow(5, 2)
+    follows, likes = FOLLOWS + [(5, 2)], LIKES + [(2, 16), (0, 12)]
+
+    for user_id in range(6):
+        assert recommender.recommend(user_id, 3) == recommended(follows, likes, user_id, 3)
+    recommender.compact()
+    for user_id in range(6):
+        assert recommender.recommend(user_id, 3) == recommended(follows, likes, user_id, 3)
+
+
+def test_recommendations_survive_arrays_round_trip():
+    recommender = Recommender(k=3)
+    recommender.build(FOLLOWS, LIKES)
+    recommender.add_like(4, 10)
+
+    restored = Recommender(k=3)
+    restored.load_arrays(recommender.arrays())
+
+    for user_id in range(6):
+        assert restored.recommend(user_id, 3) == recommended(FOLLOWS, LIKES + [(4, 10)],
+                                                             user_id, 3)
@@ -0,0 +1,41 @@
+"""Write endpoint of the web app on the memory backend"""
+import pytest
+
+from app import app, memory_models
+from app.passwords import verifier
+
+
+@pytest.fixture
+def client():
+    app.config.update(MODELS='app.memory_models', SNAPSHOT=None, WRITE_BEHIND=False)
+    memory_models.clear_graph()
+    memory_models.User.insert_many([{'user_id': user_id, 'username': 'user%d' % user_id,
+                                     'password': 'hash'} for user_id in (1, 2)])
+    memory_models.Book.insert_many([{'book_id': 5, 'authors': 'author', 'year': 2000,
+                                     'title': 'book', 'language': 'eng'}])
+    verifier.sessions.put('token-of-1', 1)
+    yield app.test_client()
+    verifier.logout('token-of-1')
+    memory_models.clear_graph()
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer unknown'},
+                                     {'Authorization': 'Basic token-of-1'}])
+def test_relationship_without_session_is_unauthorized(client, headers):
+    response = client.post('/api/users/1/reads/5', headers=headers)
+
+    assert response.status_code == 401
+    assert list(memory_models.relationships('reads')) == []
+
+
+def test_relationship_of_another_user_is_forbidden(client):
+    response = client.post('/api/users/2/reads/5', headers={'Authorization': 'Bearer token-of-1'})
+
+    assert response.status_code == 403
+
+
+def test_relationship_of_session_user_is_created(client):
+    response = client.post('/api/users/1/reads/5', headers={'Authorization': 'Bearer token-of-1'})
+
+    assert response.status_code == 204
+    assert list(memory_models.relationships('reads')) == [(1, 5)]
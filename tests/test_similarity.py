@@ -0,0 +1,91 @@
+"""Similar books of tag vectors agree with brute-force cosine similarity"""
+import numpy as np
+import pytest
+
+from app import similarity
+from app.similarity import TagSimilarity
+
+EDGES = [(0, 0), (0, 1), (0, 1), (1, 0), (1, 2), (2, 1), (2, 2), (2, 3), (3, 3),
+         (3, 0), (4, 1), (4, 3), (5, 2), (5, 0), (5, 0), (6, 4), (6, 1), (7, 4),
+         (7, 2), (8, 0), (8, 4), (9, 3), (9, 1), (9, 4)]
+
+
+def cosine(edges, idf_edges=None):
+    """ Return matrix of cosine similarity of books, tags are weighted
+     by inverse frequency in idf_edges, edges by default """
+    books, tags = np.array(edges).T
+    width = max(tags.max(), np.array(idf_edges or edges)[:, 1].max()) + 1
+    counts = np.zeros((books.max() + 1, width))
+    np.add.at(counts, (books, tags), 1)
+    idf_books, idf_tags = np.array(idf_edges or edges).T
+    tagged = len(set(idf_books.tolist()))
+    frequencies = np.array([len(set(idf_books[idf_tags == tag].tolist())) for tag in range(width)])
+    # tags given to no book are as rare as possible
+    idf = np.log(tagged / np.maximum(frequencies, 1)) + 1
+    weights = np.where(counts > 0, (1 + np.log(np.maximum(counts, 1))) * idf, 0)
+    weights /= np.sqrt((weights ** 2).sum(axis=1, keepdims=True))
+    return weights @ weights.T
+
+
+def assert_most_similar(similar, scores, book_id, k):
+    """ Assert similar books of book have the k highest positive scores of its row """
+    row = scores[book_id].copy()
+    row[book_id] = 0
+    expected = np.sort(row[row > 1e-9])[::-1][:k]
+    assert len(similar) == len(expected)
+    assert np.allclose(np.sort(row[similar])[::-1], expected)
+
+
+@pytest.mark.parametrize('dense_ratio', [0, 1000], ids=['sparse', 'dense'])
+def test_build_finds_books_with_highest_cosine_similarity(monkeypatch, dense_ratio):
+    monkeypatch.setattr(similarity, 'DENSE_RATIO', dense_ratio)
+    index = TagSimilarity(k=3)
+    books, tags = np.array(EDGES).T
+    index.build(books, tags, np.ones(len(EDGES)))
+
+    scores = cosine(EDGES)
+    for book_id in range(10):
+        assert_most_similar(index.similar(book_id, 3), scores, book_id, 3)
+        assert_most_similar(index.similar(book_id, 9), scores, book_id, 9)
+
+
+def test_repeated_tags_of_book_are_counted():
+    repeated = TagSimilarity(k=3)
+    books, tags = np.array(EDGES).T
+    repeated.build(books, tags, np.ones(len(EDGES)))
+    summed = TagSimilarity(k=3)
+    pairs, counts = np.unique(np.array(EDGES), axis=0, return_counts=True)
+    summed.build(pairs[:, 0], pairs[:, 1], counts)
+
+    assert np.array_equal(repeated.arrays()['book_weights'], summed.arrays()['book_weights'])
+    for book_id in range(10):
+        assert repeated.similar(book_id, 9) == summed.similar(book_id, 9)
+
+
+def test_added_tag_updates_vector_of_tagged_book_with_weights_of_build():
+    index = TagSimilarity(k=3)
+    books, tags = np.array(EDGES).T
+    index.build(books, tags, np.ones(len(EDGES)))
+    assert 1 <= similarity.REBUILD_FRACTION * len(EDGES)
+
+    index.add(3, 2)
+
+    scores = cosine(EDGES + [(3, 2)], idf_edges=EDGES)
+    assert_most_similar(index.similar(3, 3), scores, 3, 3)
+    for book_id in range(10):
+        assert_most_similar(index.similar(book_id, 9), scores, book_id, 9)
+
+
+def test_many_added_tags_rebuild_all_vectors():
+    index = TagSimilarity(k=3)
+    books, tags = np.array(EDGES).T
+    index.build(books, tags, np.ones(len(EDGES)))
+    added = [(3, 2), (10, 1), (10, 4), (0, 5)]
+    assert len(added) > similarity.REBUILD_FRACTION * len(EDGES)
+
+    for book_id, tag_id in added:
+        index.add(book_id, tag_id)
+
+    scores = cosine(EDGES + added)
+    for book_id in range(11):
+        assert_most_similar(index.similar(book_id, 3), scores, book_id, 3)
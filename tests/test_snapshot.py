@@ -0,0 +1,99 @@
+"""Snapshots are saved, switched and mapped back without changes"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from app import datasets, snapshot
+from app.popularity import reader_counts
+from app.recommendations import recommender
+from app.similarity import book_similarity
+from app.tag_index import tag_index
+
+NODES = {'users': [1, 2, 3], 'books': [10, 11, 12], 'tags': [5, 6]}
+EDGES = {'reads': ([1, 2, 2], [10, 10, 12]),
+         'tagged_to': ([10, 11, 12, 12], [5, 5, 5, 6]),
+         'follows': ([1, 2], [2, 3]),
+         'likes': ([2, 3], [11, 12])}
+TAG_NAMES = ([5, 6], ['fantasy', 'classics'])
+
+
+@pytest.fixture
+def indexes():
+    yield
+    reader_counts.clear()
+    tag_index.clear()
+    book_similarity.clear()
+    recommender.clear()
+
+
+def test_loaded_snapshot_maps_saved_arrays(tmp_path):
+    saved = snapshot.build(NODES, EDGES, TAG_NAMES)
+    path = saved.save(str(tmp_path / 'snapshot'))
+
+    loaded = snapshot.load(path)
+
+    assert os.path.islink(path)
+    assert sorted(loaded.arrays) == sorted(saved.arrays)
+    for name, array in saved.arrays.items():
+        assert isinstance(loaded.arrays[name], np.memmap)
+        assert loaded.arrays[name].dtype == array.dtype
+        assert np.array_equal(loaded.arrays[name], array)
+    assert loaded.neighbours('reads', 2).tolist() == [10, 12]
+
+
+def test_mapped_snapshot_stays_readable_after_next_save(tmp_path):
+    path = snapshot.build(NODES, EDGES, TAG_NAMES).save(str(tmp_path / 'snapshot'))
+    old = snapshot.load(path)
+
+    edges = dict(EDGES, reads=([1, 3], [11, 11]))
+    snapshot.build(NODES, edges, TAG_NAMES).save(path)
+
+    assert old.neighbours('reads', 2).tolist() == [10, 12]
+    assert snapshot.load(path).neighbours('reads', 3).tolist() == [11]
+    # symlink and directory of the new snapshot, the old one was removed
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def test_snapshot_of_another_version_is_rejected(tmp_path):
+    path = snapshot.build(NODES, EDGES, TAG_NAMES).save(str(tmp_path / 'snapshot'))
+    manifest_path = os.path.join(path, snapshot.MANIFEST)
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest['version'] = snapshot.SNAPSHOT_VERSION - 1
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load(path)
+
+
+def test_warm_start_without_snapshot_builds_indexes_from_datasets(tmp_path, monkeypatch,
+                                                                  indexes):
+    for name, header, rows in (('reads', 'user_id,book_id', EDGES['reads']),
+                               ('tagged_to', 'book_id,tag_id', EDGES['tagged_to']),
+                               ('follows', 'user,friend', EDGES['follows']),
+                               ('likes', 'user_id,book_id', EDGES['likes']),
+                               ('tags', 'tag_id,tag_name', TAG_NAMES)):
+        lines = [header] + ['%s,%s' % row for row in zip(*rows)]
+        (tmp_path / datasets.DATASETS[name][0]).write_text('\n'.join(lines) + '\n')
+    monkeypatch.setattr(datasets, 'DATASETS_DIR', str(tmp_path))
+
+    with pytest.warns(UserWarning):
+        assert snapshot.warm_start_or_build(str(tmp_path / 'snapshot')) is None
+
+    assert reader_counts.top(1) == [10]
+    assert tag_index.books(5).tolist() == [10, 11, 12]
+    assert book_similarity.similar(10) == [11, 12]
+    assert recommender.recommend(1) == [11]
+
+
+def test_warm_start_maps_indexes_of_snapshot(tmp_path, indexes):
+    path = snapshot.build(NODES, EDGES, TAG_NAMES).save(str(tmp_path / 'snapshot'))
+
+    loaded = snapshot.warm_start_or_build(path)
+
+    assert loaded.source is None
+    assert tag_index.tag_names(12) == ['fantasy', 'classics']
+    assert recommender.recommend(1) == [11]
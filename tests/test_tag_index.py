@@ -0,0 +1,80 @@
+"""Tag index lists the same tags and books as a dict of its relationships"""
+from collections import defaultdict
+
+import pytest
+
+from app.tag_index import TagIndex
+from app.utils import index_updates
+
+EDGES = [(1, 10), (1, 11), (2, 10), (3, 12), (3, 10), (5, 11), (5, 13), (8, 12)]
+
+
+def assert_same_as_dict(index, edges):
+    tags, books = defaultdict(set), defaultdict(set)
+    for book_id, tag_id in edges:
+        tags[book_id].add(tag_id)
+        books[tag_id].add(book_id)
+
+    assert len(index) == len(edges)
+    for book_id in range(10):
+        assert sorted(index.tags(book_id).tolist()) == sorted(tags[book_id])
+    for tag_id in range(15):
+        assert index.books(tag_id).tolist() == sorted(books[tag_id])
+    assert index.books(10, 11).tolist() == sorted(books[10] & books[11])
+
+
+def test_built_index_lists_tags_of_books_and_books_of_tags():
+    index = TagIndex()
+    index.build(*zip(*EDGES), names=([10, 11, 12, 13], ['a', 'b', 'c', 'd']))
+
+    assert index.complete
+    assert_same_as_dict(index, EDGES)
+    assert sorted(index.tag_names(1)) == ['a', 'b']
+
+
+def test_added_relationships_are_listed_before_and_after_compact():
+    index = TagIndex()
+    index.build(*zip(*EDGES))
+    added = [(2, 11), (9, 14), (5, 10)]
+
+    for book_id, tag_id in added:
+        index.add(book_id, tag_id)
+    assert_same_as_dict(index, EDGES + added)
+
+    index.compact()
+    assert index.complete
+    assert_same_as_dict(index, EDGES + added)
+
+
+def test_cleared_index_is_incomplete():
+    index = TagIndex()
+    index.build(*zip(*EDGES))
+
+    index.clear()
+
+    assert not index.complete
+    assert_same_as_dict(index, [])
+
+
+class FakeGraph:
+    """ Graph returning every relationship of the query as created """
+
+    def run(self, query, rows):
+        return [{'from_id': from_id, 'to_id': to_id} for from_id, to_id in rows]
+
+
+def test_paused_index_updates_leave_tag_index_alone(monkeypatch):
+    neo4j_models = pytest.importorskip("app.neo4j_models")
+    monkeypatch.setattr(neo4j_models, 'graph', FakeGraph())
+    index = TagIndex()
+    index.build(*zip(*EDGES))
+    monkeypatch.setattr(neo4j_models, 'tag_index', index)
+    monkeypatch.setattr(neo4j_models, 'book_similarity', neo4j_models.book_similarity.__class__())
+
+    with index_updates.paused():
+        neo4j_models.Book.link_to_tag_many([(2, 11), (9, 14)])
+    assert index_updates.enabled
+    assert_same_as_dict(index, EDGES)
+
+    neo4j_models.Book.link_to_tag_many([(2, 11)])
+    assert_same_as_dict(index, EDGES + [(2, 11)])
@@ -0,0 +1,71 @@
+"""Workloads draw Zipf distributed keys and measure latency of concurrent calls"""
+import threading
+from collections import Counter
+from time import sleep
+
+import numpy as np
+
+from app import workloads
+
+KEYS = ['book%d' % book_id for book_id in range(100)]
+SERVICE = 0.05
+
+
+def _slow():
+    sleep(SERVICE)
+
+
+def test_zipf_sample_is_skewed_to_first_keys():
+    sample = workloads.zipf_sample(KEYS, 20000, exponent=1.1, random=np.random.RandomState(0))
+    counts = Counter(sample)
+    weights = np.arange(1, len(KEYS) + 1, dtype=float) ** -1.1
+
+    assert len(sample) == 20000
+    assert set(counts) <= set(KEYS)
+    assert abs(counts['book0'] / 20000 - weights[0] / weights.sum()) < 0.01
+    assert 1.8 < counts['book0'] / counts['book1'] < 2.6
+    assert counts['book0'] > counts['book9'] > counts['book99']
+    assert sample == workloads.zipf_sample(KEYS, 20000, exponent=1.1,
+                                           random=np.random.RandomState(0))
+
+
+def test_closed_loop_workers_run_all_calls():
+    calls_of_thread = Counter()
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            calls_of_thread[threading.get_ident()] += 1
+        sleep(0.001)
+
+    def failing():
+        raise ValueError('password rejected')
+
+    stats = workloads.run_workload([call] * 200 + [failing] * 3, concurrency=4)
+
+    assert stats['requests'] == 203
+    assert stats['errors'] == 3
+    assert sum(calls_of_thread.values()) == 200
+    assert 1 < len(calls_of_thread) <= 4
+    assert stats['throughput'] > 0
+    assert stats['p50'] <= stats['p99'] <= stats['p999']
+
+
+def test_open_loop_latency_includes_queueing():
+    # operations arrive every 10 ms on average, one thread serves each in 50 ms
+    operations = [('slow', _slow)] * 4 + [('fast', lambda: None)]
+    arrivals = np.cumsum(np.random.RandomState(0).exponential(1.0 / 100, size=5))
+
+    stats = workloads.run_open_loop(operations, rate=100, concurrency=1, seed=0)
+
+    assert stats['all']['requests'] == 5
+    assert stats['slow']['requests'] == 4
+    assert stats['all']['service'] >= SERVICE * 4 / 5
+    # the fast operation waits for all slow ones scheduled before it
+    assert stats['fast']['p50'] >= SERVICE * 4 - arrivals[-1]
+    assert stats['fast']['p50'] > stats['fast']['service'] + SERVICE
+    assert stats['all']['offered'] == 100
+    # achieved rate is bound by the thread serving all slow operations, not by arrivals
+    assert stats['all']['throughput'] <= 5 / (SERVICE * 4)
+    assert stats['all']['throughput'] < stats['all']['offered'] / 2
+    assert sum(stats['all']['histogram']) == 5
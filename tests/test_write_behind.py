@@ -0,0 +1,80 @@
+"""Write-behind buffer writes every relationship once and flushes users on demand"""
+import threading
+import time
+from collections import Counter
+
+from app.write_behind import WriteBehind
+
+
+class Sink:
+    """ Writers recording pairs written per relationship """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.written = {'reads': [], 'likes': []}
+        self._lock = threading.Lock()
+
+    def writers(self):
+        return {relationship: self._writer(relationship) for relationship in self.written}
+
+    def _writer(self, relationship):
+        def write(pairs, batch_size):
+            time.sleep(self.delay)
+            with self._lock:
+                self.written[relationship].extend(pairs)
+        return write
+
+
+def test_buffered_relationships_are_written_by_flush():
+    sink = Sink()
+    buffer = WriteBehind(sink.writers(), flush_size=100)
+
+    buffer.add('reads', 1, 10)
+    buffer.add('likes', 1, 11)
+
+    assert sink.written == {'reads': [], 'likes': []}
+    assert buffer.pending('reads', 1) == [10]
+    assert buffer.flush() == 2
+    assert sink.written == {'reads': [(1, 10)], 'likes': [(1, 11)]}
+    assert len(buffer) == 0
+
+
+def test_flush_of_user_writes_only_relationships_of_the_user():
+    sink = Sink()
+    buffer = WriteBehind(sink.writers(), flush_size=100)
+    buffer.add('reads', 1, 10)
+    buffer.add('reads', 2, 10)
+    buffer.add('likes', 2, 12)
+    buffer.add('likes', 1, 11)
+
+    assert buffer.flush(2) == 2
+
+    assert sink.written == {'reads': [(2, 10)], 'likes': [(2, 12)]}
+    assert buffer.pending('reads', 1) == [10] and buffer.pending('likes', 1) == [11]
+    assert buffer.flush(2) == 0
+
+
+def test_nothing_is_lost_when_full_buffer_and_explicit_flushes_interleave():
+    sink = Sink(delay=0.001)
+    buffer = WriteBehind(sink.writers(), flush_size=20, interval=60)
+    buffer.start()
+
+    def add(user_id):
+        for book_id in range(500):
+            buffer.add('reads' if book_id % 2 else 'likes', user_id, book_id)
+            if book_id % 50 == 0:
+                buffer.flush(user_id if book_id % 100 else None)
+
+    threads = [threading.Thread(target=add, args=(user_id,)) for user_id in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    buffer.close()
+
+    expected = Counter(('reads' if book_id % 2 else 'likes', user_id, book_id)
+                       for user_id in range(6) for book_id in range(500))
+    assert Counter((relationship, user_id, book_id)
+                   for relationship, pairs in sink.written.items()
+                   for user_id, book_id in pairs) == expected
+    assert buffer.written == 3000 and len(buffer) == 0